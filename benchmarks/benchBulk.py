@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+# Compares a parser rule returning 'inserts' with bulk payload rules for a
+# gateway publishing 200 readings per message, with and without encoding the
+# points to line protocol.
+
+import json
+import time
+
+from mqtt2influxdb import influxdb_
+from mqtt2influxdb import payload
+from mqtt2influxdb import rule
+
+MESSAGES = 200
+READINGS = 200
+
+PARSER = """
+inserts = []
+for reading in payload['readings']:
+    inserts.append({
+        'measurement': 'sensor',
+        'tags': {'gateway': tokens['gateway'], 'sensor': reading['id']},
+        'fields': {'temperature': float(reading['t']), 'humidity': float(reading['h'])},
+        'time': reading['ts'] * 1000000,
+    })
+"""
+
+BULK = {
+    'json': 'readings',
+    'tags': {'sensor': 'id'},
+    'fields': {'temperature': {'key': 't', 'type': 'float'}, 'humidity': {'key': 'h', 'type': 'float'}},
+    'time': 'ts',
+    'unit': 'ms',
+}
+
+RULES = {
+    'parser': {'topic': 'gateway/+gateway', 'payload': {'parser': PARSER}},
+    'bulk (rows)': {'topic': 'gateway/+gateway', 'measurement': 'sensor', 'tokens': {'gateway': {'tag': True}}, 'bulk': BULK},
+    'bulk (columns)': {'topic': 'gateway/+gateway', 'measurement': 'sensor', 'tokens': {'gateway': {'tag': True}}, 'bulk': BULK},
+}
+
+def createPayload(columns):
+    readings = [{'id': f"sensor{index}", 't': 20.0 + index / 100, 'h': 50.0, 'ts': 1700000000000 + index} for index in range(READINGS)]
+    if columns:
+        readings = {key: [reading[key] for reading in readings] for key in readings[0]}
+    return json.dumps({'readings': readings}).encode('utf-8')
+
+def main():
+    for name, ruleConfig in RULES.items():
+        compiledRule = rule.Rule(ruleConfig, 0)
+        raw = createPayload(name == 'bulk (columns)')
+        encoder = influxdb_.LineProtocolEncoder()
+
+        for encode in [False, True]:
+            # Best of 10 runs
+            durations = []
+            for _ in range(10):
+                start = time.perf_counter()
+                for _ in range(MESSAGES):
+                    points = compiledRule.apply('gateway/gw1', payload.Payload(raw), 0)
+                    if encode:
+                        for point in points:
+                            encoder.encode(point)
+                durations.append(time.perf_counter() - start)
+            duration = min(durations)
+
+            label = f"{name}{' + encode' if encode else ''}"
+            print(f"{label:<26} {duration / (MESSAGES * READINGS) * 1e9:>6.0f} ns/point ({len(points)} points/msg)")
+
+if __name__ == "__main__":
+    main()
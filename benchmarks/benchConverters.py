@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+# Compares the regular expression based type inference which rules used
+# before with the converters module, for a mix of typical payload values.
+
+import json
+import random
+import re
+import timeit
+
+from mqtt2influxdb import converters
+
+VALUES = 100000
+
+def legacyConvertToType(value, type_):
+    if type_ is None:
+        if re.match(r"^-?\d+\.?\d*$", value) is not None:
+            return float(value)
+        elif re.match(r"^true|false$", value, re.IGNORECASE) is not None:
+            return bool(value)
+        else:
+            return value
+    elif type_ == "int":
+        return int(value)
+    elif type_ == "float":
+        return float(value)
+    elif type_ == "bool":
+        return bool(value)
+    elif type_ == "json":
+        return json.loads(value)
+    else:
+        return str(value)
+
+def createValues(count):
+    random.seed(0)
+    choices = [
+        lambda: f"{random.uniform(-20, 40):.2f}",
+        lambda: str(random.randrange(1000)),
+        lambda: random.choice(["true", "false", "ON", "OFF"]),
+        lambda: random.choice(["online", "offline", "idle"]),
+    ]
+    return [random.choice(choices)() for _ in range(count)]
+
+def measure(name, function, values):
+    seconds = min(timeit.repeat(lambda: [function(value) for value in values], number=1, repeat=5))
+    print(f"{name:<22} {seconds * 1e9 / len(values):>6.0f} ns/value")
+
+def main():
+    values = createValues(VALUES)
+    numbers = [f"{random.uniform(-20, 40):.2f}" for _ in range(VALUES)]
+
+    measure("legacy inference", lambda value: legacyConvertToType(value, None), values)
+    measure("inferType", converters.inferType, values)
+    measure("learned (fixed)", converters.getConverter(None, learn=1), numbers)
+    measure("legacy float", lambda value: legacyConvertToType(value, "float"), numbers)
+    measure("float", converters.getConverter("float"), numbers)
+
+if __name__ == "__main__":
+    main()
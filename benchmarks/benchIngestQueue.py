@@ -0,0 +1,66 @@
+#!/usr/bin/python
+
+# Measures the cost of Mqtt._mqtt_on_message and of the queue operations for
+# the different overflow policies of the ingest queue.
+
+import logging
+import queue
+import tempfile
+import pathlib
+import time
+
+import paho.mqtt.client as mqttClient
+
+from mqtt2influxdb import mqtt
+
+MESSAGES = 200000
+
+def createMessages(count):
+    # As received from paho, with prefix
+    messages = []
+    for index in range(count):
+        msg = mqttClient.MQTTMessage(topic=f"home/room{index % 100}/sensor/temperature".encode('utf-8'))
+        msg.payload = b"21.5"
+        messages.append(msg)
+    return messages
+
+def createQueuedMessages(count):
+    return [mqtt.Message(f"room{index % 100}/sensor/temperature", b"21.5") for index in range(count)]
+
+def measure(name, queue_, messages):
+    start = time.perf_counter()
+    for msg in messages:
+        queue_.put(msg)
+    putTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    while not queue_.empty():
+        queue_.get()
+        queue_.task_done()
+    getTime = time.perf_counter() - start
+
+    print(f"{name:<28} put {putTime / len(messages) * 1e9:>6.0f} ns/msg   get {getTime / len(messages) * 1e9:>6.0f} ns/msg")
+
+def main():
+    # Drop warnings are expected here
+    logging.disable(logging.WARNING)
+
+    messages = createQueuedMessages(MESSAGES)
+
+    measure("queue.Queue", queue.Queue(), messages)
+    measure("IngestQueue unbounded", mqtt.IngestQueue(), messages)
+    measure("IngestQueue drop_newest", mqtt.IngestQueue(MESSAGES // 2, 'drop_newest'), messages)
+    measure("IngestQueue drop_oldest", mqtt.IngestQueue(MESSAGES // 2, 'drop_oldest'), messages)
+    with tempfile.TemporaryDirectory() as directory:
+        measure("IngestQueue spill", mqtt.IngestQueue(MESSAGES // 2, 'spill', pathlib.Path(directory) / 'spill'), messages)
+
+    # Complete message callback including the prefix handling
+    m = mqtt.Mqtt({'mqtt': {'prefix': 'home'}})
+    start = time.perf_counter()
+    for msg in createMessages(MESSAGES):
+        m._mqtt_on_message(None, None, msg)
+    duration = time.perf_counter() - start
+    print(f"{'_mqtt_on_message':<28}     {duration / MESSAGES * 1e9:>6.0f} ns/msg")
+
+if __name__ == "__main__":
+    main()
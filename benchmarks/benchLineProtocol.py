@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+# Compares InfluxDBClient.write_points() with the line protocol encoder of
+# Influxdb for 100k points, written to a local stub server. CPU time is the
+# time of the writing thread, bytes are the bytes of the request bodies.
+
+import http.server
+import random
+import threading
+import time
+
+import influxdb
+
+from mqtt2influxdb import influxdb_
+
+POINTS = 100000
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.server.bytes += len(self.rfile.read(int(self.headers['Content-Length'])))
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def createPoints(count):
+    random.seed(0)
+    points = []
+    for _ in range(count):
+        points.append({
+            'measurement': random.choice(['temperature', 'humidity', 'pressure']),
+            'tags': {'room': random.choice(['livingroom', 'kitchen', 'bedroom', 'office']), 'sensor': f"sensor-{random.randrange(20)}"},
+            'fields': {'value': random.uniform(0, 100)},
+        })
+    return points
+
+def measure(name, server, function):
+    server.bytes = 0
+    start = time.thread_time()
+    function()
+    cpu = time.thread_time() - start
+    print(f"{name:<26} CPU {cpu * 1000:>7.0f} ms   sent {server.bytes / 1024:>7.0f} KiB")
+
+def main():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.bytes = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    points = createPoints(POINTS)
+    client = influxdb.InfluxDBClient('127.0.0.1', server.server_address[1], database='bench')
+
+    measure("write_points", server, lambda: client.write_points(points))
+
+    for name, compressLevel in [("encoder", None), ("encoder gzip level 1", 1), ("encoder gzip level 6", 6)]:
+        db = influxdb_.Influxdb({'influxdb': {'address': '127.0.0.1', 'port': server.server_address[1], 'database': 'bench'}})
+        db._backend.client = client
+        db.compressLevel = compressLevel
+
+        def write():
+            db._writeLines([db._encoder.encode(point) for point in points])
+
+        measure(name, server, write)
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
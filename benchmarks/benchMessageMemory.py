@@ -0,0 +1,99 @@
+#!/usr/bin/python
+
+# Measures the memory of queued messages and the allocations of the message
+# callback with tracemalloc: paho's MQTTMessage, which was queued before, and
+# the mqtt.Message record which is queued now.
+
+import gc
+import logging
+import os
+import time
+import tracemalloc
+
+import paho.mqtt.client as mqttClient
+
+from mqtt2influxdb import mqtt
+
+MESSAGES = 100000
+
+def createPahoMessage(index):
+    msg = mqttClient.MQTTMessage(topic=f"home/room{index % 100}/sensor/temperature".encode('utf-8'))
+    msg.payload = b"21.5"
+    return msg
+
+def createMessage(index):
+    return mqtt.Message(f"room{index % 100}/sensor/temperature", b"21.5")
+
+def rss():
+    # Resident set size in bytes, Linux only
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+def traced(function):
+    """
+        Returns the result of function, the bytes and blocks it allocated and
+        which are still alive, and the peak of its allocations in bytes.
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    result = function()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    size = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    return result, size, blocks, peak
+
+def untraced(function):
+    """
+        Returns the result of function and the growth of the RSS, tracemalloc
+        would inflate the RSS with its own bookkeeping.
+    """
+    gc.collect()
+    before = rss()
+    result = function()
+    return result, rss() - before
+
+def measureQueued(name, create):
+    def run():
+        return [create(index) for index in range(MESSAGES)]
+    _, size, blocks, _ = traced(run)
+    _, rssDiff = untraced(run)
+    print(f"{name:<24} {size / MESSAGES:>6.0f} bytes/msg   {blocks / MESSAGES:>5.1f} blocks/msg   RSS {rssDiff / 1024 / 1024:>6.1f} MiB")
+
+def measureCallback(level):
+    logging.getLogger().setLevel(level)
+    messages = [createPahoMessage(index) for index in range(MESSAGES)]
+
+    def run():
+        m = mqtt.Mqtt({'mqtt': {'prefix': 'home'}})
+        start = time.perf_counter()
+        for msg in messages:
+            m._mqtt_on_message(None, None, msg)
+        return m, time.perf_counter() - start
+    _, size, blocks, peak = traced(run)
+    (_, duration), rssDiff = untraced(run)
+    name = f"callback ({logging.getLevelName(level)})"
+    print(f"{name:<24} {size / MESSAGES:>6.0f} bytes/msg   {blocks / MESSAGES:>5.1f} blocks/msg   "
+          f"RSS {rssDiff / 1024 / 1024:>6.1f} MiB   peak {peak / MESSAGES:.0f} bytes/msg   {duration / MESSAGES * 1e9:.0f} ns/msg")
+
+def main():
+    # Debug messages are logged into the void
+    logging.basicConfig(handlers=[logging.NullHandler()])
+
+    print(f"{MESSAGES} messages")
+    measureQueued("paho MQTTMessage", createPahoMessage)
+    measureQueued("mqtt.Message", createMessage)
+
+    measureCallback(logging.INFO)
+    measureCallback(logging.DEBUG)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+# Measures messages per second through RuleHandler for a parser rule with
+# worker threads and processes, using in-memory stand-ins for MQTT and
+# InfluxDB. The 'cpu' parser computes for about a millisecond, the 'sleep'
+# parser sleeps 5 ms instead, so it shows how many messages are evaluated in
+# the processes at the same time even on a machine with a single core.
+
+import queue
+import time
+
+from mqtt2influxdb import mqtt
+from mqtt2influxdb.rule_handler import RuleHandler
+
+MESSAGES = 2000
+
+PARSERS = {
+    'cpu': """
+total = 0.0
+for index in range(20000):
+    total += index * float(payload['value'])
+fields = {'value': float(payload['value']), 'total': total}
+tags = {'device': tokens['device']}
+""",
+    'sleep': """
+__import__('time').sleep(0.005)
+fields = {'value': float(payload['value'])}
+tags = {'device': tokens['device']}
+""",
+}
+
+class StubMqtt:
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def getQueue(self):
+        return self.queue
+
+    def subscribe(self, topics):
+        pass
+
+class StubInfluxdb:
+    def __init__(self):
+        self.points = 0
+
+    def write(self, message):
+        self.points += len(message)
+
+def measure(parser, threads, processes):
+    m = StubMqtt()
+    influxdb = StubInfluxdb()
+    config = {'rules': [{'topic': 'sensors/+device', 'measurement': 'sensor', 'payload': {'parser': PARSERS[parser]}}]}
+    rh = RuleHandler({**config, 'workers': {'threads': threads, 'processes': processes}}, m, influxdb)
+
+    # The worker processes are started by the first messages
+    for index in range(processes * 4):
+        m.queue.put(mqtt.Message(f"sensors/device{index}", b'{"value": 1.5}'))
+    m.queue.join()
+
+    start = time.perf_counter()
+    for index in range(MESSAGES):
+        m.queue.put(mqtt.Message(f"sensors/device{index % 100}", b'{"value": 1.5}'))
+    m.queue.join()
+    duration = time.perf_counter() - start
+    rh.finish()
+
+    print(f"{parser:<6} threads {threads} processes {processes}: {MESSAGES / duration:>6.0f} msgs/s")
+
+def main():
+    for parser in PARSERS:
+        for threads, processes in [(1, 0), (1, 1), (1, 2), (1, 4), (4, 4)]:
+            measure(parser, threads, processes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+# Measures the cost of the retained messages a broker sends on every
+# (re)connect: 20000 retained topics, of which 10% are accepted by a rule
+# with 'retain: True'. The first pass is the initial subscribe, the second
+# one a reconnect.
+
+import logging
+import time
+
+from mqtt2influxdb import mqtt
+from mqtt2influxdb.rule_handler import RuleHandler
+
+TOPICS = 20000
+
+RULES = [
+    {
+        'topic': '+room/+sensor/+quantity',
+        'payload': {'type': 'float', 'name': 'value', 'field': True},
+        'tokens': {'room': {'tag': True}, 'sensor': {'tag': True}, 'quantity': {'measurement': True}},
+    },
+    {
+        'topic': 'device/+device',
+        'retain': True,
+        'measurement': 'device',
+        'payload': {'type': 'json', 'json': 'battery', 'name': 'battery', 'field': True},
+        'tokens': {'device': {'tag': True}},
+    },
+]
+
+class StubMqtt:
+    def getQueue(self):
+        return None
+
+    def subscribe(self, topics):
+        pass
+
+class StubInfluxdb:
+    def __init__(self):
+        self.points = 0
+
+    def write(self, message):
+        self.points += len(message)
+
+def createMessages(count):
+    messages = []
+    for index in range(count):
+        if index % 10 == 0:
+            messages.append(mqtt.Message(f"device/plug{index}", b'{"battery": 97}', retain=True))
+        else:
+            messages.append(mqtt.Message(f"room{index}/sensor/temperature", b"21.5", retain=True))
+    return messages
+
+def main():
+    logging.disable(logging.INFO)
+
+    influxdb = StubInfluxdb()
+    rh = RuleHandler({'rules': RULES}, StubMqtt(), influxdb, workers=False)
+    messages = createMessages(TOPICS)
+
+    for name in ["subscribe", "reconnect"]:
+        points = influxdb.points
+        start = time.perf_counter()
+        for msg in messages:
+            rh.handleMessage(msg)
+        duration = time.perf_counter() - start
+        print(f"{name:<10} {TOPICS} retained messages in {duration * 1000:>6.1f} ms ({duration / TOPICS * 1e9:>5.0f} ns/msg), "
+              f"{influxdb.points - points} points")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+# Measures messages per second through RuleHandler for the rules of the
+# sample configuration, using in-memory stand-ins for MQTT and InfluxDB.
+
+import pathlib
+import queue
+import random
+import time
+
+import yaml
+
+from mqtt2influxdb import mqtt
+from mqtt2influxdb.rule_handler import RuleHandler
+
+MESSAGES = 100000
+CONFIG = pathlib.Path(__file__).parent.parent / "config.yaml.sample"
+
+class StubMqtt:
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def getQueue(self):
+        return self.queue
+
+    def subscribe(self, topics):
+        pass
+
+class StubInfluxdb:
+    def __init__(self):
+        self.points = 0
+
+    def write(self, message):
+        self.points += len(message)
+
+def createMessages(count):
+    random.seed(0)
+    messages = []
+    for _ in range(count):
+        room = random.choice(['livingroom', 'kitchen', 'garage'])
+        quantity = random.choice(['humidity', 'pressure', 'temperature'])
+        messages.append(mqtt.Message(f"{room}/environment-sensor/{quantity}", f"{random.uniform(0, 100):.2f}".encode('utf-8')))
+    return messages
+
+def main():
+    config = yaml.safe_load(CONFIG.read_text())
+    mqtt = StubMqtt()
+    influxdb = StubInfluxdb()
+    RuleHandler(config, mqtt, influxdb)
+
+    messages = createMessages(MESSAGES)
+
+    start = time.perf_counter()
+    for msg in messages:
+        mqtt.queue.put(msg)
+    mqtt.queue.join()
+    duration = time.perf_counter() - start
+
+    print(f"{MESSAGES} messages in {duration:.2f} s: {MESSAGES / duration:.0f} msgs/s, {influxdb.points / duration:.0f} points/s")
+
+if __name__ == "__main__":
+    main()
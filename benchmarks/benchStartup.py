@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+# Measures the startup of a configuration with 10000 rules: parsing the config
+# file, compiling the rules and subscribing their topics.
+
+import pathlib
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from mqtt2influxdb import configfile
+from mqtt2influxdb import mqtt
+from mqtt2influxdb.rule_handler import RuleHandler
+
+RULES = 10000
+
+def createConfig(count):
+    rules = []
+    for index in range(count):
+        kind = index % 4
+        if kind == 0:
+            rules.append({
+                'topic': f"site{index % 50}/+room/sensor{index}/temperature",
+                'measurement': 'temperature',
+                'payload': {'type': 'float', 'field': True, 'name': 'value'},
+                'tokens': {'room': {'tag': True}},
+            })
+        elif kind == 1:
+            rules.append({
+                'topic': f"zigbee{index % 20}/+device",
+                'measurement': 'zigbee',
+                'payload': {'type': 'json', 'json': 'linkquality', 'field': True, 'name': 'lqi'},
+                'tokens': {'device': {'tag': True, 'rule': '^[a-z_0-9]+$'}},
+            })
+        elif kind == 2:
+            rules.append({
+                'topic': f"power/+device/meter{index}",
+                'measurement': 'power',
+                'payload': {'parser': "fields = {'value': float(payload)}\ntags = {'device': tokens['device']}"},
+            })
+        else:
+            rules.append({
+                'topic': "home/+room/#rest",
+                'measurement': 'misc',
+                'tags': {'site': f"s{index % 10}"},
+                'payload': {'type': 'string', 'field': True, 'name': 'value'},
+                'tokens': {'room': {'tag': True}},
+            })
+    return {'rules': rules}
+
+class CountingClient:
+    def __init__(self):
+        self.packets = 0
+
+    def subscribe(self, topics):
+        self.packets += 1
+
+class StubInfluxdb:
+    def write(self, message):
+        pass
+
+def measure(name, function):
+    start = time.perf_counter()
+    result = function()
+    print(f"{name:<32} {(time.perf_counter() - start) * 1000:>8.0f} ms")
+    return result
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        configFile = pathlib.Path(directory) / 'config.yaml'
+        configFile.write_text(yaml.safe_dump(createConfig(RULES)))
+        cacheDirectory = pathlib.Path(directory) / 'cache'
+
+        print(f"{RULES} rules, {configFile.stat().st_size / 1024 / 1024:.1f} MiB config")
+        measure("yaml.safe_load", lambda: yaml.safe_load(configFile.read_text()))
+        measure("configfile.load", lambda: configfile.load(configFile))
+        measure("configfile.load (cache miss)", lambda: configfile.load(configFile, cacheDirectory))
+        config = measure("configfile.load (cache hit)", lambda: configfile.load(configFile, cacheDirectory))
+
+    m = mqtt.Mqtt({'mqtt': {'prefix': 'home'}})
+    client = CountingClient()
+    m._clients = [client]
+    rh = measure("RuleHandler", lambda: RuleHandler(config, m, StubInfluxdb(), workers=False))
+    print(f"{'subscribed':<32} {len(rh._ruleSet.normalizedTopics):>8} topics in {client.packets} SUBSCRIBE packets")
+
+    # In a fresh interpreter, the modules are already imported here
+    code = "import time; start = time.perf_counter(); import mqtt2influxdb.mqtt2influxdb; print(time.perf_counter() - start)"
+    importTime = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    print(f"{'import mqtt2influxdb':<32} {float(importTime) * 1000:>8.0f} ms")
+
+if __name__ == "__main__":
+    main()
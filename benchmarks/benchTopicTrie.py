@@ -0,0 +1,64 @@
+#!/usr/bin/python
+
+# Compares the topic trie with the linear scan over all normalized topics
+# using paho's topic_matches_sub().
+
+import random
+import timeit
+
+import paho.mqtt.client as mqttClient
+
+from mqtt2influxdb import topic
+
+RULE_COUNTS = [10, 100, 1000, 10000]
+MESSAGES = 200
+
+def createFilters(count):
+    filters = []
+    for index in range(count):
+        kind = index % 4
+        if kind == 0:
+            filters.append(f"room{index}/+/temperature")
+        elif kind == 1:
+            filters.append(f"room{index}/sensor{index}/+")
+        elif kind == 2:
+            filters.append(f"zigbee2mqtt/device{index}")
+        else:
+            filters.append(f"gateway{index}/#")
+    return filters
+
+def createTopics(filters, count):
+    random.seed(0)
+    topics = []
+    for _ in range(count):
+        filter_ = random.choice(filters)
+        topics.append(filter_.replace('+', 'x').replace('#', 'a/b'))
+    return topics
+
+def main():
+    print(f"{'rules':>8} {'linear [us/msg]':>16} {'trie [us/msg]':>14} {'speedup':>8}")
+
+    for count in RULE_COUNTS:
+        filters = createFilters(count)
+        topics = createTopics(filters, MESSAGES)
+
+        trie = topic.TopicTrie()
+        for filter_ in filters:
+            trie.add(filter_, filter_)
+
+        def linear():
+            for t in topics:
+                [f for f in filters if mqttClient.topic_matches_sub(f, t)]
+
+        def trieMatch():
+            for t in topics:
+                trie.match(t)
+
+        number = max(1, 1000 // count)
+        linearTime = min(timeit.repeat(linear, number=number, repeat=3)) / number / MESSAGES * 1e6
+        trieTime = min(timeit.repeat(trieMatch, number=number, repeat=3)) / number / MESSAGES * 1e6
+
+        print(f"{count:>8} {linearTime:>16.2f} {trieTime:>14.2f} {linearTime / trieTime:>7.0f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+# Measures the write throughput of an InfluxDB 2 output against a local stub
+# server with limited capacity: requests take 20 ms while at most 4 are
+# handled at once, beyond that they get slower and beyond 8 they fail with
+# 503. A fixed number of concurrent writes either wastes capacity or
+# overloads the server, the adaptive limit settles below the overload.
+
+import http.server
+import logging
+import threading
+import time
+
+from mqtt2influxdb import influxdb_
+
+BATCHES = 400
+POINTS = 100
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.active += 1
+            active = self.server.active
+        time.sleep(0.02 * max(1, active / 4))
+        with self.server.lock:
+            self.server.active -= 1
+
+        status = 503 if active > 8 else 204
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(http.server.ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.active = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+def measure(server, name, fixed=False, **kwargs):
+    db = influxdb_.Influxdb({'influxdb': {'version': 2, 'port': server.server_address[1], 'bucket': 'b', 'flush_interval': 60,
+                                          'retry_backoff': 0.05, 'latency_target': 0.05, 'pool_size': 16, **kwargs}})
+    if fixed:
+        # All writes in flight all the time, as without the adaptive limit
+        db._scheduler.limit = db._scheduler.maxConcurrency
+        db._scheduler._adjust = lambda success, retryAfter=None: None
+    db.connect()
+    points = [{'measurement': 'm', 'tags': {'sensor': f"s{index}"}, 'fields': {'value': 1.5}} for index in range(POINTS)]
+
+    start = time.perf_counter()
+    for _ in range(BATCHES):
+        db.write(points)
+        db._submitBatch()
+    db.flush()
+    duration = time.perf_counter() - start
+    db.disconnect()
+
+    summary = db.stats.summary()
+    print(f"{name:<24} {BATCHES / duration:>8.0f} batches/s   retries {db._scheduler.retried:>5}   "
+          f"failed {summary['failed_flushes']:>4}   limit {db._scheduler.limit:.1f}")
+
+def main():
+    # Retries and failed batches are counted instead of logged
+    logging.basicConfig(level=logging.CRITICAL)
+
+    server = StubServer()
+    for concurrency in (1, 4, 16):
+        measure(server, f"fixed {concurrency}", fixed=True, max_concurrency=concurrency)
+    for concurrency in (4, 16):
+        measure(server, f"adaptive max {concurrency}", max_concurrency=concurrency)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import collections
+import math
+import threading
+import time
+
+class Aggregator:
+    """
+        Aggregates the points of a rule over tumbling windows of a fixed number
+        of seconds, aligned to the epoch. The state of a series is one open
+        window with a few numbers per field. A window is written when a point
+        of the series falls into a later window, when collect() finds that it
+        has ended, or when the number of open windows exceeds maxSeries.
+    """
+
+    FUNCTIONS = ('mean', 'min', 'max', 'last', 'count')
+
+    def __init__(self, window, functions=('mean', ), maxSeries=10000):
+        if window <= 0:
+            raise ValueError(f"Invalid aggregation window '{window}'")
+
+        if isinstance(functions, str):
+            functions = (functions, )
+        for function in functions:
+            if function not in self.FUNCTIONS:
+                raise ValueError(f"Invalid aggregation function '{function}'")
+
+        self.window = window
+        self.functions = tuple(functions)
+        self.maxSeries = maxSeries
+        self.evicted = 0
+
+        self._lock = threading.Lock()
+        # Series key -> [window start, measurement, tags, {field: _FieldState}], oldest first
+        self._series = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._series)
+
+    def add(self, points, now=None):
+        """
+            Adds the points to their windows and returns the points of the
+            windows which were closed by them.
+        """
+        if now is None:
+            now = time.time()
+        windowStart = now - (now % self.window)
+        closed = []
+
+        with self._lock:
+            for point in points:
+                tags = point.get('tags') or {}
+                key = (point.get('measurement'), tuple(sorted(tags.items())))
+
+                series = self._series.get(key)
+                if (series is not None) and (series[0] != windowStart):
+                    closed.append(self._finish(series))
+                    series = None
+                    del self._series[key]
+
+                if series is None:
+                    if len(self._series) >= self.maxSeries:
+                        # Write the oldest open window early instead of growing without limit
+                        _, oldest = self._series.popitem(last=False)
+                        closed.append(self._finish(oldest))
+                        self.evicted += 1
+                    series = [windowStart, point.get('measurement'), tags, {}]
+                    self._series[key] = series
+
+                states = series[3]
+                for name, value in (point.get('fields') or {}).items():
+                    state = states.get(name)
+                    if state is None:
+                        state = _FieldState()
+                        states[name] = state
+                    state.add(value)
+
+        return closed
+
+    def collect(self, now=None):
+        """
+            Returns the points of all windows which have ended.
+        """
+        if now is None:
+            now = time.time()
+        windowStart = now - (now % self.window)
+
+        with self._lock:
+            expired = [key for key, series in self._series.items() if series[0] < windowStart]
+            return [self._finish(self._series.pop(key)) for key in expired]
+
+    def flush(self):
+        """
+            Returns the points of all open windows, e.g. on shutdown.
+        """
+        with self._lock:
+            series = list(self._series.values())
+            self._series.clear()
+        return [self._finish(s) for s in series]
+
+    def _finish(self, series):
+        windowStart, measurement, tags, states = series
+        fields = {}
+        for name, state in states.items():
+            if len(self.functions) == 1:
+                fields[name] = state.result(self.functions[0])
+            else:
+                for function in self.functions:
+                    fields[f"{name}_{function}"] = state.result(function)
+
+        point = {'tags': dict(tags), 'fields': fields, 'time': int(windowStart * 1e9)}
+        if measurement is not None:
+            point['measurement'] = measurement
+        return point
+
+class _FieldState:
+    __slots__ = ('count', 'sum', 'min', 'max', 'last', 'numeric')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.numeric = True
+
+    def add(self, value):
+        self.count += 1
+        self.last = value
+
+        # Strings and booleans can only be aggregated with last and count
+        if self.numeric and isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.sum += value
+            self.min = value if (self.min is None) or (value < self.min) else self.min
+            self.max = value if (self.max is None) or (value > self.max) else self.max
+        else:
+            self.numeric = False
+
+    def result(self, function):
+        if function == 'count':
+            return self.count
+        elif (function == 'last') or not self.numeric:
+            return self.last
+        elif function == 'mean':
+            return self.sum / self.count
+        elif function == 'min':
+            return self.min
+        else:
+            return self.max
+
+class Deadband:
+    """
+        Drops field values which did not change by more than threshold since
+        the value last written for the series. With maxInterval the value is
+        written again after that many seconds even if it did not change. The
+        state of series which were not seen for staleAfter seconds is removed
+        by collect(), at most maxSeries series are kept.
+    """
+
+    def __init__(self, threshold=0.0, maxInterval=None, maxSeries=10000, staleAfter=3600.0):
+        self.threshold = threshold
+        self.maxInterval = maxInterval
+        self.maxSeries = maxSeries
+        self.staleAfter = staleAfter
+        self.suppressed = 0
+
+        self._lock = threading.Lock()
+        # Series key -> (last seen, {field: (value, written at)}), least recently seen first
+        self._series = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._series)
+
+    def add(self, points, now=None):
+        """
+            Returns the points with unchanged fields removed, points without
+            any changed field are dropped.
+        """
+        if now is None:
+            now = time.time()
+        result = []
+
+        with self._lock:
+            for point in points:
+                tags = point.get('tags') or {}
+                key = (point.get('measurement'), tuple(sorted(tags.items())))
+
+                series = self._series.pop(key, None)
+                written = series[1] if series is not None else {}
+                fields = {}
+                for name, value in (point.get('fields') or {}).items():
+                    last = written.get(name)
+                    if (last is None) or self._changed(last[0], value) or \
+                            ((self.maxInterval is not None) and (now - last[1] >= self.maxInterval)):
+                        fields[name] = value
+                        written[name] = (value, now)
+                    else:
+                        self.suppressed += 1
+
+                if len(self._series) >= self.maxSeries:
+                    self._series.popitem(last=False)
+                self._series[key] = (now, written)
+
+                if len(fields) > 0:
+                    result.append({**point, 'fields': fields})
+
+        return result
+
+    def collect(self, now=None):
+        """
+            Removes the state of stale series, nothing is written.
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            while len(self._series) > 0:
+                key, (seen, _) = next(iter(self._series.items()))
+                if now - seen < self.staleAfter:
+                    break
+                del self._series[key]
+
+        return []
+
+    def flush(self):
+        return []
+
+    def _changed(self, last, value):
+        if isinstance(value, (int, float)) and isinstance(last, (int, float)) and \
+                not isinstance(value, bool) and not isinstance(last, bool):
+            return math.fabs(value - last) > self.threshold
+        return value != last
+
+def createStages(config, index):
+    """
+        Returns the aggregation stages configured for a rule, in the order
+        they are applied.
+    """
+    stages = []
+
+    aggregateConfig = config.get('aggregate', None)
+    if aggregateConfig is not None:
+        try:
+            stages.append(Aggregator(
+                aggregateConfig['window'],
+                aggregateConfig.get('functions', ('mean', )),
+                aggregateConfig.get('max_series', 10000),
+                ))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid 'aggregate' for rule #{index}: {e}") from e
+
+    deadbandConfig = config.get('deadband', None)
+    if (deadbandConfig is not None) and (deadbandConfig is not False):
+        if not isinstance(deadbandConfig, dict):
+            # deadband: True writes only changed values
+            deadbandConfig = {}
+        stages.append(Deadband(
+            deadbandConfig.get('threshold', 0.0),
+            deadbandConfig.get('max_interval', None),
+            deadbandConfig.get('max_series', 10000),
+            deadbandConfig.get('stale_after', 3600.0),
+            ))
+
+    return tuple(stages)
+
+def runStages(stages, points, now=None):
+    for stage in stages:
+        points = stage.add(points, now)
+    return points
+
+def collectStages(stages, now=None, flush=False):
+    """
+        Returns the points which are due for writing without a new message,
+        all pending points with flush.
+    """
+    points = []
+    for index, stage in enumerate(stages):
+        due = stage.flush() if flush else stage.collect(now)
+        # Points leaving a stage still pass the later stages
+        points += runStages(stages[index + 1:], due, now)
+    return points
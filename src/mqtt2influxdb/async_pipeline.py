@@ -0,0 +1,550 @@
+import asyncio
+import base64
+import logging
+import random
+import signal
+import socket
+import ssl
+import time
+import urllib.parse
+
+import paho.mqtt.client as mqttClient
+
+from . import configfile
+from . import influxdb_ as influxdb
+from . import metrics
+from . import mqtt
+from . import wal
+from .rule_handler import RuleHandler
+
+class AsyncMqtt(mqtt.Mqtt):
+    """
+        MQTT client driven by the asyncio event loop instead of a loop thread.
+        The socket of the paho client is registered with the event loop and
+        received messages are put into an asyncio.Queue.
+
+        The overflow policies of a queue_size are those of mqtt.IngestQueue,
+        except spill. With block, the socket is not read while the queue is
+        full, so the broker holds the messages back.
+    """
+
+    reconnectInterval = 1.0
+    maxReconnectInterval = 60.0
+
+    def __init__(self, config):
+        # Checked first, so the spill file is not created
+        self.overflow = config["mqtt"].get("overflow", "block")
+        if self.overflow == 'spill':
+            raise ValueError("Overflow policy 'spill' is not supported by the asyncio pipeline")
+        if self.overflow not in mqtt.IngestQueue.OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy '{self.overflow}'")
+
+        super().__init__(config)
+
+        if self.clients > 1:
+            raise ValueError("Multiple MQTT clients are not supported by the asyncio pipeline")
+
+        self.dropped = 0
+        self._queueSize = config["mqtt"].get("queue_size", 0)
+        self._socket = None
+        self._paused = False
+        self._loop = None
+        self._miscTask = None
+        self._stopping = False
+
+    def connect(self):
+        logging.info("Connecting to MQTT server " + self.address + ":" + str(self.port) + " ...")
+
+        self._loop = asyncio.get_running_loop()
+        # The queue size is enforced by the overflow policy
+        self._queue = asyncio.Queue()
+        self._stopping = False
+        metrics.queueDepth.setFunction(self._queue.qsize)
+
+        self._client = self._createClient(0)
+        self._clients = [self._client]
+
+        self._client.on_socket_open = self._mqtt_on_socket_open
+        self._client.on_socket_close = self._mqtt_on_socket_close
+        self._client.on_socket_register_write = self._mqtt_on_socket_register_write
+        self._client.on_socket_unregister_write = self._mqtt_on_socket_unregister_write
+        self._client.connect(self.address, self.port, 60)
+
+        self._miscTask = self._loop.create_task(self._miscLoop())
+
+    async def disconnect(self):
+        logging.info("Disconnecting from MQTT server ...")
+        self._stopping = True
+        self._client.disconnect()
+
+        if self._miscTask is not None:
+            self._miscTask.cancel()
+            self._miscTask = None
+
+        # Wake up the consumer, all messages queued before are still handled
+        await self._queue.put(None)
+
+        logging.info(f"Ingest queue: depth={self._queue.qsize()} dropped={self.dropped}")
+
+    def _mqtt_on_message(self, client, userdata, msg):
+        if metrics.enabled:
+            metrics.mqttMessages.inc()
+
+        topic = msg.topic
+        if not topic.startswith(self.prefix):
+            logging.error(f"Received message for topic '{topic}' does not contain prefix.")
+            return
+
+        if (self._queueSize > 0) and (self._queue.qsize() >= self._queueSize):
+            # The paho callback can't wait for space in the queue
+            if self.overflow == 'drop_newest':
+                self._drop()
+                return
+            # The None sentinel of disconnect() is never dropped
+            if (self.overflow == 'drop_oldest') and not self._stopping:
+                self._queue.get_nowait()
+                self._drop()
+
+        self._queue.put_nowait(mqtt.Message(topic[len(self.prefix):], msg.payload, msg.qos, msg.retain, time.time_ns(), msg.timestamp))
+
+        if (self.overflow == 'block') and (self._queueSize > 0) and (self._queue.qsize() >= self._queueSize):
+            self._pauseReading()
+
+    def resumeReading(self):
+        """
+            Called by the consumer after taking a message from the queue.
+        """
+        if self._paused and (self._queue.qsize() < self._queueSize):
+            self._paused = False
+            if self._socket is not None:
+                self._loop.add_reader(self._socket, self._client.loop_read)
+
+    def _pauseReading(self):
+        self._paused = True
+        if self._socket is not None:
+            self._loop.remove_reader(self._socket)
+
+    def _drop(self):
+        self.dropped += 1
+        if (self.dropped == 1) or (self.dropped % 10000 == 0):
+            logging.warning(f"Ingest queue is full, dropped {self.dropped} messages so far.")
+
+    def _mqtt_on_socket_open(self, client, userdata, sock):
+        self._socket = sock
+        if not self._paused:
+            self._loop.add_reader(sock, client.loop_read)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2048)
+
+    def _mqtt_on_socket_close(self, client, userdata, sock):
+        self._socket = None
+        self._loop.remove_reader(sock)
+
+    def _mqtt_on_socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _mqtt_on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    async def _miscLoop(self):
+        reconnectInterval = self.reconnectInterval
+        while not self._stopping:
+            if self._client.loop_misc() == mqttClient.MQTT_ERR_SUCCESS:
+                reconnectInterval = self.reconnectInterval
+                await asyncio.sleep(1)
+                continue
+
+            # Connection lost, reconnect with backoff
+            await asyncio.sleep(reconnectInterval)
+            reconnectInterval = min(reconnectInterval * 2, self.maxReconnectInterval)
+            try:
+                self._client.reconnect()
+            except OSError as e:
+                logging.warning(f"Could not reconnect to MQTT server: {e}")
+
+class AsyncInfluxdbWriter:
+    """
+        Non-blocking InfluxDB writer. Points are batched like in
+        influxdb_.Influxdb and each batch is sent as its own HTTP request over
+        a pool of keep-alive connections, with at most maxInFlight requests
+        at the same time. Like influxdb_.InfluxdbV2Backend, the connections
+        use TLS with ssl, at most poolSize idle connections are kept and
+        requests time out after timeout seconds.
+
+        Failed writes are retried like by influxdb_.Influxdb, with a buffer
+        they are appended to its write-ahead log instead, which is replayed
+        over the same connections.
+    """
+
+    maxInFlight = 4
+    timeout = 10.0
+
+    def __init__(self, config, influxdbConfig=None):
+        if influxdbConfig is None:
+            influxdbConfig = config.get("influxdb", None)
+
+        if influxdbConfig is None:
+            raise ValueError("No configuration section for InfluxDB")
+
+        self.name = influxdbConfig.get("name", influxdb.Influxdb.name)
+        self.version = influxdbConfig.get("version", 1)
+        self.username = influxdbConfig.get("username", "")
+        self.password = influxdbConfig.get("password", "")
+        self.address = influxdbConfig.get("address", "localhost")
+        self.port = influxdbConfig.get("port", 8086)
+        self.database = influxdbConfig.get("database", None)
+        self.batchSize = influxdbConfig.get("batch_size", influxdb.Influxdb.batchSize)
+        self.batchBytes = influxdbConfig.get("batch_bytes", influxdb.Influxdb.batchBytes)
+        self.flushInterval = influxdbConfig.get("flush_interval", influxdb.Influxdb.flushInterval)
+        self.maxInFlight = influxdbConfig.get("max_in_flight", AsyncInfluxdbWriter.maxInFlight)
+        self.poolSize = influxdbConfig.get("pool_size", self.maxInFlight)
+        self.timeout = influxdbConfig.get("timeout", AsyncInfluxdbWriter.timeout)
+        self.ssl = bool(influxdbConfig.get("ssl", False))
+        self.retryBackoff = influxdbConfig.get("retry_backoff", influxdb.Influxdb.retryBackoff)
+        self.maxRetryBackoff = influxdbConfig.get("max_retry_backoff", influxdb.Influxdb.maxRetryBackoff)
+        self.compressLevel = influxdbConfig.get("gzip", None)
+        if self.compressLevel is True:
+            self.compressLevel = 6
+        elif self.compressLevel is False:
+            self.compressLevel = None
+
+        self.stats = influxdb.BatchStats()
+        self.retried = 0
+
+        # With a write-ahead log, failed batches are logged and replayed instead of retried
+        self._wal = influxdb.createWriteAheadLog(influxdbConfig, self._replayLines)
+        self.retries = influxdbConfig.get("retries", influxdb.Influxdb.retries if self._wal is None else 0)
+
+        self._encoder = influxdb.LineProtocolEncoder(precision=influxdbConfig.get("precision", None))
+        self._batch = []
+        self._batchBytes = 0
+        self._flushHandle = None
+        self._inFlight = None
+        self._loop = None
+        self._connections = []
+        self._tasks = set()
+        # The certificate and host name of the server are verified
+        self._sslContext = ssl.create_default_context() if self.ssl else None
+
+        self._metricLabels = (self.name, )
+        metrics.influxdbWriteRetries.setFunction(lambda: self.retried, labels=self._metricLabels)
+        self._headers = f"Host: {self.address}:{self.port}\r\nContent-Type: application/octet-stream\r\n"
+
+        if self.version == 2:
+            # Same parameters as influxdb_.InfluxdbV2Backend
+            params = {'bucket': influxdbConfig.get("bucket", self.database)}
+            if influxdbConfig.get("org", None) is not None:
+                params['org'] = influxdbConfig["org"]
+            if self._encoder.precision is not None:
+                params['precision'] = self._encoder.precision
+            self._path = "/api/v2/write?" + urllib.parse.urlencode(params)
+            if influxdbConfig.get("token", None) is not None:
+                self._headers += f"Authorization: Token {influxdbConfig['token']}\r\n"
+        elif self.version == 1:
+            params = {'db': self.database}
+            if self._encoder.precisionParameter is not None:
+                params['precision'] = self._encoder.precisionParameter
+            self._path = "/write?" + urllib.parse.urlencode(params)
+            if self.username != "":
+                credentials = base64.b64encode(f"{self.username}:{self.password}".encode('utf-8')).decode('ascii')
+                self._headers += f"Authorization: Basic {credentials}\r\n"
+        else:
+            raise ValueError(f"Invalid InfluxDB version '{self.version}' for output '{self.name}'")
+
+        if self.compressLevel is not None:
+            self._headers += "Content-Encoding: gzip\r\n"
+
+    def connect(self):
+        scheme = "https" if self.ssl else "http"
+        logging.info(f"Using InfluxDB server {scheme}://{self.address}:{self.port} for output '{self.name}' "
+                     f"with up to {self.maxInFlight} concurrent writes")
+        self._inFlight = asyncio.Semaphore(self.maxInFlight)
+        self._loop = asyncio.get_running_loop()
+
+        if self._wal is not None:
+            self._wal.start()
+
+    def write(self, message):
+        lines = [self._encoder.encode(point) for point in message]
+
+        self._batch += lines
+        self._batchBytes += sum(len(line) + 1 for line in lines)
+
+        if (len(self._batch) >= self.batchSize) or (self._batchBytes >= self.batchBytes):
+            self.flush()
+        elif self._flushHandle is None:
+            self._flushHandle = asyncio.get_running_loop().call_later(self.flushInterval, self.flush)
+
+    def flush(self):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+
+        if len(self._batch) == 0:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._send(self._batch, self._batchBytes))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        self._batch = []
+        self._batchBytes = 0
+
+    async def drain(self):
+        # Backpressure: don't queue more batches than can be in flight twice
+        while len(self._tasks) >= 2 * self.maxInFlight:
+            await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+
+    async def disconnect(self):
+        self.flush()
+        if len(self._tasks) > 0:
+            await asyncio.wait(self._tasks)
+
+        logging.info(f"InfluxDB batch statistics of '{self.name}': %r" % self.stats.summary())
+
+        if self._wal is not None:
+            # The replay thread writes over the event loop, which must keep running until it stopped
+            await asyncio.to_thread(self._wal.stop)
+            logging.info(f"Write-ahead log of '{self.name}': appended={self._wal.appendedBatches} "
+                         f"replayed={self._wal.replayedBatches} pending segments={len(self._wal)}")
+
+        for _, writer in self._connections:
+            writer.close()
+        self._connections = []
+
+    async def _send(self, lines, bytes_):
+        async with self._inFlight:
+            start = time.perf_counter()
+            error = None
+            try:
+                if (self._wal is not None) and not self._wal.empty:
+                    # Keep the order while older batches are replayed
+                    await asyncio.to_thread(self._wal.append, lines)
+                else:
+                    await self._writeLines(lines, self.retries)
+            except wal.DiscardBatch as e:
+                error = e
+                logging.error(f'Could not write batch of {len(lines)} points to db: {e}')
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, influxdb.WriteError) as e:
+                error = e
+                if self._wal is not None:
+                    logging.warning(f'Could not write batch of {len(lines)} points to db, appending to write-ahead log: '
+                                    f'{type(e).__name__}: {e}')
+                    await asyncio.to_thread(self._wal.append, lines)
+                else:
+                    logging.error(f'Could not write batch of {len(lines)} points to db: {type(e).__name__}: {e}')
+            finally:
+                latency = time.perf_counter() - start
+                success = error is None
+                self.stats.observe(len(lines), bytes_, latency, success)
+                if metrics.enabled:
+                    metrics.influxdbWrite.observe(latency, labels=self._metricLabels)
+                    metrics.influxdbBatchSize.observe(len(lines), labels=self._metricLabels)
+                    if not success:
+                        metrics.influxdbWriteErrors.inc(labels=self._metricLabels)
+
+    async def _writeLines(self, lines, retries=0):
+        """
+            Writes the lines, failed writes are retried up to retries times
+            after a backoff like by write_scheduler.WriteScheduler.
+        """
+        body = self._encoder.encodeBody(lines, self.compressLevel)
+        attempt = 0
+        while True:
+            try:
+                status, headers, response = await asyncio.wait_for(self._post(body), self.timeout)
+                influxdb.checkResponse(status, response, headers.get('retry-after'))
+                return
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, influxdb.WriteError) as e:
+                if attempt >= retries:
+                    raise
+
+                delay = random.uniform(0, min(self.maxRetryBackoff, self.retryBackoff * 2**attempt))
+                retryAfter = getattr(e, 'retryAfter', None)
+                if retryAfter is not None:
+                    delay = max(delay, min(retryAfter, self.maxRetryBackoff))
+                attempt += 1
+                self.retried += 1
+                logging.warning(f"Write to '{self.name}' failed, retry {attempt}/{retries} in {delay:.2f} s: {type(e).__name__}: {e}")
+                await asyncio.sleep(delay)
+
+    def _replayLines(self, lines):
+        # Called by the replay thread of the write-ahead log
+        asyncio.run_coroutine_threadsafe(self._writeLines(lines), self._loop).result()
+
+    async def _post(self, body):
+        request = (f"POST {self._path} HTTP/1.1\r\n{self._headers}Content-Length: {len(body)}\r\n\r\n").encode('ascii') + body
+
+        # A pooled connection may have been closed by the server, retry once with a new one
+        for attempt in range(2):
+            reused = len(self._connections) > 0
+            if reused:
+                reader, writer = self._connections.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.address, self.port, ssl=self._sslContext)
+
+            # The connection is closed unless it goes back to the pool, also when
+            # the request is cancelled by its timeout
+            pooled = False
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, headers, response = await self._readResponse(reader)
+            except (OSError, asyncio.IncompleteReadError):
+                if reused and attempt == 0:
+                    continue
+                raise
+            else:
+                if (headers.get('connection', '').lower() != 'close') and (len(self._connections) < self.poolSize):
+                    self._connections.append((reader, writer))
+                    pooled = True
+                return status, headers, response
+            finally:
+                if not pooled:
+                    writer.close()
+
+    async def _readResponse(self, reader):
+        statusLine = await reader.readuntil(b"\r\n")
+        status = int(statusLine.split()[1])
+
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            response = b""
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                response += chunk[:-2]
+        else:
+            response = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        return status, headers, response
+
+class AsyncOutputs(influxdb.Outputs):
+    """
+        Writes the points to several AsyncInfluxdbWriters.
+    """
+
+    async def drain(self):
+        for output in self.outputs:
+            await output.drain()
+
+    async def disconnect(self):
+        for output in self.outputs:
+            await output.disconnect()
+
+async def run(config, filename=None, watch=False, cacheDirectory=None):
+    loop = asyncio.get_running_loop()
+    stopEvent = asyncio.Event()
+    for signalNumber in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signalNumber, stopEvent.set)
+
+    metrics.start(config)
+
+    m = AsyncMqtt(config)
+    m.connect()
+
+    db = influxdb.createOutput(config, AsyncInfluxdbWriter, AsyncOutputs)
+    db.connect()
+
+    # Rules are evaluated on the event loop
+    rh = RuleHandler(config, m, db, workers=False)
+    consumer = loop.create_task(_consume(m, rh, db))
+    collector = loop.create_task(_collectStages(rh))
+
+    reloader = None
+    if filename is not None:
+        reloadEvent = asyncio.Event()
+        loop.add_signal_handler(signal.SIGHUP, reloadEvent.set)
+        reloader = loop.create_task(_reloadLoop(filename, config, rh, reloadEvent, watch, cacheDirectory))
+
+    try:
+        await stopEvent.wait()
+    finally:
+        logging.info("Shutting down...")
+
+        # Stop receiving, handle all queued messages and write remaining points
+        await m.disconnect()
+        await consumer
+        collector.cancel()
+        if reloader is not None:
+            reloader.cancel()
+        rh.finish()
+        await db.disconnect()
+        metrics.stop()
+
+async def _reloadLoop(filename, config, rh, reloadEvent, watch, cacheDirectory):
+    """
+        Reloads the rules on SIGHUP and, with watch, when the file changes.
+    """
+    modified = configfile.modificationTime(filename)
+    while True:
+        try:
+            await asyncio.wait_for(reloadEvent.wait(), 2 if watch else None)
+        except asyncio.TimeoutError:
+            pass
+
+        if reloadEvent.is_set():
+            reloadEvent.clear()
+            config = await _reload(filename, config, rh, cacheDirectory)
+
+        if watch and (configfile.modificationTime(filename) != modified):
+            modified = configfile.modificationTime(filename)
+            reloadEvent.set()
+
+async def _reload(filename, config, rh, cacheDirectory=None):
+    """
+        Like mqtt2influxdb.reloadConfig(), returns the new configuration or
+        the old one if the file is invalid.
+    """
+    logging.info(f"Reloading rules from {filename} ...")
+    try:
+        # Rules are compiled in a thread, so the event loop keeps handling messages
+        newConfig = await asyncio.to_thread(configfile.load, filename, cacheDirectory)
+        ruleSet = await asyncio.to_thread(rh.compileRules, newConfig)
+    except Exception as e:
+        logging.error(f"Could not reload config file, keeping the current rules: {type(e).__name__}: {e}")
+        return config
+
+    # Subscriptions are changed on the event loop, which owns the MQTT client
+    rh.swapRules(ruleSet)
+    configfile.warnRestartSections(config, newConfig)
+
+    return newConfig
+
+async def _collectStages(rh):
+    while True:
+        await asyncio.sleep(1.0)
+        try:
+            rh.collectStages()
+        except Exception as e:
+            logging.error(f'Error while collecting aggregated points: {type(e).__name__}: {e}')
+
+async def _consume(m, rh, db):
+    logging.info("Starting Queue handler ...")
+    queue_ = m.getQueue()
+    handled = 0
+    while True:
+        msg = await queue_.get()
+        if msg is None:
+            break
+        m.resumeReading()
+
+        try:
+            rh.handleMessage(msg)
+        except Exception as e:
+            logging.error(f'Error while sending from mqtt to db: {type(e).__name__}: {e}')
+
+        await db.drain()
+
+        # get() does not yield while messages are queued, give the socket readers a chance
+        handled += 1
+        if handled % 100 == 0:
+            await asyncio.sleep(0)
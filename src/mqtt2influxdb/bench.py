@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+"""
+    Offline benchmark which feeds recorded or generated MQTT traffic through
+    RuleHandler, without MQTT or InfluxDB servers.
+
+    Capture files contain one JSON object per line:
+        {"timestamp": 1700000000.0, "topic": "home/kitchen/sensor1/temperature", "payload": "21.5", "retain": false}
+    Binary payloads are stored base64 encoded in "payload_base64" instead.
+"""
+
+import argparse
+import base64
+import cProfile
+import json
+import logging
+import random
+import resource
+import sys
+import time
+
+
+from . import configfile
+from . import influxdb_ as influxdb
+from . import mqtt
+from .rule_handler import RuleHandler
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parseArgs(argv)
+
+    logging.basicConfig(format="%(asctime)s %(levelname)-6s %(message)s",
+                        level=max(3 - args.verbose_count, 0) * 10)
+
+    config = configfile.load(args.conf_file)
+
+    if args.replay is not None:
+        messages = readCapture(args.replay)
+    else:
+        messages = GENERATORS[args.generate](args.messages, random.Random(args.seed))
+
+    if args.record is not None:
+        writeCapture(args.record, messages)
+
+    report = run(config, messages, encode=args.encode, profile=args.profile)
+    printReport(report)
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(
+        description="Feeds recorded or generated MQTT traffic through the rules of a configuration and reports the throughput.",
+        add_help=True
+        )
+
+    parser.add_argument("-c", "--conf_file",
+                        help="Specify config file", metavar="FILE", required = True)
+
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("-r", "--replay",
+                        help="Replay messages of a capture file", metavar="FILE")
+    source.add_argument("-g", "--generate",
+                        help="Generate synthetic traffic (default: mixed)", choices=sorted(GENERATORS), default="mixed")
+
+    parser.add_argument("-n", "--messages",
+                        help="Number of generated messages (default: 100000)", type=int, default=100000)
+
+    parser.add_argument("-s", "--seed",
+                        help="Seed of the traffic generator", type=int, default=0)
+
+    parser.add_argument("-w", "--record",
+                        help="Write the messages to a capture file", metavar="FILE")
+
+    parser.add_argument("-e", "--encode",
+                        help="Encode points to line protocol like the InfluxDB writer", action='store_true')
+
+    parser.add_argument("-p", "--profile",
+                        help="Write cProfile statistics of the run to a file", metavar="FILE")
+
+    parser.add_argument("-v", "--verbose",
+                        help="Increases log verbosity for each occurence", dest="verbose_count", action="count", default=0)
+
+    return parser.parse_args(argv)
+
+class StubMqtt:
+    def __init__(self):
+        self.topics = []
+
+    def getQueue(self):
+        return None
+
+    def subscribe(self, topics):
+        self.topics += topics
+
+class StubInfluxdb:
+    def __init__(self, encode=False):
+        self.points = 0
+        self.bytes = 0
+        self._encoder = influxdb.LineProtocolEncoder() if encode else None
+
+    def write(self, message):
+        self.points += len(message)
+        if self._encoder is not None:
+            for point in message:
+                self.bytes += len(self._encoder.encode(point)) + 1
+
+def createMessage(topic, payload, retain=False, received=None):
+    return mqtt.Message(topic, payload, retain=retain, received=received)
+
+def readCapture(filename):
+    messages = []
+    with open(filename, "r") as file:
+        for number, line in enumerate(file, 1):
+            if line.strip() == "":
+                continue
+
+            try:
+                record = json.loads(line)
+                if 'payload_base64' in record:
+                    payload = base64.b64decode(record['payload_base64'])
+                else:
+                    payload = record['payload'].encode('utf-8')
+                received = int(record['timestamp'] * 1e9) if 'timestamp' in record else None
+                messages.append(createMessage(record['topic'], payload, bool(record.get('retain', False)), received))
+            except (ValueError, KeyError) as e:
+                raise ValueError(f"Invalid message in line {number} of capture file '{filename}': {e}") from e
+
+    return messages
+
+def writeCapture(filename, messages):
+    with open(filename, "w") as file:
+        for msg in messages:
+            record = {'timestamp': msg.received / 1e9, 'topic': msg.topic, 'retain': bool(msg.retain)}
+            try:
+                record['payload'] = msg.payload.decode('utf-8')
+            except UnicodeDecodeError:
+                record['payload_base64'] = base64.b64encode(msg.payload).decode('ascii')
+            file.write(json.dumps(record) + "\n")
+
+def run(config, messages, encode=False, profile=None):
+    mqtt = StubMqtt()
+    db = StubInfluxdb(encode)
+    rh = RuleHandler(config, mqtt, db, workers=False)
+
+    # Captures contain the full topics, the rules are relative to the prefix
+    prefix = (config.get("mqtt", None) or {}).get("prefix", "")
+    if prefix != "":
+        prefix += "/"
+        for msg in messages:
+            if msg.topic.startswith(prefix):
+                msg.topic = msg.topic[len(prefix):]
+
+    latencies = []
+    errors = 0
+    profiler = cProfile.Profile() if profile is not None else None
+
+    if profiler is not None:
+        profiler.enable()
+
+    start = time.perf_counter()
+    for msg in messages:
+        messageStart = time.perf_counter()
+        try:
+            rh.handleMessage(msg)
+        except Exception as e:
+            errors += 1
+            logging.debug(f'Error while handling message: {type(e).__name__}: {e}')
+        latencies.append(time.perf_counter() - messageStart)
+    duration = time.perf_counter() - start
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile)
+
+    rh.finish()
+
+    latencies.sort()
+    return {
+        'messages': len(messages),
+        'points': db.points,
+        'bytes': db.bytes,
+        'errors': errors,
+        'duration': duration,
+        'messages_per_second': len(messages) / duration if duration > 0 else 0.0,
+        'points_per_second': db.points / duration if duration > 0 else 0.0,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p99': percentile(latencies, 0.99),
+        'topic_cache': rh.topicCacheInfo(),
+        # ru_maxrss is in KiB on Linux
+        'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+def percentile(sortedValues, fraction):
+    if len(sortedValues) == 0:
+        return 0.0
+    return sortedValues[min(len(sortedValues) - 1, int(fraction * len(sortedValues)))]
+
+def printReport(report):
+    print(f"messages:    {report['messages']} in {report['duration']:.2f} s ({report['errors']} errors)")
+    print(f"throughput:  {report['messages_per_second']:.0f} msgs/s, {report['points_per_second']:.0f} points/s")
+    print(f"latency:     p50 {report['latency_p50'] * 1e6:.1f} us, p99 {report['latency_p99'] * 1e6:.1f} us")
+    if report['bytes'] > 0:
+        print(f"encoded:     {report['bytes'] / 1024:.0f} KiB line protocol")
+    print(f"topic cache: {report['topic_cache']['hit_rate'] * 100:.1f}% hits")
+    print(f"peak memory: {report['peak_memory'] / 1024 / 1024:.1f} MiB")
+
+# Synthetic traffic
+
+ROOMS = ['livingroom', 'kitchen', 'bedroom', 'bathroom', 'office', 'garage', 'hallway', 'attic']
+
+def generateSensors(count, random_):
+    """
+        Plain text readings on room/sensor/quantity topics.
+    """
+    quantities = {'temperature': (15, 30), 'humidity': (30, 80), 'pressure': (980, 1040)}
+    messages = []
+    for _ in range(count):
+        quantity = random_.choice(list(quantities))
+        topic = f"{random_.choice(ROOMS)}/environment-sensor/{quantity}"
+        messages.append(createMessage(topic, f"{random_.uniform(*quantities[quantity]):.2f}".encode('utf-8')))
+    return messages
+
+def generateZigbee(count, random_):
+    """
+        zigbee2mqtt style JSON documents of 200 devices, with some retained
+        availability messages.
+    """
+    devices = []
+    for index in range(200):
+        kind = random_.choice(['plug', 'climate', 'motion', 'light'])
+        devices.append(f"{random_.choice(ROOMS)}_{kind}_{index}")
+    messages = []
+    for _ in range(count):
+        device = random_.choice(devices)
+        if random_.random() < 0.05:
+            messages.append(createMessage(f"zigbee2mqtt/{device}/availability", random_.choice([b'online', b'offline']), retain=True))
+            continue
+
+        document = {'linkquality': random_.randrange(255), 'battery': random_.randrange(100), 'voltage': random_.randrange(2800, 3100)}
+        if 'climate' in device:
+            document.update({'temperature': round(random_.uniform(15, 30), 2), 'humidity': round(random_.uniform(30, 80), 1)})
+        elif 'plug' in device:
+            document.update({
+                'state': random_.choice(['ON', 'OFF']),
+                'power': round(random_.uniform(0, 2000), 1),
+                'energy': round(random_.uniform(0, 500), 2),
+                })
+        elif 'motion' in device:
+            document.update({'occupancy': random_.random() < 0.2, 'illuminance': random_.randrange(1000)})
+        else:
+            document.update({
+                'state': random_.choice(['ON', 'OFF']),
+                'brightness': random_.randrange(255),
+                'color_temp': random_.randrange(150, 500),
+                })
+        messages.append(createMessage(f"zigbee2mqtt/{device}", json.dumps(document).encode('utf-8')))
+    return messages
+
+def generateMixed(count, random_):
+    sensors = generateSensors(count // 2, random_)
+    zigbee = generateZigbee(count - len(sensors), random_)
+    messages = sensors + zigbee
+    random_.shuffle(messages)
+    return messages
+
+GENERATORS = {
+    'sensors': generateSensors,
+    'zigbee': generateZigbee,
+    'mixed': generateMixed,
+}
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import itertools
+import operator
+import sys
+
+from . import converters
+from . import payload
+
+def _toBool(value):
+    # Strings like "off" are parsed as in payload fields, bool("off") would be True
+    if isinstance(value, str):
+        return converters.toBool(value)
+    return bool(value)
+
+def _toInt(value):
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError(f"Invalid integer {value!r}")
+    return int(value)
+
+class BulkPayload:
+    """
+        Maps a JSON payload with many readings to one point per reading. The
+        readings are either an array of objects, or an object of equally long
+        arrays (columns), e.g. from a gateway:
+
+            [{"id": "s1", "t": 21.5}, {"id": "s2", "t": 19.0}]
+            {"id": ["s1", "s2"], "t": [21.5, 19.0]}
+
+        tags and fields map tag and field names to keys of the readings. Tags,
+        fields and the measurement of the rule are added to every point.
+    """
+
+    _CASTS = {
+        None: None,
+        'float': float,
+        'int': _toInt,
+        'bool': _toBool,
+        'string': str,
+    }
+
+    def __init__(self, fields, tags=None, path=None, measurement=None, time=None, multiplier=10**9):
+        if len(fields) == 0:
+            raise ValueError("No fields")
+
+        self.path = payload.JsonPath(path) if path is not None else None
+        # (name, key, cast) of all fields, names of tags and fields are shared by all points
+        self._fields = tuple(self._compileField(name, field) for name, field in fields.items())
+        self._tags = tuple((sys.intern(str(name)), key) for name, key in (tags or {}).items())
+        self._measurementKey = measurement
+        self._timeKey = time
+        self._multiplier = multiplier
+        keys = [key for _, key, _ in self._fields] + [key for _, key in self._tags] + [measurement, time]
+        self._keys = tuple(key for key in keys if key is not None)
+        self._getKeys = operator.itemgetter(*self._keys) if len(self._keys) > 1 else lambda reading: (reading[self._keys[0]], )
+        self._fieldNames = tuple(name for name, _, _ in self._fields)
+        self._tagNames = tuple(name for name, _ in self._tags)
+
+    def _compileField(self, name, field):
+        if isinstance(field, dict):
+            if field.get('type', None) not in self._CASTS:
+                raise ValueError(f"Invalid type '{field['type']}' of field '{name}'")
+            return (sys.intern(str(name)), field['key'], self._CASTS[field.get('type', None)])
+        return (sys.intern(str(name)), field, None)
+
+    def points(self, document, base):
+        """
+            Returns the points of the readings in the document. base is the
+            insert built by the rule for the whole message.
+        """
+        readings = self.path(document) if self.path is not None else document
+
+        # Readings are turned into columns, which are converted with one map() each
+        if isinstance(readings, list):
+            readings = [reading for reading in readings if isinstance(reading, dict)]
+            length = len(readings)
+            try:
+                # Usually all readings have all keys, then they are transposed in one go
+                columns = dict(zip(self._keys, zip(*map(self._getKeys, readings))))
+            except KeyError:
+                columns = {}
+            def column(key):
+                values = columns.get(key)
+                return list(values) if values is not None else list(map(dict.get, readings, itertools.repeat(key)))
+        elif isinstance(readings, dict):
+            length = max((len(values) for values in readings.values() if isinstance(values, list)), default=0)
+            def column(key):
+                values = readings.get(key)
+                return values if isinstance(values, list) else [None] * length
+        else:
+            raise TypeError(f"Bulk payload must be an array or an object of arrays, not {type(readings).__name__}")
+
+        if length == 0:
+            return []
+
+        measurements = _castColumn(column(self._measurementKey), str) if self._measurementKey is not None else None
+        times = self._timeColumn(column(self._timeKey)) if self._timeKey is not None else None
+
+        return self._buildPoints(
+            base, length, measurements, times,
+            [_castColumn(column(key), cast) for _, key, cast in self._fields],
+            [_castColumn(column(key), str) for _, key in self._tags],
+            )
+
+    def _buildPoints(self, base, length, measurements, times, fieldColumns, tagColumns):
+        # The dicts of all points are filled column by column, which is several
+        # times faster than building the dicts of each point from its values
+        fields = [base['fields'].copy() for _ in range(length)]
+        for name, values in zip(self._fieldNames, fieldColumns):
+            _setColumn(fields, name, values)
+
+        tags = [base['tags'].copy() for _ in range(length)]
+        for name, values in zip(self._tagNames, tagColumns):
+            _setColumn(tags, name, values)
+
+        baseMeasurement = base.get('measurement')
+        if measurements is None:
+            measurements = [baseMeasurement] * length
+        elif None in measurements:
+            measurements = [measurement if measurement is not None else baseMeasurement for measurement in measurements]
+
+        if (times is not None) and (None not in times) and (None not in measurements):
+            # Usually every point has a measurement and a time
+            points = [
+                {'tags': tags_, 'fields': fields_, 'measurement': measurement, 'time': time_}
+                for tags_, fields_, measurement, time_ in zip(tags, fields, measurements, times)
+                ]
+        else:
+            points = []
+            for tags_, fields_, measurement, time_ in zip(tags, fields, measurements, times or itertools.repeat(None)):
+                point = {'tags': tags_, 'fields': fields_}
+                if measurement is not None:
+                    point['measurement'] = measurement
+                if time_ is not None:
+                    point['time'] = time_
+                points.append(point)
+
+        if any(None in values for values in fieldColumns):
+            # Readings without any of the fields are skipped
+            present = [any(value is not None for value in values) for values in zip(*fieldColumns)]
+            points = list(itertools.compress(points, present))
+        return points
+
+    def _timeColumn(self, values):
+        multiplier = self._multiplier
+        if set(map(type, values)) == {int}:
+            return list(map(operator.mul, values, itertools.repeat(multiplier)))
+        return [
+            (int(value * multiplier) if isinstance(value, float) else value * multiplier)
+            if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+            for value in values
+            ]
+
+def _setColumn(dicts, name, values):
+    if None in values:
+        for dict_, value in zip(dicts, values):
+            if value is not None:
+                dict_[name] = value
+    else:
+        for dict_, value in zip(dicts, values):
+            dict_[name] = value
+
+def _castColumn(values, cast):
+    if cast is None:
+        return values
+    if None in values:
+        return [cast(value) if value is not None else None for value in values]
+    return list(map(cast, values))
+
+def createBulk(config, index, timeUnits):
+    bulkConfig = config.get('bulk', None)
+    if bulkConfig is None:
+        return None
+
+    try:
+        unit = bulkConfig.get('unit', 's')
+        if unit not in timeUnits:
+            raise ValueError(f"Invalid timestamp unit '{unit}'")
+
+        return BulkPayload(
+            bulkConfig['fields'],
+            bulkConfig.get('tags', None),
+            bulkConfig.get('json', None),
+            bulkConfig.get('measurement', None),
+            bulkConfig.get('time', None),
+            timeUnits[unit],
+            )
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid 'bulk' for rule #{index}: {e}") from e
@@ -0,0 +1,93 @@
+import logging
+import sys
+import threading
+
+class SeriesGuard:
+    """
+        Tracks the distinct series written by a rule and limits their number.
+        When a point would start a new series beyond maxSeries, the action
+        decides what happens:
+
+        drop:  the point is dropped
+        other: the values of the guarded tags are replaced by otherValue
+        alert: the point is written and a warning is logged
+    """
+
+    ACTIONS = ('drop', 'other', 'alert')
+
+    def __init__(self, maxSeries, action='drop', otherValue='other', tags=None, name=None):
+        if action not in self.ACTIONS:
+            raise ValueError(f"Invalid cardinality action '{action}'")
+
+        self.maxSeries = maxSeries
+        self.action = action
+        self.otherValue = sys.intern(str(otherValue))
+        self.tags = frozenset(tags) if tags is not None else None
+        self.name = name
+        self.limited = 0
+
+        self._lock = threading.Lock()
+        self._series = set()
+
+    def __len__(self):
+        return len(self._series)
+
+    def add(self, points, now=None):
+        result = []
+
+        with self._lock:
+            for point in points:
+                tags = point.get('tags') or {}
+                key = (point.get('measurement'), tuple(sorted(tags.items())))
+
+                if key in self._series:
+                    result.append(point)
+                    continue
+
+                if len(self._series) < self.maxSeries:
+                    self._series.add(key)
+                    result.append(point)
+                    continue
+
+                self.limited += 1
+                if (self.limited == 1) or (self.limited % 10000 == 0):
+                    logging.warning(f"Rule '{self.name}' reached its limit of {self.maxSeries} series, "
+                                    f"{self.limited} points over the limit so far (action: {self.action})")
+
+                if self.action == 'alert':
+                    result.append(point)
+                elif self.action == 'other':
+                    tags = {
+                        name: (self.otherValue if (self.tags is None) or (name in self.tags) else value)
+                        for name, value in tags.items()
+                        }
+                    # The buckets are tracked as well, there are few of them
+                    self._series.add((point.get('measurement'), tuple(sorted(tags.items()))))
+                    result.append({**point, 'tags': tags})
+
+        return result
+
+    def collect(self, now=None):
+        return []
+
+    def flush(self):
+        return []
+
+    def info(self):
+        return {'series': len(self._series), 'max_series': self.maxSeries, 'limited': self.limited}
+
+def createGuard(config, index):
+    cardinalityConfig = config.get('cardinality', None)
+    if cardinalityConfig is None:
+        return None
+
+    try:
+        return SeriesGuard(
+            cardinalityConfig['max_series'],
+            cardinalityConfig.get('action', 'drop'),
+            cardinalityConfig.get('other_value', 'other'),
+            cardinalityConfig.get('tags', None),
+            config.get('topic', f"#{index}"),
+            )
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid 'cardinality' for rule #{index}: {e}") from e
@@ -0,0 +1,74 @@
+import hashlib
+import logging
+import os
+import pathlib
+import pickle
+
+import yaml
+
+# libyaml parses large configurations several times faster than the pure
+# Python loader, which is used if PyYAML was built without it
+_Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Sections and settings which are only read at startup, a reload can't apply their changes
+RESTART_SECTIONS = ("mqtt", "influxdb", "outputs", "metrics", "workers", "retain_cache_size")
+
+def load(filename, cacheDirectory=None):
+    """
+        Loads a YAML config file. With a cache directory the parsed config is
+        stored there, keyed by the SHA-256 of the file, and read from there
+        until the file changes. The cache directory must be trusted like the
+        config file itself, the cache is a pickle.
+    """
+    with open(filename, 'rb') as file:
+        data = file.read()
+
+    if cacheDirectory is None:
+        return yaml.load(data, Loader=_Loader)
+
+    cacheFile = pathlib.Path(cacheDirectory) / f"config-{hashlib.sha256(data).hexdigest()}.pickle"
+    try:
+        with open(cacheFile, 'rb') as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f"Could not read cached config {cacheFile}, parsing {filename}: {type(e).__name__}: {e}")
+
+    config = yaml.load(data, Loader=_Loader)
+
+    try:
+        _writeCache(cacheFile, config)
+    except OSError as e:
+        logging.warning(f"Could not write cached config {cacheFile}: {e}")
+
+    return config
+
+def _writeCache(cacheFile, config):
+    cacheFile.parent.mkdir(parents=True, exist_ok=True)
+
+    # Written under a temporary name, so other processes never read a partial file
+    temporaryFile = cacheFile.with_suffix(f".{os.getpid()}.tmp")
+    with open(temporaryFile, 'wb') as file:
+        pickle.dump(config, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporaryFile, cacheFile)
+
+    # Only the cache of the current version of the file is kept
+    for oldFile in cacheFile.parent.glob("config-*.pickle"):
+        if oldFile != cacheFile:
+            oldFile.unlink(missing_ok=True)
+
+def warnRestartSections(oldConfig, newConfig):
+    """
+        Logs a warning for every changed section or setting which needs a
+        restart.
+    """
+    for section in RESTART_SECTIONS:
+        if newConfig.get(section, None) != oldConfig.get(section, None):
+            logging.warning(f"Changes of '{section}' need a restart")
+
+def modificationTime(filename):
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
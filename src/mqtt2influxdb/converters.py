@@ -0,0 +1,124 @@
+import collections
+import logging
+import math
+import threading
+
+# Returned by converters for values which must not be written
+SKIP = object()
+
+_TRUE = frozenset(('true', '1', 'on', 'yes'))
+_FALSE = frozenset(('false', '0', 'off', 'no'))
+_NUMBER_START = frozenset('0123456789+-.')
+
+def toBool(value):
+    lowered = value.strip().lower()
+    if lowered in _TRUE:
+        return True
+    elif lowered in _FALSE:
+        return False
+    raise ValueError(f"Invalid boolean '{value}'")
+
+def toFiniteFloat(value):
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"Invalid number '{value}'")
+    return number
+
+def inferType(value):
+    """
+        Converts numbers to float and true/false to bool, everything else is
+        returned as string.
+    """
+    if (len(value) > 0) and (value[0] in _NUMBER_START) and ('_' not in value):
+        try:
+            number = float(value)
+        except ValueError:
+            pass
+        else:
+            # InfluxDB does not accept NaN or infinite values
+            if math.isfinite(number):
+                return number
+
+    lowered = value.lower()
+    if lowered == 'true':
+        return True
+    elif lowered == 'false':
+        return False
+
+    return value
+
+_CONVERTERS = {
+    None: inferType,
+    'int': int,
+    'float': float,
+    'bool': toBool,
+    'string': str,
+}
+
+def getConverter(type_, learn=None, name=None):
+    """
+        Returns a function converting payload text to the given type, or
+        inferring the type if type_ is None. With learn, the type of untyped
+        values is fixed after that many samples.
+    """
+    if type_ not in _CONVERTERS:
+        raise ValueError(f"Invalid type '{type_}'")
+
+    if (type_ is None) and (learn is not None):
+        return LearnedConverter(learn, name)
+
+    return _CONVERTERS[type_]
+
+class DeferredValue:
+    """
+        Payload text whose conversion is left to the process which owns the
+        LearnedConverter, see Rule.convertDeferred().
+    """
+
+    __slots__ = ('text', )
+
+    def __init__(self, text):
+        self.text = text
+
+class LearnedConverter:
+    """
+        Infers the type of the first samples and then fixes the type of the
+        field to the most common one. Later values which can't be converted
+        to it are skipped, so InfluxDB never sees conflicting field types.
+    """
+
+    _CASTS = {
+        float: toFiniteFloat,
+        bool: toBool,
+        str: str,
+    }
+
+    def __init__(self, samples, name=None):
+        self.samples = samples
+        self.name = name
+        self.type_ = None
+        self.skipped = 0
+
+        self._lock = threading.Lock()
+        self._seen = collections.Counter()
+        self._cast = None
+
+    def __call__(self, value):
+        if self._cast is not None:
+            try:
+                return self._cast(value)
+            except ValueError:
+                self.skipped += 1
+                logging.warning(f"Skipping value {value!r} of field '{self.name}', which was learned as {self.type_.__name__}")
+                return SKIP
+
+        converted = inferType(value)
+        with self._lock:
+            if self._cast is None:
+                self._seen[type(converted)] += 1
+                if self._seen.total() >= self.samples:
+                    self.type_ = self._seen.most_common(1)[0][0]
+                    self._cast = self._CASTS[self.type_]
+                    logging.info(f"Learned type {self.type_.__name__} for field '{self.name}'")
+
+        return converted
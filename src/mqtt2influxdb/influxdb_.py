@@ -1,42 +1,691 @@
-import influxdb
+import base64
+import email.utils
+import functools
+import gzip
+import http.client
 import logging
+import threading
+import time
+import urllib.parse
+
+from . import metrics
+from . import wal
+from . import write_scheduler
+
+class BatchStats:
+    # Upper bounds of the batch size histogram buckets (points per flush)
+    BUCKETS = (1, 10, 100, 1000, 5000, 10000, 50000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.batchSizes = [0] * (len(self.BUCKETS) + 1)
+        self.flushes = 0
+        self.failedFlushes = 0
+        self.points = 0
+        self.bytes = 0
+        self.flushLatencySum = 0.0
+        self.flushLatencyMax = 0.0
+
+    def observe(self, points, bytes_, latency, success):
+        with self._lock:
+            for index, bound in enumerate(self.BUCKETS):
+                if points <= bound:
+                    self.batchSizes[index] += 1
+                    break
+            else:
+                self.batchSizes[-1] += 1
+
+            self.flushes += 1
+            if not success:
+                self.failedFlushes += 1
+            self.points += points
+            self.bytes += bytes_
+            self.flushLatencySum += latency
+            self.flushLatencyMax = max(self.flushLatencyMax, latency)
+
+    def summary(self):
+        with self._lock:
+            histogram = {f"<={bound}": count for bound, count in zip(self.BUCKETS, self.batchSizes)}
+            histogram[f">{self.BUCKETS[-1]}"] = self.batchSizes[-1]
+
+            return {
+                'flushes': self.flushes,
+                'failed_flushes': self.failedFlushes,
+                'points': self.points,
+                'bytes': self.bytes,
+                'batch_size_histogram': histogram,
+                'flush_latency_avg': (self.flushLatencySum / self.flushes) if self.flushes > 0 else 0.0,
+                'flush_latency_max': self.flushLatencyMax,
+            }
+
+class LineProtocolEncoder:
+    """
+        Encodes points to InfluxDB line protocol. The escaped measurement and
+        the sorted, escaped tag set of a series are cached, as are the sorted,
+        escaped field keys, so repeated points of a series only encode their
+        field values.
+    """
+
+    # Nanoseconds per unit and the name of the unit in the precision parameter of the write API
+    PRECISIONS = {'s': (10**9, 's'), 'ms': (10**6, 'ms'), 'us': (10**3, 'u'), 'ns': (1, 'ns')}
+
+    def __init__(self, cacheSize=100000, precision=None):
+        if (precision is not None) and (precision not in self.PRECISIONS):
+            raise ValueError(f"Invalid precision '{precision}'")
+
+        self.cacheSize = cacheSize
+        self.precision = precision
+        self._seriesCache = {}
+        self._fieldKeysCache = {}
+        self._timeDivisor = self.PRECISIONS[precision][0] if precision is not None else 1
+
+    @property
+    def precisionParameter(self):
+        """
+            Value of the precision parameter of write requests, None for
+            nanoseconds.
+        """
+        return self.PRECISIONS[self.precision][1] if self.precision is not None else None
+
+    def encode(self, point):
+        measurement = point.get('measurement')
+        tags = point.get('tags') or {}
+        fields = point.get('fields') or {}
+
+        try:
+            seriesKey = (measurement, tuple(tags.items()))
+            series = self._seriesCache.get(seriesKey)
+        except TypeError:
+            # Unhashable tag values are not cached
+            seriesKey = None
+            series = None
+
+        if series is None:
+            series = self._encodeSeries(measurement, tags)
+            if seriesKey is not None:
+                if len(self._seriesCache) >= self.cacheSize:
+                    self._seriesCache.clear()
+                self._seriesCache[seriesKey] = series
+
+        fieldKeysKey = tuple(fields)
+        fieldKeys = self._fieldKeysCache.get(fieldKeysKey)
+        if fieldKeys is None:
+            fieldKeys = tuple((_escapeTag(str(key)), key) for key in sorted(fields))
+            if len(self._fieldKeysCache) >= self.cacheSize:
+                self._fieldKeysCache.clear()
+            self._fieldKeysCache[fieldKeysKey] = fieldKeys
+
+        encodedFields = []
+        for escapedKey, key in fieldKeys:
+            value = _encodeFieldValue(fields[key])
+            if (escapedKey != '') and (value != ''):
+                encodedFields.append(escapedKey + '=' + value)
+
+        line = series
+        if len(encodedFields) > 0:
+            line += ' ' + ','.join(encodedFields)
+
+        time_ = point.get('time')
+        if time_ is not None:
+            # Integer times are nanoseconds, a coarser precision shortens the lines
+            if type(time_) is not int:
+                time_ = int(_lineProtocol()._convert_timestamp(time_))
+            line += ' ' + str(time_ // self._timeDivisor)
+
+        return line
+
+    def encodeBody(self, lines, compressLevel=None):
+        body = ('\n'.join(lines) + '\n').encode('utf-8')
+
+        if compressLevel is not None:
+            body = gzip.compress(body, compresslevel=compressLevel)
+
+        return body
+
+    def _encodeSeries(self, measurement, tags):
+        if measurement is None:
+            raise ValueError(f"Point without measurement (tags: {tags})")
+
+        # Tags are sorted client-side to take load off the server
+        series = _escapeTag(str(measurement))
+        for key in sorted(tags):
+            escapedKey = _escapeTag(str(key))
+            escapedValue = _escapeTag(str(tags[key]))
+
+            if (escapedKey != '') and (escapedValue != ''):
+                series += ',' + escapedKey + '=' + escapedValue
+
+        return series
+
+def _escapeTag(value):
+    return value.replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,").replace("=", "\\=").replace("\n", "\\n")
+
+def _encodeFieldValue(value):
+    type_ = type(value)
+
+    if type_ is float:
+        return repr(value)
+    elif type_ is int:
+        return str(value) + 'i'
+    elif type_ is str:
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+    elif type_ is bool:
+        return str(value)
+    elif value is None:
+        return ''
+    else:
+        # Subclasses and other types are handled by the generic encoder
+        return _lineProtocol()._escape_value(value)
+
+def _lineProtocol():
+    # The influxdb package imports requests, which is slow and only needed by
+    # InfluxDB 1.x outputs and for rare point values
+    import influxdb.line_protocol
+    return influxdb.line_protocol
+
+class WriteError(Exception):
+    def __init__(self, message, retryAfter=None):
+        super().__init__(message)
+        # Seconds the server asked to wait before the next write
+        self.retryAfter = retryAfter
+
+def _parseRetryAfter(value):
+    """
+        Returns the seconds of a Retry-After header, which are given as a
+        number or as an HTTP date, or None.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class HttpBackend:
+    """
+        Base of the backends, which post line protocol bodies over a pool of
+        keep-alive connections, so batches don't pay for a new connection.
+        Subclasses set the path and headers of the write requests.
+    """
+
+    poolSize = 4
+    timeout = 10.0
+
+    def __init__(self, influxdbConfig):
+        self.address = influxdbConfig.get("address", "localhost")
+        self.port = influxdbConfig.get("port", 8086)
+        self.ssl = bool(influxdbConfig.get("ssl", False))
+        self.poolSize = influxdbConfig.get("pool_size", HttpBackend.poolSize)
+        self.timeout = influxdbConfig.get("timeout", HttpBackend.timeout)
+
+        self._path = None
+        self._headers = {'Content-Type': 'text/plain; charset=utf-8'}
+
+        # Idle connections, used by the write threads and the write-ahead log replay
+        self._pool = []
+        self._poolLock = threading.Lock()
+
+    def write(self, body, compressed):
+        headers = self._headers
+        if compressed:
+            headers = {**headers, 'Content-Encoding': 'gzip'}
+
+        status, content, retryAfter = self._post(body, headers)
+        checkResponse(status, content, retryAfter)
+
+    def close(self):
+        with self._poolLock:
+            pool = self._pool
+            self._pool = []
+        for connection in pool:
+            connection.close()
+
+    def _post(self, body, headers):
+        # A pooled connection may have been closed by the server, retry once with a new one
+        for attempt in range(2):
+            with self._poolLock:
+                connection = self._pool.pop() if len(self._pool) > 0 else None
+            reused = connection is not None
+            if not reused:
+                connectionClass = http.client.HTTPSConnection if self.ssl else http.client.HTTPConnection
+                connection = connectionClass(self.address, self.port, timeout=self.timeout)
+
+            try:
+                connection.request('POST', self._path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                with self._poolLock:
+                    if len(self._pool) < self.poolSize:
+                        self._pool.append(connection)
+                        connection = None
+                if connection is not None:
+                    connection.close()
+
+            return response.status, content, response.getheader('Retry-After')
+
+def checkResponse(status, content, retryAfter):
+    """
+        Raises the error for the response of a write request: DiscardBatch
+        for points the server rejected, WriteError for writes to retry.
+    """
+    if status // 100 == 2:
+        return
+
+    message = f"{status} {content[:200]!r}"
+    if (status // 100 == 4) and (status != 429):
+        # The server rejected the points, writing them again won't help
+        raise wal.DiscardBatch(message)
+    raise WriteError(message, _parseRetryAfter(retryAfter))
+
+class InfluxdbV1Backend(HttpBackend):
+    """
+        Writes to the /write endpoint of InfluxDB 1.x.
+    """
+
+    def __init__(self, influxdbConfig, precision=None):
+        super().__init__(influxdbConfig)
+        self.username = influxdbConfig.get("username", "")
+        self.password = influxdbConfig.get("password", "")
+        self.database = influxdbConfig.get("database", None)
+
+        params = {'db': self.database}
+        if precision is not None:
+            params['precision'] = LineProtocolEncoder.PRECISIONS[precision][1]
+        self._path = "/write?" + urllib.parse.urlencode(params)
+
+        if self.username != "":
+            credentials = base64.b64encode(f"{self.username}:{self.password}".encode('utf-8')).decode('ascii')
+            self._headers['Authorization'] = f"Basic {credentials}"
+
+    def connect(self):
+        logging.info("Connecting to InfluxDB server " + self.address + ":" + str(self.port) + " with username '" + self.username + "'")
+
+class InfluxdbV2Backend(HttpBackend):
+    """
+        Writes to the /api/v2/write endpoint of InfluxDB 2.x, which InfluxDB
+        3.x supports as well.
+    """
+
+    def __init__(self, influxdbConfig, precision=None):
+        super().__init__(influxdbConfig)
+        self.org = influxdbConfig.get("org", None)
+        self.bucket = influxdbConfig.get("bucket", influxdbConfig.get("database", None))
+        self.token = influxdbConfig.get("token", None)
+
+        if self.bucket is None:
+            raise ValueError("No 'bucket' for InfluxDB 2 output")
+
+        params = {'bucket': self.bucket}
+        if self.org is not None:
+            params['org'] = self.org
+        if precision is not None:
+            params['precision'] = precision
+        self._path = "/api/v2/write?" + urllib.parse.urlencode(params)
+
+        if self.token is not None:
+            self._headers['Authorization'] = f"Token {self.token}"
+
+    def connect(self):
+        logging.info(f"Using InfluxDB 2 server {self.address}:{self.port}, bucket '{self.bucket}'")
+
+BACKENDS = {
+    1: InfluxdbV1Backend,
+    2: InfluxdbV2Backend,
+}
+
+def createWriteAheadLog(influxdbConfig, writer):
+    """
+        Returns the write-ahead log for the 'buffer' section of an output,
+        which replays the batches with writer(lines), or None without it.
+    """
+    bufferConfig = influxdbConfig.get("buffer", None)
+    if bufferConfig is None:
+        return None
+
+    if 'path' not in bufferConfig:
+        raise ValueError("No 'path' for InfluxDB buffer")
+
+    return wal.WriteAheadLog(
+        bufferConfig['path'],
+        writer,
+        segmentSize=bufferConfig.get("segment_size", 16 * 1024 * 1024),
+        maxSize=bufferConfig.get("max_size", 1024 * 1024 * 1024),
+        fsyncInterval=bufferConfig.get("fsync_interval", 1.0),
+        replayBatchBytes=bufferConfig.get("replay_batch_bytes", 4 * 1024 * 1024),
+        )
 
 class Influxdb:
-    username = ""
-    password = ""
-    address = "localhost"
-    port = 8086
-    database = None
+    """
+        Output which batches points and writes them with a backend for the
+        configured InfluxDB version.
+    """
+
+    name = "influxdb"
+
+    batchSize = 5000
+    batchBytes = 1024 * 1024
+    flushInterval = 1.0
+    maxPendingBatches = 10
+    overflow = 'block'
 
-    _client = None
-    _threads = []
-    _queue = None
+    maxConcurrency = 4
+    retries = 3
+    retryBackoff = 0.5
+    maxRetryBackoff = 30.0
+    latencyTarget = 2.0
 
-    def __init__(self, config):
+    def __init__(self, config, influxdbConfig=None):
         if (config == None):
             raise "No configuration given."
 
-        # Load InfluxDB settings
-        influxdbConfig = config.get("influxdb", None)
+        # Load InfluxDB settings, from one entry of 'outputs' or the 'influxdb' section
+        if influxdbConfig is None:
+            influxdbConfig = config.get("influxdb", None)
 
         if (influxdbConfig == None):
                 raise "No configuration section for InfluxDB"
 
-        self.username = influxdbConfig.get("username", "")
-        self.password = influxdbConfig.get("password", "")
-        self.address = influxdbConfig.get("address", "localhost")
-        self.port = influxdbConfig.get("port", 1883)
-        self.database =  influxdbConfig.get("database", None)
+        self.name = influxdbConfig.get("name", Influxdb.name)
+        self._metricLabels = (self.name, )
+
+        # Batch settings, a batch is flushed as soon as one of the limits is reached
+        self.batchSize = influxdbConfig.get("batch_size", Influxdb.batchSize)
+        self.batchBytes = influxdbConfig.get("batch_bytes", Influxdb.batchBytes)
+        self.flushInterval = influxdbConfig.get("flush_interval", Influxdb.flushInterval)
+        # write() blocks while this many points wait for a flush, so a slow InfluxDB holds up the ingest queue
+        self.maxPendingPoints = influxdbConfig.get("max_pending_points", Influxdb.maxPendingBatches * self.batchSize)
+        # Or, with overflow 'drop', write() drops the points, so a stalled output does not hold up the others
+        self.overflow = influxdbConfig.get("overflow", Influxdb.overflow)
+        if self.overflow not in ('block', 'drop'):
+            raise ValueError(f"Invalid overflow policy '{self.overflow}' for output '{self.name}'")
+        self.dropped = 0
+        self._dropping = False
+
+        self._batch = []
+        self._batchBytes = 0
+        self._batchDeadline = None
+        self._batchCondition = threading.Condition()
+        self._flushLock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._threads = []
+
+        self.stats = BatchStats()
+
+        # Compression level for gzip compressed write requests, None to disable compression
+        self.compressLevel = influxdbConfig.get("gzip", None)
+        if self.compressLevel is True:
+            self.compressLevel = 6
+        elif self.compressLevel is False:
+            self.compressLevel = None
+
+        # Precision of the point times: s, ms, us or ns (default)
+        self._encoder = LineProtocolEncoder(precision=influxdbConfig.get("precision", None))
+
+        version = influxdbConfig.get("version", 1)
+        if version not in BACKENDS:
+            raise ValueError(f"Invalid InfluxDB version '{version}' for output '{self.name}'")
+        self._backend = BACKENDS[version](influxdbConfig, self._encoder.precision)
+
+        # Optional write-ahead log for batches which could not be written
+        self._wal = createWriteAheadLog(influxdbConfig, self._writeLines)
+
+        # Batches are written by a scheduler with an adaptive number of concurrent writes and
+        # retries. With a write-ahead log, failed batches are logged and replayed instead of retried.
+        self._scheduler = write_scheduler.WriteScheduler(
+            maxConcurrency=influxdbConfig.get("max_concurrency", Influxdb.maxConcurrency),
+            retries=influxdbConfig.get("retries", Influxdb.retries if self._wal is None else 0),
+            backoff=influxdbConfig.get("retry_backoff", Influxdb.retryBackoff),
+            maxBackoff=influxdbConfig.get("max_retry_backoff", Influxdb.maxRetryBackoff),
+            latencyTarget=influxdbConfig.get("latency_target", Influxdb.latencyTarget),
+            name=self.name,
+            )
+        metrics.influxdbWriteConcurrency.setFunction(lambda: self._scheduler.limit, labels=self._metricLabels)
+        metrics.influxdbWriteRetries.setFunction(lambda: self._scheduler.retried, labels=self._metricLabels)
+        metrics.influxdbDroppedPoints.setFunction(lambda: self.dropped, labels=self._metricLabels)
 
     def connect(self):
-        logging.info("Connecting to InfluxDB server " + self.address + ":" + str(self.port) + " with username '" + self.username + "'")
-        self._client = influxdb.InfluxDBClient(self.address, self.port, self.username, self.password, self.database)
+        self._backend.connect()
+        self._scheduler.start()
+
+        self._stopEvent.clear()
+        flushThread = threading.Thread(target=self._flushLoop, name=f"{self.name}Flush")
+        flushThread.daemon = True
+        flushThread.start()
+        self._threads.append(flushThread)
+
+        if self._wal is not None:
+            self._wal.start()
 
     def disconnect(self):
-        if hasattr(self._client, "close"):
-            logging.info("Disconnecting from InfluxDB server.")
-            self._client.close()
+        self._stopEvent.set()
+        with self._batchCondition:
+            self._batchCondition.notify_all()
+
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+        self.flush()
+        self._scheduler.stop()
+
+        logging.info(f"InfluxDB batch statistics of '{self.name}': %r" % self.stats.summary())
+        if self.dropped > 0:
+            logging.warning(f"Output '{self.name}' dropped {self.dropped} points")
+
+        if self._wal is not None:
+            self._wal.stop()
+            logging.info(f"Write-ahead log of '{self.name}': appended={self._wal.appendedBatches} "
+                         f"replayed={self._wal.replayedBatches} pending segments={len(self._wal)}")
+
+        self._backend.close()
 
     def write(self, message):
-        logging.debug("Writing %r to database." % message)
-        self._client.write_points(message);
\ No newline at end of file
+        logging.debug("Writing %r to database.", message)
+
+        # Serialize on the caller's thread, so broken points are reported to the caller
+        # and the size of the batch is known exactly.
+        lines = [self._encoder.encode(point) for point in message]
+
+        with self._batchCondition:
+            if (self.overflow == 'drop') and (len(self._batch) >= self.maxPendingPoints):
+                self._drop(lines)
+                return
+
+            while (len(self._batch) >= self.maxPendingPoints) and not self._stopEvent.is_set():
+                self._batchCondition.wait()
+
+            if self._dropping:
+                self._dropping = False
+                logging.warning(f"Output '{self.name}' accepts points again, dropped {self.dropped} points so far")
+
+            # Wake up the flush loop when a new deadline starts or the batch is full
+            notify = (self._batchDeadline is None)
+            if notify:
+                self._batchDeadline = time.monotonic() + self.flushInterval
+
+            self._batch += lines
+            self._batchBytes += sum(len(line) + 1 for line in lines)
+
+            if notify or self._isBatchFull():
+                # Writers may be waiting on the condition as well
+                self._batchCondition.notify_all()
+
+    def _drop(self, lines):
+        # The lock must be held
+        if not self._dropping:
+            self._dropping = True
+            logging.warning(f"Output '{self.name}' has {self.maxPendingPoints} pending points, dropping points")
+        self.dropped += len(lines)
+
+    def flush(self):
+        """
+            Writes the batch and waits for all writes in flight.
+        """
+        self._submitBatch()
+        self._scheduler.join()
+
+    def _submitBatch(self):
+        # Batches are submitted in the order they were taken, with one write in flight they are written in order
+        with self._flushLock:
+            while True:
+                with self._batchCondition:
+                    lines, bytes_ = self._takeBatch()
+                    if len(self._batch) == 0:
+                        self._batchDeadline = None
+                    self._batchCondition.notify_all()
+
+                if len(lines) == 0:
+                    return
+
+                # Blocks while the writes are behind, the next batches wait in self._batch
+                self._scheduler.submit(functools.partial(self._writeBatch, lines), functools.partial(self._batchDone, lines, bytes_))
+
+    def _takeBatch(self):
+        """
+            Removes the first lines up to batchSize and batchBytes from the
+            batch and returns them with their size. The lock must be held.
+        """
+        if not self._isBatchFull():
+            lines = self._batch
+            bytes_ = self._batchBytes
+            self._batch = []
+            self._batchBytes = 0
+            return lines, bytes_
+
+        count = 0
+        bytes_ = 0
+        for line in self._batch:
+            size = len(line) + 1
+            # A single line larger than batchBytes is a batch of its own
+            if (count >= self.batchSize) or ((count > 0) and (bytes_ + size > self.batchBytes)):
+                break
+            count += 1
+            bytes_ += size
+
+        lines = self._batch[:count]
+        del self._batch[:count]
+        self._batchBytes -= bytes_
+        return lines, bytes_
+
+    def _writeBatch(self, lines):
+        if (self._wal is not None) and not self._wal.empty:
+            # Keep the order while older batches are replayed
+            self._wal.append(lines)
+        else:
+            self._writeLines(lines)
+
+    def _batchDone(self, lines, bytes_, error, latency):
+        if isinstance(error, wal.DiscardBatch):
+            logging.error(f'Could not write batch of {len(lines)} points to db: {error}')
+        elif error is not None:
+            if self._wal is not None:
+                logging.warning(f'Could not write batch of {len(lines)} points to db, appending to write-ahead log: {error}')
+                self._wal.append(lines)
+            else:
+                logging.error(f'Could not write batch of {len(lines)} points to db: {error}')
+
+        success = error is None
+        self.stats.observe(len(lines), bytes_, latency, success)
+        if metrics.enabled:
+            metrics.influxdbWrite.observe(latency, labels=self._metricLabels)
+            metrics.influxdbBatchSize.observe(len(lines), labels=self._metricLabels)
+            if not success:
+                metrics.influxdbWriteErrors.inc(labels=self._metricLabels)
+        logging.debug('Flushed %d points (%d bytes) in %.1f ms', len(lines), bytes_, latency * 1000)
+
+    def _writeLines(self, lines):
+        self._backend.write(self._encoder.encodeBody(lines, self.compressLevel), self.compressLevel is not None)
+
+    def _isBatchFull(self):
+        return (len(self._batch) >= self.batchSize) or (self._batchBytes >= self.batchBytes)
+
+    def _flushLoop(self):
+        logging.debug("Starting InfluxDB flush loop ...")
+        while not self._stopEvent.is_set():
+            with self._batchCondition:
+                while not self._stopEvent.is_set() and not self._isBatchFull():
+                    if self._batchDeadline is None:
+                        timeout = None
+                    else:
+                        timeout = self._batchDeadline - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    self._batchCondition.wait(timeout)
+
+            if not self._stopEvent.is_set():
+                self._submitBatch()
+
+class Outputs:
+    """
+        Writes the points to several outputs, e.g. a long-term and a short
+        retention database. Every output has its own batch, write threads and
+        write-ahead log. By default an output drops the points once its
+        max_pending_points are reached, so a stalled output does not hold up
+        the others.
+    """
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def connect(self):
+        for output in self.outputs:
+            output.connect()
+
+    def write(self, message):
+        error = None
+        for output in self.outputs:
+            try:
+                output.write(message)
+            except Exception as e:
+                logging.error(f"Could not write to output '{output.name}': {e}")
+                error = error or e
+
+        if error is not None:
+            raise error
+
+    def flush(self):
+        for output in self.outputs:
+            output.flush()
+
+    def disconnect(self):
+        for output in self.outputs:
+            output.disconnect()
+
+def createOutput(config, outputClass=Influxdb, outputsClass=Outputs):
+    """
+        Returns the output for the 'outputs' list of the configuration or,
+        without it, for the 'influxdb' section.
+    """
+    outputsConfig = config.get("outputs", None)
+    if outputsConfig is None:
+        return outputClass(config)
+
+    if len(outputsConfig) == 0:
+        raise ValueError("No outputs configured")
+
+    outputs = []
+    names = set()
+    for index, outputConfig in enumerate(outputsConfig):
+        name = outputConfig.get("name", f"output{index}")
+        if name in names:
+            raise ValueError(f"Duplicate output name '{name}'")
+        names.add(name)
+        outputs.append(outputClass(config, {'overflow': 'drop', **outputConfig, 'name': name}))
+
+    return outputsClass(outputs)
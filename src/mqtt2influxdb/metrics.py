@@ -0,0 +1,204 @@
+import bisect
+import http.server
+import logging
+import threading
+
+# Hooks on the hot path check this flag first, so disabled metrics cost a global lookup
+enabled = False
+
+_registry = []
+_server = None
+
+class _Metric:
+    type_ = None
+
+    def __init__(self, name, help_, labelNames=()):
+        self.name = name
+        self.help = help_
+        self.labelNames = labelNames
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def remove(self, labels):
+        with self._lock:
+            self._values.pop(labels, None)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_}"]
+        with self._lock:
+            for labels, value in self._values.items():
+                lines += self._exposeValue(self._formatLabels(labels), value)
+        return lines
+
+    def _formatLabels(self, labels, extra=()):
+        pairs = [f'{name}="{_escapeLabel(value)}"' for name, value in (*zip(self.labelNames, labels), *extra)]
+        return '{' + ','.join(pairs) + '}' if len(pairs) > 0 else ''
+
+    def _exposeValue(self, labels, value):
+        return [f"{self.name}{labels} {value}"]
+
+class _FunctionMetric(_Metric):
+    def __init__(self, name, help_, labelNames=()):
+        super().__init__(name, help_, labelNames)
+        self._functions = {}
+
+    def setFunction(self, function, labels=()):
+        # The function is called when the metrics are scraped
+        with self._lock:
+            self._functions[labels] = function
+
+    def remove(self, labels):
+        with self._lock:
+            self._functions.pop(labels, None)
+            self._values.pop(labels, None)
+
+    def expose(self):
+        with self._lock:
+            functions = list(self._functions.items())
+        values = [(labels, function()) for labels, function in functions]
+        with self._lock:
+            # Functions removed in the meantime are not exposed again
+            self._values.update((labels, value) for labels, value in values if labels in self._functions)
+        return super().expose()
+
+class Counter(_FunctionMetric):
+    """
+        A counter is either incremented or its total is returned by a
+        function set with setFunction(), e.g. for counts kept elsewhere.
+    """
+
+    type_ = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+class Gauge(_FunctionMetric):
+    type_ = 'gauge'
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(_Metric):
+    type_ = 'histogram'
+
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help_, labelNames=(), buckets=BUCKETS):
+        super().__init__(name, help_, labelNames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Counts per bucket (the last one is +Inf), sum
+                state = [[0] * (len(self.buckets) + 1), 0.0]
+                self._values[labels] = state
+            state[0][index] += 1
+            state[1] += value
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_}"]
+        with self._lock:
+            for labels, (counts, sum_) in self._values.items():
+                cumulative = 0
+                for bound, count in zip((*self.buckets, '+Inf'), counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{self._formatLabels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{self.name}_sum{self._formatLabels(labels)} {sum_}")
+                lines.append(f"{self.name}_count{self._formatLabels(labels)} {cumulative}")
+        return lines
+
+def _escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def expose():
+    lines = []
+    for metric in _registry:
+        lines += metric.expose()
+    return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics: " + format % args)
+
+def start(config):
+    global enabled, _server
+
+    metricsConfig = config.get("metrics", None)
+    if metricsConfig is None:
+        return
+
+    address = metricsConfig.get("address", "0.0.0.0")
+    port = metricsConfig.get("port", 9100)
+
+    logging.info(f"Serving metrics on http://{address}:{port}/metrics")
+    _server = http.server.ThreadingHTTPServer((address, port), _MetricsHandler)
+    thread = threading.Thread(target=_server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+
+    enabled = True
+
+def stop():
+    global enabled, _server
+
+    enabled = False
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+# MQTT
+mqttMessages = Counter("mqtt2influxdb_mqtt_messages_total", "Messages received from the MQTT server")
+mqttReconnects = Counter("mqtt2influxdb_mqtt_reconnects_total", "Reconnects to the MQTT server")
+queueDepth = Gauge("mqtt2influxdb_queue_depth", "Messages waiting in the ingest queue")
+retainedSkipped = Counter("mqtt2influxdb_retained_skipped_total", "Retained messages skipped without evaluating rules")
+queueWait = Histogram("mqtt2influxdb_queue_wait_seconds", "Time between receiving a message and handling it")
+
+# Rules
+ruleLabels = ('rule', 'topic')
+ruleMatches = Counter("mqtt2influxdb_rule_matches_total", "Messages matched by a rule", ruleLabels)
+rulePoints = Counter("mqtt2influxdb_rule_points_total", "Points produced by a rule", ruleLabels)
+ruleParseFailures = Counter("mqtt2influxdb_rule_parse_failures_total", "Messages a rule failed to convert", ruleLabels)
+ruleWriteErrors = Counter("mqtt2influxdb_rule_write_errors_total", "Points of a rule which could not be queued for writing", ruleLabels)
+ruleSeries = Gauge("mqtt2influxdb_rule_series", "Distinct series of a rule with a series limit", ruleLabels)
+ruleSeriesLimited = Counter("mqtt2influxdb_rule_series_limited_total", "Points of a rule which exceeded its series limit", ruleLabels)
+ruleEvaluation = Histogram("mqtt2influxdb_rule_evaluation_seconds", "Time to evaluate a rule for a message", ruleLabels)
+ruleMetrics = (ruleMatches, rulePoints, ruleParseFailures, ruleWriteErrors, ruleSeries, ruleSeriesLimited, ruleEvaluation)
+
+topicCacheHits = Counter("mqtt2influxdb_topic_cache_hits_total", "Topic lookups answered by the topic cache")
+topicCacheMisses = Counter("mqtt2influxdb_topic_cache_misses_total", "Topic lookups which had to match and parse the topic")
+
+# InfluxDB
+outputLabels = ('output', )
+influxdbWrite = Histogram("mqtt2influxdb_influxdb_write_seconds", "Latency of InfluxDB write requests", outputLabels)
+influxdbBatchSize = Histogram("mqtt2influxdb_influxdb_batch_points", "Points per InfluxDB write request", outputLabels,
+                              buckets=(1, 10, 100, 1000, 5000, 10000, 50000))
+influxdbWriteErrors = Counter("mqtt2influxdb_influxdb_write_errors_total", "Failed InfluxDB write requests", outputLabels)
+influxdbWriteConcurrency = Gauge("mqtt2influxdb_influxdb_write_concurrency", "Adaptive limit of concurrent InfluxDB writes", outputLabels)
+influxdbWriteRetries = Counter("mqtt2influxdb_influxdb_write_retries_total", "Retried InfluxDB write requests", outputLabels)
+influxdbDroppedPoints = Counter("mqtt2influxdb_influxdb_dropped_points_total", "Points dropped by an overflowing output", outputLabels)
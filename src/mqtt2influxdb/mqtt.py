@@ -2,7 +2,189 @@ import paho.mqtt.client as mqtt
 import logging
 import threading
 import queue
-import copy
+import pickle
+import struct
+import time
+
+from . import metrics
+
+class Message:
+    """
+        A received MQTT message. The topic is without prefix, received is the
+        wall clock time of receipt in nanoseconds, which becomes the time of
+        the points, and timestamp the time.monotonic() of receipt.
+    """
+
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'received', 'timestamp')
+
+    def __init__(self, topic, payload, qos=0, retain=False, received=None, timestamp=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.received = received if received is not None else time.time_ns()
+        self.timestamp = timestamp if timestamp is not None else time.monotonic()
+
+class IngestQueue(queue.Queue):
+    """
+        Queue between the MQTT loop and the rule handler. With a maximum depth
+        the overflow policy decides what happens when the queue is full:
+
+        drop_oldest: the oldest queued message is discarded
+        drop_newest: the new message is discarded
+        block:       the MQTT loop waits until there is space in the queue
+        spill:       messages are appended to a spill file and read back in order
+
+        The spill file starts with the offset of the next message to read back.
+        Messages which are still spilled on shutdown are queued again on the
+        next start.
+    """
+
+    OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block', 'spill')
+
+    _SPILL_HEADER = struct.Struct('<Q')
+
+    def __init__(self, maxDepth=0, overflow='block', spillFile=None):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Invalid overflow policy '{overflow}'")
+
+        if (overflow == 'spill') and (spillFile is None):
+            raise ValueError("Overflow policy 'spill' needs a spill file")
+
+        # The depth is limited here instead of by queue.Queue
+        super().__init__()
+
+        self.maxDepth = maxDepth
+        self.overflow = overflow
+        self.dropped = 0
+        self.spilled = 0
+
+        self._spillFile = None
+        self._spillCount = 0
+        self._spillReadPosition = 0
+        if overflow == 'spill':
+            self._openSpillFile(spillFile)
+
+    @property
+    def depth(self):
+        return self.qsize()
+
+    def close(self):
+        if self._spillFile is not None:
+            self._spillFile.close()
+            self._spillFile = None
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            # The None sentinel is never subject to the overflow policy
+            if (item is not None) and (self.maxDepth > 0) and self._isFull():
+                if self.overflow == 'block':
+                    if not block:
+                        raise queue.Full
+                    if not self.not_full.wait_for(lambda: not self._isFull(), timeout):
+                        raise queue.Full
+                elif self.overflow == 'drop_newest':
+                    self._drop()
+                    return
+                elif self.overflow == 'drop_oldest':
+                    if (len(self.queue) > 0) and (self.queue[0] is not None):
+                        self.queue.popleft()
+                        self.unfinished_tasks -= 1
+                        self._drop()
+                elif self.overflow == 'spill':
+                    try:
+                        self._spill(item)
+                    except OSError as e:
+                        logging.error(f"Could not spill message to disk: {e}")
+                        self._drop()
+                        return
+                    self.unfinished_tasks += 1
+                    self.not_empty.notify()
+                    return
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _isFull(self):
+        # Once messages are spilled, new messages go to the spill file as well to keep the order
+        return (len(self.queue) >= self.maxDepth) or (self._spillCount > 0)
+
+    def _drop(self):
+        self.dropped += 1
+        if (self.dropped == 1) or (self.dropped % 10000 == 0):
+            logging.warning(f"Ingest queue is full, dropped {self.dropped} messages so far.")
+
+    def _qsize(self):
+        return len(self.queue) + self._spillCount
+
+    def _get(self):
+        if len(self.queue) > 0:
+            item = self.queue.popleft()
+        else:
+            item = self._unspill()
+
+        # Move spilled messages back into memory as space becomes available
+        while (self._spillCount > 0) and (len(self.queue) < self.maxDepth):
+            self.queue.append(self._unspill())
+
+        return item
+
+    def _openSpillFile(self, spillFile):
+        try:
+            self._spillFile = open(spillFile, 'r+b')
+        except FileNotFoundError:
+            self._spillFile = open(spillFile, 'w+b')
+
+        header = self._spillFile.read(self._SPILL_HEADER.size)
+        if len(header) < self._SPILL_HEADER.size:
+            self._resetSpillFile()
+            return
+
+        # Count the messages left over from the previous run
+        self._spillReadPosition = self._SPILL_HEADER.unpack(header)[0]
+        self._spillFile.seek(self._spillReadPosition)
+        while True:
+            position = self._spillFile.tell()
+            try:
+                pickle.load(self._spillFile)
+            except Exception:
+                # The end of the file, or a message which was not completely written
+                self._spillFile.truncate(position)
+                break
+            self._spillCount += 1
+
+        if self._spillCount > 0:
+            self.unfinished_tasks += self._spillCount
+            logging.info(f"Restored {self._spillCount} spilled messages from {spillFile}")
+        else:
+            self._resetSpillFile()
+
+    def _resetSpillFile(self):
+        self._spillFile.seek(0)
+        self._spillFile.truncate()
+        self._spillReadPosition = self._SPILL_HEADER.size
+        self._spillFile.write(self._SPILL_HEADER.pack(self._spillReadPosition))
+
+    def _spill(self, msg):
+        self._spillFile.seek(0, 2)
+        pickle.dump((msg.topic, msg.payload, msg.qos, msg.retain, msg.received, msg.timestamp), self._spillFile)
+        self._spillCount += 1
+        self.spilled += 1
+
+    def _unspill(self):
+        self._spillFile.seek(self._spillReadPosition)
+        msg = Message(*pickle.load(self._spillFile))
+        self._spillReadPosition = self._spillFile.tell()
+        self._spillCount -= 1
+
+        if self._spillCount == 0:
+            self._resetSpillFile()
+        else:
+            self._spillFile.seek(0)
+            self._spillFile.write(self._SPILL_HEADER.pack(self._spillReadPosition))
+
+        return msg
 
 class Mqtt:
     username = ""
@@ -11,10 +193,11 @@ class Mqtt:
     port = 1883
     prefix = ""
 
+    clients = 1
+    subscribeBatch = 100
+
     _client = None
-    _threads = []
     _queue = None
-    _topics = set()
 
     def __init__(self, config):
         if (config == None):
@@ -30,8 +213,34 @@ class Mqtt:
         self.password = mqttConfig.get("password", "")
         self.address = mqttConfig.get("address", "localhost")
         self.port = mqttConfig.get("port", 1883)
-        self._queue = queue.Queue()
+        self._queue = IngestQueue(
+            maxDepth=mqttConfig.get("queue_size", 0),
+            overflow=mqttConfig.get("overflow", "block"),
+            spillFile=mqttConfig.get("spill_file", None),
+            )
         self.prefix = mqttConfig.get("prefix")
+        self.protocol = mqttConfig.get("protocol", 4)
+        self.clientId = mqttConfig.get("client_id", "")
+
+        # With a share group the broker distributes the messages between all
+        # clients of the group, in this and in other processes
+        self.shareGroup = mqttConfig.get("share_group", None)
+        self.clients = mqttConfig.get("clients", Mqtt.clients)
+
+        if self.protocol not in (4, 5):
+            raise ValueError(f"Invalid MQTT protocol '{self.protocol}', expected 4 (3.1.1) or 5")
+        if (self.shareGroup is not None) and ((self.shareGroup == '') or any(char in self.shareGroup for char in '/+#')):
+            raise ValueError(f"Invalid MQTT share group '{self.shareGroup}'")
+        if (self.clients > 1) and (self.shareGroup is None):
+            raise ValueError("Multiple MQTT clients need a share group, otherwise every message is received by all of them")
+
+        self._clients = []
+        self._connectedClients = set()
+        self._threads = []
+        # Subscribed topics without prefix
+        self._topics = set()
+
+        metrics.queueDepth.setFunction(self._queue.qsize)
 
         if (self.prefix == None):
             self.prefix = ""
@@ -41,38 +250,96 @@ class Mqtt:
     def connect(self):
         logging.info("Connecting to MQTT server " + self.address + ":" + str(self.port) + " ...")
 
-        self._client = mqtt.Client()
+        # Every client has its own network loop, all of them feed the same queue
+        for index in range(self.clients):
+            client = self._createClient(index)
+            client.connect(self.address, self.port, 60)
+            self._clients.append(client)
 
-        if (self.username != "" and self.password != ""):
-            self._client.username_pw_set(self.username, self.password)
+            name = "mqttLoop" if self.clients == 1 else f"mqttLoop{index}"
+            mqttLoopThread = threading.Thread(target=self._mqttLoop, name=name, args=(client, ))
+            mqttLoopThread.start()
+            self._threads.append(mqttLoopThread)
 
-        self._client.on_message = self._mqtt_on_message
-        self._client.on_connect = self._mqtt_on_connect
-        self._client.on_disconnect = self._mqtt_on_disconnect
-        self._client.on_log = self._mqtt_on_log
-        self._client.connect(self.address, self.port, 60)
+        self._client = self._clients[0]
 
-        mqttLoopThread = threading.Thread(target=self._mqttLoop, name="mqttLoop")
-        mqttLoopThread.start()
-        self._threads.append(mqttLoopThread)
+    def _createClient(self, index):
+        clientId = self.clientId
+        if (clientId != "") and (self.clients > 1):
+            clientId = f"{clientId}-{index}"
+
+        if self.protocol == 5:
+            client = mqtt.Client(clientId, protocol=mqtt.MQTTv5)
+        else:
+            client = mqtt.Client(clientId)
+
+        if (self.username != "" and self.password != ""):
+            client.username_pw_set(self.username, self.password)
+
+        client.on_message = self._mqtt_on_message
+        client.on_connect = self._mqtt_on_connect
+        client.on_disconnect = self._mqtt_on_disconnect
+        client.on_log = self._mqtt_on_log
+        return client
 
     def disconnect(self):
         logging.info("Disconnecting from MQTT server ...")
-        self._client.disconnect()
+        for client in self._clients:
+            client.disconnect()
         self._queue.put(None)
 
         for t in self._threads:
             t.join()
 
+        logging.info(f"Ingest queue: depth={self._queue.depth} dropped={self._queue.dropped} spilled={self._queue.spilled}")
+
     def getQueue(self):
         return self._queue
 
-    def subscribe(self, topic):
-        fullTopic = self.prefix + topic
+    def subscribe(self, topics):
+        """
+            Subscribes to a topic or a list of topics. Lists are sent with up
+            to subscribeBatch topics per SUBSCRIBE packet.
+        """
+        if isinstance(topics, str):
+            topics = [topics]
+
+        self._logTopics("Subscribing to", topics)
+        self._topics.update(topics)
+        for client in self._clients:
+            self._subscribeClient(client, topics)
+
+    def unsubscribe(self, topics):
+        if isinstance(topics, str):
+            topics = [topics]
+
+        self._logTopics("Unsubscribing from", topics)
+        self._topics.difference_update(topics)
+        fullTopics = [self._subscriptionTopic(topic) for topic in topics]
+        for client in self._clients:
+            for start in range(0, len(fullTopics), self.subscribeBatch):
+                client.unsubscribe(fullTopics[start:start + self.subscribeBatch])
 
-        logging.info("Subscribing to " + fullTopic + ".")
-        self._topics.add(fullTopic)
-        self._client.subscribe(fullTopic)
+    def _subscribeClient(self, client, topics):
+        fullTopics = [(self._subscriptionTopic(topic), 0) for topic in topics]
+        for start in range(0, len(fullTopics), self.subscribeBatch):
+            client.subscribe(fullTopics[start:start + self.subscribeBatch])
+
+    def _logTopics(self, action, topics):
+        if len(topics) == 1:
+            logging.info(action + " " + self._subscriptionTopic(topics[0]) + ".")
+        else:
+            # Large rule sets have thousands of topics
+            logging.info(f"{action} {len(topics)} topics.")
+            if logging.root.isEnabledFor(logging.DEBUG):
+                for topic in topics:
+                    logging.debug(action + " " + self._subscriptionTopic(topic) + ".")
+
+    def _subscriptionTopic(self, topic):
+        # Messages of shared subscriptions have the topic they were published to, without '$share/<group>/'
+        if self.shareGroup is not None:
+            return f"$share/{self.shareGroup}/{self.prefix}{topic}"
+        return self.prefix + topic
 
     def publish(self, topic, value, retain):
         fullTopic = self.prefix + topic
@@ -80,27 +347,39 @@ class Mqtt:
         logging.debug("Publishing to '%s': %r" % (fullTopic, value))
         self._client.publish(topic=fullTopic, payload=value, qos=0, retain=retain)
 
-    def _mqttLoop(self):
+    def _mqttLoop(self, client):
         logging.debug("Starting MQTT loop ...")
-        self._client.loop_forever()
+        client.loop_forever()
 
-    def _mqtt_on_connect(self, client, userdata, flags, rc):
+    def _mqtt_on_connect(self, client, userdata, flags, rc, properties=None):
         logging.info("Connected to MQTT server " + self.address + ":" + str(self.port) + ".")
-        for topic in copy.copy(self._topics):
-            self.subscribe(topic)
+        if (id(client) in self._connectedClients) and metrics.enabled:
+            metrics.mqttReconnects.inc()
+        self._connectedClients.add(id(client))
+
+        # Subscribe this client again, stored topics have no prefix
+        self._subscribeClient(client, list(self._topics))
 
-    def _mqtt_on_disconnect(self, client, userdata, rc):
+    def _mqtt_on_disconnect(self, client, userdata, rc, properties=None):
         logging.info("Disconnected from MQTT server.")
 
     def _mqtt_on_message(self, client, userdata, msg):
-        logging.debug("Message: "+msg.topic +" "+msg.payload.decode('utf-8', errors="replace"))
+        if metrics.enabled:
+            metrics.mqttMessages.inc()
 
-        if msg.topic.startswith(self.prefix):
-            msg.topic = msg.topic[len(self.prefix):].encode('utf-8')
-        else:
-            raise "Received message does not contain prefix."
+        # paho decodes the topic on every access
+        topic = msg.topic
+
+        # The message is only formatted when it is logged
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("Message: %s %s", topic, msg.payload.decode('utf-8', errors="replace"))
+
+        if not topic.startswith(self.prefix):
+            logging.error(f"Received message for topic '{topic}' does not contain prefix.")
+            return
 
-        self._queue.put(msg)
+        # paho stamps messages with time.monotonic() when they are received
+        self._queue.put(Message(topic[len(self.prefix):], msg.payload, msg.qos, msg.retain, time.time_ns(), msg.timestamp))
 
     def _mqtt_on_log(self, client, userdata, level, buf):
         if (level == mqtt.MQTT_LOG_ERR):
@@ -1,16 +1,20 @@
 #!/usr/bin/python
 
+import asyncio
 import logging
+import signal
 import sys
 import daemon
 import time
 import argparse
-import yaml
 import threading
 import re
 import paho.mqtt
 
+from . import async_pipeline
+from . import configfile
 from . import influxdb_ as influxdb
+from . import metrics
 from . import mqtt
 from .rule_handler import RuleHandler
 
@@ -41,6 +45,17 @@ def parseArgs(argv):
     parser.add_argument("-d", "--daemon",
                         help="Run as daemon", action='store_true')
 
+    parser.add_argument("-a", "--async",
+                        help="Run MQTT, rule evaluation and InfluxDB writes on an asyncio event loop",
+                        dest="async_mode", action='store_true')
+
+    parser.add_argument("-w", "--watch",
+                        help="Reload the rules when the config file changes (they are always reloaded on SIGHUP)", action='store_true')
+
+    parser.add_argument("--config-cache",
+                        help="Cache the parsed config file in this directory, which speeds up the start with large rule sets",
+                        dest="config_cache", metavar="DIRECTORY")
+
     parser.add_argument("-v", "--verbose",
                         help="Increases log verbosity for each occurence", dest="verbose_count", action="count", default=0)
 
@@ -48,32 +63,68 @@ def parseArgs(argv):
 
     return args
 
-def parseConfig(filename):
+def parseConfig(filename, cacheDirectory=None):
     try:
-        return yaml.safe_load(open(filename, "r"))
+        return configfile.load(filename, cacheDirectory)
     except Exception as e:
         raise
         logging.error("Can't load yaml file %r (%r)" % (filename, e))
 
+def reloadConfig(filename, config, rh, cacheDirectory=None):
+    """
+        Loads the rules of the config file into the rule handler. Returns the
+        new configuration or the old one if the file is invalid.
+    """
+    logging.info(f"Reloading rules from {filename} ...")
+    try:
+        newConfig = parseConfig(filename, cacheDirectory)
+        ruleSet = rh.compileRules(newConfig)
+    except Exception as e:
+        logging.error(f"Could not reload config file, keeping the current rules: {type(e).__name__}: {e}")
+        return config
+
+    rh.swapRules(ruleSet)
+    configfile.warnRestartSections(config, newConfig)
+
+    return newConfig
+
 def run(args):
     logging.basicConfig(format="%(asctime)s [%(threadName)-15s] %(levelname)-6s %(message)s",
                         level=max(3 - args.verbose_count, 0) * 10)
 
-    config = parseConfig(args.conf_file)
+    config = parseConfig(args.conf_file, args.config_cache)
+
+    if args.async_mode:
+        asyncio.run(async_pipeline.run(config, args.conf_file, args.watch, args.config_cache))
+        logging.shutdown()
+        return
+
+    metrics.start(config)
 
     m = mqtt.Mqtt(config)
     m.connect()
 
-    db = influxdb.Influxdb(config)
+    db = influxdb.createOutput(config)
     db.connect()
 
     rh = RuleHandler(config, m, db)
 
     stopEvent = threading.Event()
 
+    # Rules are compiled in the main thread while the workers keep handling messages
+    reloadEvent = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signalNumber, frame: reloadEvent.set())
+    modified = configfile.modificationTime(args.conf_file)
+
     try:
         while True:
-            stopEvent.wait(60)
+            if reloadEvent.wait(2 if args.watch else 60):
+                reloadEvent.clear()
+                config = reloadConfig(args.conf_file, config, rh, args.config_cache)
+
+            if args.watch and (configfile.modificationTime(args.conf_file) != modified):
+                modified = configfile.modificationTime(args.conf_file)
+                reloadEvent.set()
 
     except (SystemExit,KeyboardInterrupt):
         # Normal exit getting a signal from the parent process
@@ -86,9 +137,13 @@ def run(args):
 
         stopEvent.set()
 
-        rh.finish()
+        # Stop receiving, handle all queued messages and write remaining points
         m.disconnect()
+        rh.finish()
+        m.getQueue().close()
+        db.flush()
         db.disconnect()
+        metrics.stop()
 
         logging.shutdown()
 
@@ -0,0 +1,84 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loadsJson(data):
+    """
+        Parses JSON with orjson if it is installed. orjson is stricter than the
+        json module (e.g. it rejects NaN), so documents it rejects are parsed
+        again with the json module.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+
+    return json.loads(data)
+
+class Payload:
+    """
+        View on the payload of a message which is shared by all rules matching
+        the message. The text is decoded and the JSON document is parsed at
+        most once, when a rule first needs it. Rules must not modify the
+        parsed document.
+    """
+
+    __slots__ = ('raw', '_text', '_json', '_jsonError')
+
+    _UNSET = object()
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._text = None
+        self._json = self._UNSET
+        self._jsonError = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.raw.decode("UTF-8")
+        return self._text
+
+    @property
+    def json(self):
+        if self._json is self._UNSET:
+            try:
+                self._json = loadsJson(self.raw)
+            except ValueError as e:
+                self._json = None
+                self._jsonError = e
+
+        if self._jsonError is not None:
+            raise self._jsonError
+
+        return self._json
+
+    def parsed(self):
+        """
+            Returns the JSON document or the text if the payload is not JSON.
+        """
+        try:
+            return self.json
+        except ValueError:
+            return self.text
+
+class JsonPath:
+    """
+        Precompiled extractor for a comma separated path into a JSON document,
+        e.g. 'sensor,temperature'.
+    """
+
+    __slots__ = ('path', '_keys')
+
+    def __init__(self, path):
+        self.path = path
+        self._keys = tuple(path.split(','))
+
+    def __call__(self, document):
+        for key in self._keys:
+            document = document[key]
+        return document
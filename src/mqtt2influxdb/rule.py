@@ -0,0 +1,344 @@
+import builtins
+import datetime
+import functools
+import importlib
+import logging
+import sys
+
+from . import aggregate
+from . import bulk
+from . import cardinality
+from . import converters
+from . import payload
+from . import topic
+
+class Rule:
+    """
+        A rule of the configuration compiled into the steps it needs to
+        convert a message into database inserts. All decisions which only
+        depend on the configuration are made once in the constructor, so
+        apply() only runs the steps configured for this rule.
+    """
+
+    __slots__ = (
+        'index', 'config', 'topicObject', 'metricLabels', 'retain', 'disableWrite', 'seriesGuard', 'stages',
+        '_parser', '_bulk', '_payloadField', '_learnedConverter', '_timestamp', '_fields', '_tags', '_measurement', '_tokenSteps',
+        )
+
+    def __init__(self, config, index, deferLearning=False):
+        self.index = index
+        self.config = config
+
+        self.topicObject = topic.Topic(config['topic'])
+        self.metricLabels = (str(index), config['topic'])
+        self.retain = bool(config.get('retain', False))
+        self.disableWrite = bool(config.get('disable_write', False))
+        # Series limit, aggregation and deadband, applied by the rule handler to the inserts of all messages.
+        # The series limit comes first, so aggregated rules are limited by the series they would write.
+        self.seriesGuard = cardinality.createGuard(config, index)
+        self.stages = aggregate.createStages(config, index)
+        if self.seriesGuard is not None:
+            self.stages = (self.seriesGuard, ) + self.stages
+
+        self._parser = None
+        self._payloadField = None
+        self._learnedConverter = None
+        self._fields = config.get('fields') or None
+        self._tags = config.get('tags') or None
+        if self._tags is not None:
+            # Tag keys and values are interned, points of all messages share them
+            self._tags = {sys.intern(str(name)): sys.intern(str(value)) for name, value in self._tags.items()}
+        self._measurement = None
+        self._tokenSteps = ()
+        self._timestamp = _receiveTime
+
+        if config.get('measurement', None) is not None:
+            self._measurement = str(config['measurement'])
+
+        payloadConfig = config.get('payload', None)
+        if isinstance(payloadConfig, dict):
+            # Compile payload parser once, so invalid code is rejected at startup
+            if 'parser' in payloadConfig:
+                self._parser = compileParser(payloadConfig['parser'], index)
+            elif 'parser_function' in payloadConfig:
+                self._parser = loadParserFunction(payloadConfig['parser_function'], index)
+
+            if payloadConfig.get('field', False):
+                name = payloadConfig.get('name', 'payload')
+                type_ = payloadConfig.get('type', None)
+                if type_ == 'json':
+                    if 'json' not in payloadConfig:
+                        raise ValueError(f"No 'json' path for payload of type 'json' in rule #{index}")
+                    # JSON paths are split once and the document is shared by all rules
+                    convert = functools.partial(_extractJson, payload.JsonPath(payloadConfig['json']))
+                else:
+                    # The converter is chosen once, values of untyped payloads are inferred without regular expressions
+                    converter = converters.getConverter(type_, payloadConfig.get('learn', None), f"{config['topic']}:{name}")
+                    if isinstance(converter, converters.LearnedConverter):
+                        self._learnedConverter = converter
+                        if deferLearning:
+                            # Worker processes leave the values to the rule handler, which learns from all of them
+                            converter = converters.DeferredValue
+                    convert = functools.partial(_convertText, converter)
+
+                self._payloadField = (name, convert)
+
+        # Points are stamped with the receive time unless the time is taken from the payload or left to the server
+        timestampConfig = config.get('timestamp', True)
+        if timestampConfig is False:
+            self._timestamp = None
+        elif isinstance(timestampConfig, dict):
+            if 'json' not in timestampConfig:
+                raise ValueError(f"No 'json' path for timestamp in rule #{index}")
+            unit = timestampConfig.get('unit', 's')
+            if unit not in TIME_UNITS:
+                raise ValueError(f"Invalid timestamp unit '{unit}' in rule #{index}")
+            self._timestamp = functools.partial(_payloadTime, payload.JsonPath(timestampConfig['json']), TIME_UNITS[unit])
+
+        # Payloads with many readings become one point per reading
+        self._bulk = bulk.createBulk(config, index, TIME_UNITS)
+
+        tokensConfig = config.get('tokens', None)
+        if isinstance(tokensConfig, dict):
+            for tokenName, tokenConfig in tokensConfig.items():
+                if 'rule' in tokenConfig:
+                    self.topicObject.addTokenRule(tokenName, tokenConfig['rule'])
+
+            self._tokenSteps = tuple(self._compileTokenSteps(tokensConfig))
+
+    @property
+    def normalized(self):
+        return self.topicObject.normalized
+
+    @property
+    def cpuBound(self):
+        return self._parser is not None
+
+    def apply(self, topic, payload_, received=None):
+        """
+            Returns the list of inserts for a message or None if the topic is
+            rejected by the rule. payload_ is the payload.Payload of the message
+            and received the receive time in nanoseconds.
+        """
+        matches = self.topicObject.parse(topic)
+
+        if matches is None:
+            return None
+
+        return self.applyTokens(matches, payload_, received)
+
+    def applyTokens(self, matches, payload_, received=None):
+        """
+            Returns the list of inserts for a message whose topic was already
+            parsed into matches, see topic.freezeTokens().
+        """
+        db_inserts = []
+
+        # primary insert
+        db_insert = {
+            'fields': {},
+            'tags': {}
+        }
+
+        if self._parser is not None:
+            result = self._parser(payload_.parsed(), topic.thawTokens(matches))
+
+            for key in ['fields', 'tags', 'measurement', 'time']:
+                if key in result:
+                    db_insert[key] = result[key]
+
+            if 'inserts' in result:
+                if isinstance(result['inserts'], list):
+                    db_inserts += result['inserts']
+                else:
+                    raise TypeError("inserts must be of type list")
+
+        if self._payloadField is not None:
+            name, convert = self._payloadField
+            value = convert(payload_)
+            if value is not converters.SKIP:
+                db_insert['fields'][name] = value
+
+        if self._fields is not None:
+            db_insert['fields'].update(self._fields)
+
+        if self._tags is not None:
+            db_insert['tags'].update(self._tags)
+
+        if self._measurement is not None:
+            db_insert['measurement'] = self._measurement
+
+        for tokenName, step in self._tokenSteps:
+            if tokenName in matches:
+                value = matches[tokenName]
+                # Multi tokens are frozen into tuples by the topic cache
+                step(db_insert, list(value) if type(value) is tuple else value)
+
+        if self._bulk is not None:
+            # The insert of the message holds what all readings share
+            db_inserts += self._bulk.points(payload_.json, db_insert)
+
+        # Check db_insert
+        elif (len(db_insert['fields']) > 0) and (len(db_insert['tags']) > 0):
+            if 'measurement' not in db_insert:
+                logging.error(f'No measurement for rule {self.topicObject.topic}: {db_insert}')
+
+            db_inserts.append(db_insert)
+
+        if (self._timestamp is not None) and (received is not None) and (len(db_inserts) > 0):
+            time_ = self._timestamp(payload_, received)
+            for insert in db_inserts:
+                if 'time' not in insert:
+                    insert['time'] = time_
+
+        return db_inserts
+
+    def convertDeferred(self, db_inserts):
+        """
+            Converts the learned payload field of the inserts returned by a
+            rule compiled with deferLearning in a worker process.
+        """
+        if (self._learnedConverter is None) or (db_inserts is None):
+            return db_inserts
+
+        name = self._payloadField[0]
+        # Bulk inserts share the value of the message, it is converted once
+        converted = {}
+        result = []
+        for insert in db_inserts:
+            fields = insert.get('fields', {})
+            value = fields.get(name)
+            if type(value) is converters.DeferredValue:
+                if id(value) not in converted:
+                    converted[id(value)] = self._learnedConverter(value.text)
+                if converted[id(value)] is converters.SKIP:
+                    insert['fields'] = {key: field for key, field in fields.items() if key != name}
+                    if len(insert['fields']) == 0:
+                        continue
+                else:
+                    fields[name] = converted[id(value)]
+            result.append(insert)
+        return result
+
+    def _compileTokenSteps(self, tokensConfig):
+        # Steps are returned in the order of the tokens in the topic
+        for tokenName in self.topicObject.tokenNames:
+            if tokenName not in tokensConfig:
+                continue
+
+            tokenConfig = tokensConfig[tokenName]
+            steps = []
+            fieldName = tokenConfig.get('field_name', tokenName)
+            tagName = sys.intern(str(tokenConfig.get('tag_name', tokenName)))
+
+            if tokenConfig.get('field', False):
+                steps.append(functools.partial(_setField, fieldName))
+
+            if tokenConfig.get('field_map', {}) != {}:
+                steps.append(functools.partial(_mapField, fieldName, tokenConfig['field_map']))
+
+            if tokenConfig.get('tag', False):
+                steps.append(functools.partial(_setTag, tagName))
+
+            if tokenConfig.get('tag_map', {}) != {}:
+                tagMap = {key: sys.intern(str(value)) for key, value in tokenConfig['tag_map'].items()}
+                steps.append(functools.partial(_mapTag, tagName, tagMap))
+
+            if tokenConfig.get('measurement', False):
+                steps.append(_setMeasurement)
+
+            if tokenConfig.get('measurement_map', {}) != {}:
+                steps.append(functools.partial(_mapMeasurement, tokenConfig['measurement_map']))
+
+            if len(steps) == 1:
+                yield (tokenName, steps[0])
+            elif len(steps) > 1:
+                yield (tokenName, functools.partial(_runSteps, tuple(steps)))
+
+# Nanoseconds per unit
+TIME_UNITS = {'s': 10**9, 'ms': 10**6, 'us': 10**3, 'ns': 1}
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+def _receiveTime(payload_, received):
+    return received
+
+def _payloadTime(jsonPath, multiplier, payload_, received):
+    try:
+        value = jsonPath(payload_.json)
+        if isinstance(value, str):
+            try:
+                value = float(value)
+            except ValueError:
+                # ISO 8601, naive times are UTC
+                time_ = datetime.datetime.fromisoformat(value)
+                if time_.tzinfo is None:
+                    time_ = time_.replace(tzinfo=datetime.timezone.utc)
+                return (time_ - _EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise TypeError(f"{value!r} is not a time")
+
+        return int(value * multiplier) if isinstance(value, float) else value * multiplier
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        logging.warning(f"No timestamp in payload ({type(e).__name__}: {e}), using the receive time")
+        return received
+
+def _extractJson(jsonPath, payload_):
+    return str(jsonPath(payload_.json))
+
+def _convertText(converter, payload_):
+    return converter(payload_.text)
+
+def _setField(name, db_insert, value):
+    db_insert['fields'][name] = str(value)
+
+def _mapField(name, map_, db_insert, value):
+    db_insert['fields'][name] = str(map_[value])
+
+def _setTag(name, db_insert, value):
+    db_insert['tags'][name] = str(value)
+
+def _mapTag(name, map_, db_insert, value):
+    db_insert['tags'][name] = map_[value]
+
+def _setMeasurement(db_insert, value):
+    db_insert['measurement'] = value
+
+def _mapMeasurement(map_, db_insert, value):
+    db_insert['measurement'] = str(map_[value])
+
+def _runSteps(steps, db_insert, value):
+    for step in steps:
+        step(db_insert, value)
+
+def compileParser(source, index):
+    try:
+        code = compile(source, f"<parser of rule #{index}>", 'exec')
+    except SyntaxError as e:
+        raise ValueError(f"Invalid parser for rule #{index}: {e}") from e
+
+    # Globals are shared between all invocations of the parser
+    globals_ = {'__builtins__': builtins}
+
+    def parser(payload, tokens):
+        locals_ = {'payload': payload, 'tokens': tokens}
+        exec(code, globals_, locals_)
+        return locals_
+
+    return parser
+
+def loadParserFunction(path, index):
+    moduleName, _, functionName = path.rpartition('.')
+    if moduleName == '':
+        raise ValueError(f"Invalid parser_function '{path}' for rule #{index}, expected 'module.function'")
+
+    try:
+        function = getattr(importlib.import_module(moduleName), functionName)
+    except (ImportError, AttributeError) as e:
+        raise ValueError(f"Could not load parser_function '{path}' for rule #{index}: {e}") from e
+
+    if not callable(function):
+        raise ValueError(f"parser_function '{path}' for rule #{index} is not callable")
+
+    return function
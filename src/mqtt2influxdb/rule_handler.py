@@ -1,217 +1,611 @@
-import paho.mqtt.client as mqttClient
+import collections
+import concurrent.futures
+import functools
 import logging
+import multiprocessing
+import queue
 import threading
-import re
-import json
+import time
 
+from . import aggregate
+from . import metrics
+from . import payload
+from . import rule
 from . import topic
 
 class RuleHandler:
     config = {}
 
-    _threads = []
-    _stopEvent = threading.Event()
+    threads = 1
+    processes = 0
+    # Messages per worker thread evaluated in the worker processes at the same time, per process
+    processWindow = 2
+    topicCacheSize = 10000
+    retainCacheSize = 100000
 
-    def __init__(self, config, mqtt, influxdb):
+    def __init__(self, config, mqtt, influxdb, workers=True):
         self._mqtt = mqtt
         self._influxdb = influxdb
+        self._threads = []
+        self._stopEvent = threading.Event()
+        self._executor = None
+        self._ruleSet = None
 
-        queueHandlerThread = threading.Thread(target=self._queueHandler, name="ruleHandlerQueueHandler")
-        queueHandlerThread.daemon = True
-        queueHandlerThread.start()
-        self._threads.append(queueHandlerThread)
+        self._ruleSet = self.compileRules(config)
 
-        self._parseConfiguration(config)
-        self._subcribeMqttTopics()
+        retainCacheSize = config.get("retain_cache_size", RuleHandler.retainCacheSize)
+        self._retainCache = RetainCache(retainCacheSize) if retainCacheSize > 0 else None
+
+        # Lookups of the rule sets replaced by reloads, the counters keep growing
+        self._topicCacheHits = 0
+        self._topicCacheMisses = 0
+        metrics.topicCacheHits.setFunction(lambda: self._topicCacheHits + self._ruleSet.matchTopic.cache_info().hits)
+        metrics.topicCacheMisses.setFunction(lambda: self._topicCacheMisses + self._ruleSet.matchTopic.cache_info().misses)
+        self._registerSeriesMetrics(self._ruleSet)
+
+        # Without workers the caller passes the messages to handleMessage()
+        if workers:
+            self._startWorkers(config)
+
+        self._subcribeMqttTopics(self._ruleSet.normalizedTopics)
 
     def finish(self):
         logging.info("Finishing topic handler ...")
         self._stopEvent.set()
 
-    def _queueHandler(self):
-        logging.info("Starting Queue handler ...")
-        while not self._stopEvent.is_set():
+        # Wake up the queue reader, all messages queued before are still handled
+        if len(self._threads) > 0:
+            self._mqtt.getQueue().put(None)
+
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+        # Write the open aggregation windows
+        self.collectStages(flush=True)
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        logging.info("Topic cache: %r" % (self.topicCacheInfo(), ))
+        for topic_, info in self.cardinalityInfo().items():
+            logging.info(f"Series of rule '{topic_}': %r" % (info, ))
+
+    def compileRules(self, config):
+        """
+            Compiles the rules of a configuration into a RuleSet. This does
+            not touch the rules in use, so it can run in any thread.
+        """
+        generation = self._ruleSet.generation + 1 if self._ruleSet is not None else 0
+        return RuleSet(config, generation)
+
+    def swapRules(self, ruleSet):
+        """
+            Replaces the rules in use and subscribes or unsubscribes only the
+            topics which changed. Messages are handled by either the old or
+            the new rules, the MQTT session and queued messages are kept.
+        """
+        oldRuleSet = self._ruleSet
+        self._ruleSet = ruleSet
+
+        # Messages already matched by the old rules are handled before their aggregations are flushed
+        oldRuleSet.waitUnused()
+
+        info = oldRuleSet.matchTopic.cache_info()
+        self._topicCacheHits += info.hits
+        self._topicCacheMisses += info.misses
+
+        # The state of aggregations is not carried over to the new rules
+        self._collectStages(oldRuleSet, flush=True)
+        # Retained messages skipped by the old rules may be written by the new ones
+        if self._retainCache is not None:
+            self._retainCache.clear()
+        self._registerSeriesMetrics(ruleSet)
+        self._removeRuleMetrics(oldRuleSet, ruleSet)
+
+        oldTopics = oldRuleSet.normalizedTopics
+        newTopics = ruleSet.normalizedTopics
+        self._subcribeMqttTopics([normalizedTopic for normalizedTopic in newTopics if normalizedTopic not in oldTopics])
+        removedTopics = [normalizedTopic for normalizedTopic in oldTopics if normalizedTopic not in newTopics]
+        if len(removedTopics) > 0:
+            self._mqtt.unsubscribe(removedTopics)
+
+        logging.info(f"Loaded {len(ruleSet.compiledRules)} rules for {len(newTopics)} topics")
+
+    def reload(self, config):
+        self.swapRules(self.compileRules(config))
+
+    def collectStages(self, now=None, flush=False):
+        """
+            Writes the points of aggregation windows which have ended, all
+            open windows with flush. Called every second by a worker thread,
+            without workers by the caller.
+        """
+        self._collectStages(self._ruleSet, now, flush)
+
+    def _collectStages(self, ruleSet, now=None, flush=False):
+        for compiledRule in ruleSet.stagedRules:
+            points = aggregate.collectStages(compiledRule.stages, now, flush)
+            if len(points) > 0:
+                self._write(compiledRule, points)
+
+    def cardinalityInfo(self):
+        """
+            Returns the series statistics of all rules with a series limit.
+        """
+        return {
+            compiledRule.config['topic']: compiledRule.seriesGuard.info()
+            for compiledRule in self._ruleSet.compiledRules if compiledRule.seriesGuard is not None
+            }
+
+    def _registerSeriesMetrics(self, ruleSet):
+        for compiledRule in ruleSet.compiledRules:
+            guard = compiledRule.seriesGuard
+            if guard is not None:
+                metrics.ruleSeries.setFunction(guard.__len__, labels=compiledRule.metricLabels)
+                metrics.ruleSeriesLimited.setFunction(functools.partial(getattr, guard, 'limited'), labels=compiledRule.metricLabels)
+
+    def _removeRuleMetrics(self, oldRuleSet, ruleSet):
+        # The metrics of rules which are gone would otherwise be exposed forever
+        labels = {compiledRule.metricLabels for compiledRule in ruleSet.compiledRules}
+        for compiledRule in oldRuleSet.compiledRules:
+            if compiledRule.metricLabels not in labels:
+                for metric in metrics.ruleMetrics:
+                    metric.remove(compiledRule.metricLabels)
+
+    def topicCacheInfo(self):
+        info = self._ruleSet.matchTopic.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'hit_rate': info.hits / lookups if lookups > 0 else 0.0,
+            'size': info.currsize,
+            'max_size': info.maxsize,
+        }
+
+    def _startWorkers(self, config):
+        # Load worker settings
+        workersConfig = config.get("workers", None) or {}
+
+        self.threads = max(1, workersConfig.get("threads", RuleHandler.threads))
+        self.processes = workersConfig.get("processes", RuleHandler.processes)
+        self.processWindow = workersConfig.get("process_window", RuleHandler.processWindow) * max(1, self.processes)
+
+        if self.processes > 0:
+            # Rules with parsers are evaluated in worker processes, which compile their own copy of the rules
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_initProcess,
+                initargs=(self._ruleSet.generation, self._ruleSet.rules)
+                )
+
+        if self.threads == 1:
+            self._startThread(self._queueHandler, "ruleHandlerQueueHandler", self._mqtt.getQueue())
+        else:
+            # Messages are sharded by topic, so messages of the same topic are handled in order
+            self._shardQueues = [queue.Queue() for _ in range(self.threads)]
+            for index, shardQueue in enumerate(self._shardQueues):
+                self._startThread(self._queueHandler, f"ruleHandler{index}", shardQueue)
+            self._startThread(self._dispatcher, "ruleHandlerDispatcher")
+
+        self._startThread(self._stageCollector, "ruleHandlerStages")
+
+    def _startThread(self, target, name, *args):
+        thread = threading.Thread(target=target, name=name, args=args)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _stageCollector(self):
+        while not self._stopEvent.wait(1.0):
             try:
-                msg = self._mqtt.getQueue().get()
-                if msg is None:
-                    self._mqtt.getQueue().task_done()
-                    continue
-
-                logging.debug("MQTT message: topic="+msg.topic+" payload="+msg.payload.decode('utf-8')+" qos="+str(msg.qos)+" retain="+str(msg.retain))
-                handledCounter = 0
-
-                for normalizedTopic, rules in self._normalizedTopics.items():
-                    if mqttClient.topic_matches_sub(normalizedTopic, msg.topic):
-                        # Message matches normalized topic
-                        for rule in rules:
-                            topicObject = rule['topicObject']
-                            # Handle message for all registered topics for this normalized topic
-
-                            retain = rule['retain'] if ('retain' in rule) else False
-                            if msg.retain and not retain:
-                                logging.debug(f"Ignore retained message for topic '{msg.topic}'")
-                                continue
-
-                            matches = topicObject.parse(msg.topic)
-
-                            if matches is not None:
-                                db_inserts = []
-
-                                # primary insert
-                                db_insert = {
-                                    'fields': {},
-                                    'tags': {}
-                                }
-
-                                if ('payload' in rule):
-                                    name = rule['payload'].get('name', 'payload')
-
-                                    if 'parser' in rule['payload']:
-                                        try:
-                                            locals_ = {'payload': json.loads(msg.payload.decode("UTF-8"))}
-                                        except json.decoder.JSONDecodeError:
-                                            locals_ = {
-                                                'payload': msg.payload.decode("UTF-8")
-                                            }
-                                        locals_['tokens'] = {tokenName: tokenValue for tokenName, tokenValue in matches.items()}
-
-                                        exec(rule['payload']['parser'], {}, locals_)
-
-                                        for key in ['fields', 'tags', 'measurement']:
-                                            if key in locals_:
-                                                db_insert[key] = locals_[key]
-
-                                        if 'inserts' in locals_:
-                                            if isinstance(locals_['inserts'], list):
-                                                db_inserts += locals_['inserts']
-                                            else:
-                                                raise TypeError("inserts must be of type list")
-
-                                    if rule['payload'].get('field', False):
-                                        db_insert['fields'][name] = self._convertToType(msg.payload.decode("UTF-8"), rule['payload'].get('type', None), rule['payload'].get('json', None))
-
-                                    # if ('tag' in rule['payload']) and (rule['payload']['tag'] == True):
-                                    #     db_insert['fields'][name] = self._convertToType(msg.payload.decode("UTF-8"), 'string')
-
-                                if ('fields' in rule) and (rule['fields'] is not None):
-                                    for fieldName, fieldValue in rule['fields'].items():
-                                        db_insert['tag'][fieldName] = fieldValue
-
-                                if ('tags' in rule) and (rule['tags'] is not None):
-                                    for tagName, tagValue in rule['tags'].items():
-                                        db_insert['tags'][tagName] = tagValue
-
-                                if rule.get('measurement', None) is not None:
-                                    db_insert['measurement'] = self._convertToType(rule['measurement'], 'string')
+                self.collectStages()
+            except Exception as e:
+                logging.error(f'Error while collecting aggregated points: {type(e).__name__}: {e}')
+
+    def _dispatcher(self):
+        logging.info("Starting dispatcher ...")
+        mqttQueue = self._mqtt.getQueue()
+        while True:
+            msg = mqttQueue.get()
+            if msg is None:
+                mqttQueue.task_done()
+                if self._stopEvent.is_set():
+                    break
+                continue
 
-                                for tokenName, tokenValue in matches.items():
-                                    #print(rule.get('tokens', None))
+            # The shard worker marks the message as done in the MQTT queue
+            self._shardQueues[hash(msg.topic) % self.threads].put(msg)
 
-                                    if tokenName in rule.get('tokens', []):
-                                        tokenConfig = rule['tokens'][tokenName]
-                                        field_name = tokenConfig.get('field_name', tokenName)
-                                        tag_name = tokenConfig.get('tag_name', tokenName)
+        for shardQueue in self._shardQueues:
+            shardQueue.put(None)
 
-                                        if tokenConfig.get('field', False):
-                                            db_insert['fields'].update({field_name: str(tokenValue)})
+    def _queueHandler(self, queue_):
+        logging.info("Starting Queue handler ...")
+        if self._executor is not None:
+            return self._pipelinedQueueHandler(queue_)
+
+        mqttQueue = self._mqtt.getQueue()
+        while True:
+            msg = queue_.get()
+            if msg is None:
+                if queue_ is mqttQueue:
+                    mqttQueue.task_done()
+                    if not self._stopEvent.is_set():
+                        continue
+                break
 
-                                        if tokenConfig.get('field_map', {}) != {}:
-                                            db_insert['fields'].update({field_name: str(tokenConfig['field_map'][tokenValue])})
+            try:
+                self.handleMessage(msg)
+            except Exception as e:
+                logging.error(f'Error while sending from mqtt to db: {type(e).__name__}: {e}')
+            finally:
+                mqttQueue.task_done()
 
-                                        if tokenConfig.get('tag', False):
-                                            db_insert['tags'].update({tag_name: str(tokenValue)})
+    def _pipelinedQueueHandler(self, queue_):
+        mqttQueue = self._mqtt.getQueue()
 
-                                        if tokenConfig.get('tag_map', {}) != {}:
-                                            db_insert['tags'].update({tag_name: str(tokenConfig['tag_map'][tokenValue])})
+        # Messages with rules evaluated in the worker processes are submitted without waiting for the
+        # results, so several of them are in the processes at once. They are completed in order.
+        pending = collections.deque()
+        while True:
+            try:
+                msg = queue_.get(block=len(pending) == 0)
+            except queue.Empty:
+                self._completeMessage(*pending.popleft())
+                continue
 
-                                        if tokenConfig.get('measurement', False):
-                                            db_insert['measurement'] = tokenValue
+            if msg is None:
+                if queue_ is mqttQueue:
+                    mqttQueue.task_done()
+                    if not self._stopEvent.is_set():
+                        continue
+                break
 
-                                        if tokenConfig.get('measurement_map', {}) != {}:
-                                            db_insert['measurement'] = str(tokenConfig['measurement_map'][tokenValue])
+            try:
+                matched = self._matchMessage(msg)
+                if matched is not None:
+                    ruleSet, matches, payload_ = matched
+                    try:
+                        # Rules evaluated in the worker processes are submitted right away
+                        futures = [
+                            self._submitToProcess(ruleSet, compiledRule, msg) if compiledRule.cpuBound else None
+                            for compiledRule, _ in matches
+                            ]
+                    except BaseException:
+                        ruleSet.release()
+                        raise
+            except Exception as e:
+                logging.error(f'Error while sending from mqtt to db: {type(e).__name__}: {e}')
+                matched = None
 
+            if matched is None:
+                mqttQueue.task_done()
+                continue
 
-                                # Check db_insert
-                                if (len(db_insert['fields']) > 0) and (len(db_insert['tags']) > 0):
-                                    if 'measurement' not in db_insert:
-                                        logging.error(f'No measurement for rule {topicObject.topic}: {db_insert}')
+            pending.append((msg, ruleSet, matches, payload_, futures))
+            while (len(pending) > 0) and ((len(pending) > self.processWindow) or _ready(pending[0][4])):
+                self._completeMessage(*pending.popleft())
+
+        while len(pending) > 0:
+            self._completeMessage(*pending.popleft())
+
+    def _completeMessage(self, msg, ruleSet, matches, payload_, futures):
+        try:
+            self._applyRules(msg, ruleSet, matches, payload_, futures)
+        except Exception as e:
+            logging.error(f'Error while sending from mqtt to db: {type(e).__name__}: {e}')
+        finally:
+            ruleSet.release()
+            self._mqtt.getQueue().task_done()
+
+    def handleMessage(self, msg):
+        matched = self._matchMessage(msg)
+        if matched is not None:
+            ruleSet, matches, payload_ = matched
+            try:
+                futures = None
+                if self._executor is not None:
+                    futures = [
+                        self._submitToProcess(ruleSet, compiledRule, msg) if compiledRule.cpuBound else None
+                        for compiledRule, _ in matches
+                        ]
+                self._applyRules(msg, ruleSet, matches, payload_, futures)
+            finally:
+                ruleSet.release()
+
+    def _matchMessage(self, msg):
+        """
+            Returns the rule set, the matching rules and the payload of the
+            message, or None for skipped messages. The rule set is acquired
+            and must be released once the message is handled.
+        """
+        ruleSet = self._acquireRuleSet()
+        try:
+            matched = self._matchRules(msg, ruleSet)
+        except BaseException:
+            ruleSet.release()
+            raise
+
+        if matched is None:
+            ruleSet.release()
+        return matched
+
+    def _acquireRuleSet(self):
+        # The rules may be swapped by a reload at any time, so they are looked up once per message.
+        # swapRules() waits until the old rules are released by all messages.
+        while True:
+            ruleSet = self._ruleSet
+            ruleSet.acquire()
+            if ruleSet is self._ruleSet:
+                return ruleSet
+            ruleSet.release()
+
+    def _matchRules(self, msg, ruleSet):
+        if metrics.enabled:
+            # paho stamps messages with time.monotonic() when they are received
+            metrics.queueWait.observe(time.monotonic() - msg.timestamp)
+
+        topic_ = msg.topic
+
+        if msg.retain:
+            # The broker sends all retained messages again on every (re)connect. They
+            # are filtered before matching and the ones already handled are skipped.
+            if (self._retainCache is not None) and self._retainCache.seen(topic_, msg.payload):
+                self._skipRetained()
+                return None
+
+            matches = ruleSet.matchRetained(topic_)
+            if len(matches) == 0:
+                if self._retainCache is not None:
+                    self._retainCache.add(topic_, msg.payload)
+                self._skipRetained()
+                return None
+        else:
+            matches = ruleSet.matchTopic(topic_)
 
-                                    db_inserts.append(db_insert)
+        # Decoded and parsed at most once for all rules
+        payload_ = payload.Payload(msg.payload)
 
-                                if handledCounter > 0:
-                                    logging.warning(f"Message for topic '{msg.topic}' already handled {handledCounter} times")
+        # Decoding the payload for the log is only done when it is logged
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("MQTT message: topic=%s payload=%s qos=%s retain=%s", msg.topic, payload_.text, msg.qos, msg.retain)
 
-                                handledCounter += 1
+        return ruleSet, matches, payload_
 
-                                logging.debug(f'Send to db: {db_insert}')
-                                try:
-                                    if not rule.get('disable_write', False):
-                                        self._influxdb.write(db_inserts)
-                                    else:
-                                        logging.info(f"Not writing: {db_inserts}")
-                                except Exception as e:
-                                    logging.error(f'Could not insert into db: {e}')
+    def _applyRules(self, msg, ruleSet, matches, payload_, futures=None):
+        """
+            Evaluates the rules, takes the results of the rules submitted to
+            the worker processes from futures and writes the points.
+        """
+        topic_ = msg.topic
+        handledCounter = 0
 
-                self._mqtt.getQueue().task_done()
-            except Exception as e:
-                logging.error(f'Error while sending from mqtt to db: {type(e).__name__}: {e}')
+        # Handle message for all rules accepting the topic
+        for index, (compiledRule, tokens) in enumerate(matches):
+            if metrics.enabled:
+                start = time.perf_counter()
 
-    def _parseConfiguration(self, config):
-        self._topicObjects = []
-        self._normalizedTopics = {}
+            try:
+                if (futures is not None) and (futures[index] is not None):
+                    db_inserts = self._processResult(ruleSet, compiledRule, msg, futures[index])
+                else:
+                    db_inserts = compiledRule.applyTokens(tokens, payload_, msg.received)
+            except Exception:
+                if metrics.enabled:
+                    metrics.ruleParseFailures.inc(labels=compiledRule.metricLabels)
+                raise
+
+            if metrics.enabled:
+                metrics.ruleEvaluation.observe(time.perf_counter() - start, labels=compiledRule.metricLabels)
+
+            if db_inserts is not None:
+                if metrics.enabled:
+                    metrics.ruleMatches.inc(labels=compiledRule.metricLabels)
+                    metrics.rulePoints.inc(len(db_inserts), labels=compiledRule.metricLabels)
+
+                if handledCounter > 0:
+                    logging.warning(f"Message for topic '{topic_}' already handled {handledCounter} times")
+
+                handledCounter += 1
+
+                if len(compiledRule.stages) > 0:
+                    db_inserts = aggregate.runStages(compiledRule.stages, db_inserts, msg.received / 1e9)
+                    if len(db_inserts) == 0:
+                        continue
+
+                self._write(compiledRule, db_inserts)
+
+        if msg.retain and (self._retainCache is not None):
+            self._retainCache.add(topic_, msg.payload)
+
+    def _skipRetained(self):
+        # Not logged, there are tens of thousands of them after a reconnect
+        if metrics.enabled:
+            metrics.retainedSkipped.inc()
+
+    def _write(self, compiledRule, db_inserts):
+        logging.debug('Send to db: %s', db_inserts)
+        try:
+            if not compiledRule.disableWrite:
+                self._influxdb.write(db_inserts)
+            else:
+                logging.info(f"Not writing: {db_inserts}")
+        except Exception as e:
+            if metrics.enabled:
+                metrics.ruleWriteErrors.inc(len(db_inserts), labels=compiledRule.metricLabels)
+            logging.error(f'Could not insert into db: {e}')
+
+    def _submitToProcess(self, ruleSet, compiledRule, msg):
+        return self._executor.submit(_applyInProcess, ruleSet.generation, compiledRule.index, msg.topic, msg.payload, msg.received)
+
+    def _processResult(self, ruleSet, compiledRule, msg, future):
+        try:
+            db_inserts = future.result()
+        except _UnknownRules:
+            # The worker process still has other rules, send the current ones once
+            future = self._executor.submit(
+                _applyInProcess, ruleSet.generation, compiledRule.index, msg.topic, msg.payload, msg.received, ruleSet.rules)
+            db_inserts = future.result()
+
+        # Types are learned here from the values of all worker processes
+        return compiledRule.convertDeferred(db_inserts)
+
+    def _subcribeMqttTopics(self, normalizedTopics):
+        # All topics at once, so they are sent in few SUBSCRIBE packets
+        normalizedTopics = list(normalizedTopics)
+        if len(normalizedTopics) > 0:
+            self._mqtt.subscribe(normalizedTopics)
+
+class RuleSet:
+    """
+        The compiled rules of a configuration. A RuleSet is not modified once
+        it is built, so a reload builds a new one and RuleHandler swaps it in
+        with a single assignment. Messages acquire the RuleSet while they are
+        handled, so the swap can wait until the old one is no longer used.
+    """
+
+    def __init__(self, config, generation=0):
+        self.generation = generation
+        self._users = 0
+        self._usersLock = threading.Lock()
+        self._retired = False
+        self._unused = threading.Event()
+        self.normalizedTopics = {}
+        self.compiledRules = []
+        self.stagedRules = []
+        self.topicTrie = topic.TopicTrie()
+        # Only the rules accepting retained messages
+        self.retainTrie = topic.TopicTrie()
 
         # Load Rules
-        self._rules = config.get("rules", None)
+        self.rules = config.get("rules", None)
 
-        if self._rules is None:
+        if self.rules is None:
             raise ValueError("No configuration section for Rules")
 
-        for index, rule in enumerate(self._rules):
-            if 'topic' not in rule:
+        for index, ruleConfig in enumerate(self.rules):
+            if 'topic' not in ruleConfig:
                 logging.error("No 'topic' for rule #%u" % (index))
                 continue
 
-            # Create topic object
-            topicObject = topic.Topic(rule['topic'])
-            rule['topicObject'] = topicObject
-
-            # Add topic to list of normalized Topics
-            if topicObject.normalized not in self._normalizedTopics:
-                self._normalizedTopics[topicObject.normalized] = []
-
-            self._normalizedTopics[topicObject.normalized].append(rule)
-
-            # Add tokens to topic
-            if ('tokens' in rule) and isinstance(rule['tokens'], dict):
-                for tokenName, tokenData in rule['tokens'].items():
-                    if 'rule' in tokenData:
-                        topicObject.addTokenRule(tokenName, tokenData['rule'])
-
-    def _subcribeMqttTopics(self):
-        for normalizedTopic in self._normalizedTopics:
-            self._mqtt.subscribe(normalizedTopic)
-
-    def _convertToType(self, value, type_ = None, json_ = None):
-        if type_ is None:
-            if re.match(r"^\d+?\.?\d+?", value):
-                return self._convertToType(value, 'float')
-            elif re.match(r"^(true|True|TRUE|false|False|FALSE)$", value):
-                return self._convertToType(value, 'bool')
-            else:
-                return self._convertType(value, 'string')
-        elif type_ == 'int':
-            return int(value)
-        elif type_ == 'float':
-            return float(value)
-        elif type_ == 'bool':
-            return bool(value)
-        elif type_ == 'string':
-            return str(value)
-        elif type_ == 'json':
-            json_splitted = json_.split(',')
-            ret = json.loads(value)
-            for i in json_splitted:
-                ret = ret[i]
-            return str(ret)
-        else:
-            raise Exception("Invalid type '%s'" % type_)
+            compiledRule = rule.Rule(ruleConfig, index)
+            self.compiledRules.append(compiledRule)
+            if len(compiledRule.stages) > 0:
+                self.stagedRules.append(compiledRule)
+
+            # Add rule to list of normalized Topics
+            if compiledRule.normalized not in self.normalizedTopics:
+                self.normalizedTopics[compiledRule.normalized] = []
+                self.topicTrie.add(compiledRule.normalized, self.normalizedTopics[compiledRule.normalized])
+
+            self.normalizedTopics[compiledRule.normalized].append(compiledRule)
+
+        for normalizedTopic, rules in self.normalizedTopics.items():
+            retainRules = [compiledRule for compiledRule in rules if compiledRule.retain]
+            if len(retainRules) > 0:
+                self.retainTrie.add(normalizedTopic, retainRules)
+
+        # Devices publish on a stable set of topics, so matching and parsing a
+        # topic is cached. Every RuleSet has its own cache.
+        self.topicCacheSize = config.get("topic_cache_size", RuleHandler.topicCacheSize)
+        self.matchTopic = functools.lru_cache(maxsize=self.topicCacheSize)(functools.partial(self._resolveTopic, self.topicTrie))
+
+        # Retained messages are not cached, the tens of thousands of topics
+        # replayed on a reconnect would evict the topics of live messages
+        self.matchRetained = functools.partial(self._resolveTopic, self.retainTrie)
+
+    def acquire(self):
+        with self._usersLock:
+            self._users += 1
+
+    def release(self):
+        with self._usersLock:
+            self._users -= 1
+            if self._retired and (self._users == 0):
+                self._unused.set()
+
+    def waitUnused(self):
+        """
+            Waits until the messages which acquired the RuleSet released it.
+            Called once the RuleSet is replaced.
+        """
+        with self._usersLock:
+            self._retired = True
+            if self._users == 0:
+                return
+        self._unused.wait()
+
+    def _resolveTopic(self, trie, topic_):
+        """
+            Returns the rules of the trie accepting the topic together with
+            the parsed tokens of the topic for each rule.
+        """
+        resolved = []
+        for rules in trie.match(topic_):
+            for compiledRule in rules:
+                tokens = compiledRule.topicObject.parse(topic_)
+                if tokens is not None:
+                    resolved.append((compiledRule, topic.freezeTokens(tokens)))
+        return tuple(resolved)
+
+class RetainCache:
+    """
+        Remembers a hash of the payload of the last retained message handled
+        for a topic, so the same retained message is skipped when the broker
+        sends it again after a reconnect. Holds at most maxSize topics, the
+        least recently handled are forgotten first.
+    """
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+        self._hashes = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def seen(self, topic_, payload_):
+        with self._lock:
+            return self._hashes.get(topic_) == hash(payload_)
+
+    def add(self, topic_, payload_):
+        with self._lock:
+            self._hashes[topic_] = hash(payload_)
+            self._hashes.move_to_end(topic_)
+            if len(self._hashes) > self.maxSize:
+                self._hashes.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._hashes.clear()
+
+def _ready(futures):
+    return all((future is None) or future.done() for future in futures)
+
+# Rules of a worker process, indexed like the rules of the configuration
+_processRules = {}
+_processGeneration = None
+
+class _UnknownRules(Exception):
+    pass
+
+def _initProcess(generation, rulesConfig):
+    global _processRules, _processGeneration
+
+    _processRules = {}
+    for index, ruleConfig in enumerate(rulesConfig):
+        if 'topic' in ruleConfig:
+            _processRules[index] = rule.Rule(ruleConfig, index, deferLearning=True)
+    _processGeneration = generation
+
+def _applyInProcess(generation, index, topic, raw, received, rulesConfig=None):
+    if generation != _processGeneration:
+        if rulesConfig is None:
+            raise _UnknownRules()
+        _initProcess(generation, rulesConfig)
+
+    return _processRules[index].apply(topic, payload.Payload(raw), received)
@@ -0,0 +1,64 @@
+import gzip
+import http.server
+import threading
+import time
+
+class StubInfluxdbHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+
+        with self.server.lock:
+            self.server.active += 1
+            self.server.maxActive = max(self.server.maxActive, self.server.active)
+        time.sleep(self.server.delay)
+
+        with self.server.lock:
+            self.server.active -= 1
+            self.server.requests.append((self.path, self.headers.get('Authorization'), self.client_address))
+            self.server.times.append(time.monotonic())
+            # Injected responses are returned first
+            status, headers = self.server.responses.pop(0) if len(self.server.responses) > 0 else (self.server.status, {})
+            if status // 100 == 2:
+                self.server.lines += body.decode('utf-8').splitlines()
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class StubInfluxdbServer(http.server.ThreadingHTTPServer):
+    """
+        InfluxDB write endpoint for the tests. It answers with status, or
+        first with the (status, headers) of responses, after delay seconds
+        and records the requests and the lines of accepted writes.
+    """
+
+    def __init__(self, status=204, delay=0.0, responses=None):
+        super().__init__(('127.0.0.1', 0), StubInfluxdbHandler)
+        self.status = status
+        self.delay = delay
+        self.responses = list(responses or [])
+        self.lock = threading.Lock()
+        self.requests = []
+        self.times = []
+        self.lines = []
+        self.active = 0
+        self.maxActive = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def paths(self):
+        with self.lock:
+            return [path for path, _, _ in self.requests]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
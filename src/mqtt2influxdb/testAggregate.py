@@ -0,0 +1,81 @@
+import unittest
+
+from mqtt2influxdb import aggregate
+
+def createPoint(value, sensor='a', measurement='temperature'):
+    return {'measurement': measurement, 'tags': {'sensor': sensor}, 'fields': {'value': value}}
+
+class AggregatorTests(unittest.TestCase):
+
+    def testTumblingWindows(self):
+        aggregator = aggregate.Aggregator(10, ['mean', 'min', 'max', 'count'])
+        self.assertEqual(aggregator.add([createPoint(1.0), createPoint(3.0)], now=100.0), [])
+        self.assertEqual(aggregator.add([createPoint(2.0)], now=109.9), [])
+
+        # The first point of the next window closes the previous one
+        self.assertEqual(aggregator.add([createPoint(5.0)], now=110.0), [{
+            'measurement': 'temperature',
+            'tags': {'sensor': 'a'},
+            'fields': {'value_mean': 2.0, 'value_min': 1.0, 'value_max': 3.0, 'value_count': 3},
+            'time': 100 * 10**9,
+        }])
+
+        self.assertEqual(aggregator.collect(now=119.0), [])
+        self.assertEqual([point['fields']['value_mean'] for point in aggregator.collect(now=120.0)], [5.0])
+        self.assertEqual(len(aggregator), 0)
+
+    def testStringsUseLastValue(self):
+        aggregator = aggregate.Aggregator(10, 'mean')
+        aggregator.add([createPoint('on'), createPoint('off')], now=0.0)
+        self.assertEqual(aggregator.flush()[0]['fields'], {'value': 'off'})
+
+    def testMaxSeries(self):
+        aggregator = aggregate.Aggregator(10, 'last', maxSeries=2)
+        self.assertEqual(aggregator.add([createPoint(1, 'a'), createPoint(2, 'b')], now=0.0), [])
+        self.assertEqual(aggregator.add([createPoint(3, 'c')], now=0.0), [
+            {'measurement': 'temperature', 'tags': {'sensor': 'a'}, 'fields': {'value': 1}, 'time': 0},
+        ])
+        self.assertEqual((len(aggregator), aggregator.evicted), (2, 1))
+
+    def testInvalidConfig(self):
+        with self.assertRaises(ValueError):
+            aggregate.createStages({'aggregate': {'window': 10, 'functions': ['median']}}, 0)
+
+        with self.assertRaises(ValueError):
+            aggregate.createStages({'aggregate': {'functions': ['mean']}}, 0)
+
+class DeadbandTests(unittest.TestCase):
+
+    def testThreshold(self):
+        deadband = aggregate.Deadband(threshold=0.5)
+        values = [20.0, 20.3, 20.6, 20.6, 19.9, 'error', 'error', 20.0]
+        written = [deadband.add([createPoint(value)], now=index) for index, value in enumerate(values)]
+        self.assertEqual([points[0]['fields']['value'] for points in written if len(points) > 0], [20.0, 20.6, 19.9, 'error', 20.0])
+        self.assertEqual(deadband.suppressed, 3)
+
+    def testMaxInterval(self):
+        deadband = aggregate.Deadband(maxInterval=60)
+        self.assertEqual(len(deadband.add([createPoint(1)], now=0.0)), 1)
+        self.assertEqual(len(deadband.add([createPoint(1)], now=59.0)), 0)
+        self.assertEqual(len(deadband.add([createPoint(1)], now=60.0)), 1)
+
+    def testStaleSeries(self):
+        deadband = aggregate.Deadband(staleAfter=100, maxSeries=2)
+        deadband.add([createPoint(1, 'a'), createPoint(1, 'b')], now=0.0)
+        deadband.add([createPoint(1, 'c')], now=50.0)
+        self.assertEqual(len(deadband), 2)
+
+        deadband.collect(now=149.0)
+        self.assertEqual(len(deadband), 1)
+
+        # Evicted series are written again
+        self.assertEqual(len(deadband.add([createPoint(1, 'a')], now=150.0)), 1)
+
+    def testAggregateThenDeadband(self):
+        stages = aggregate.createStages({'aggregate': {'window': 10, 'functions': 'max'}, 'deadband': True}, 0)
+        for now in range(30):
+            aggregate.runStages(stages, [createPoint(1.0 if now < 20 else 2.0)], now=now)
+
+        self.assertEqual(aggregate.collectStages(stages, now=30.0), [
+            {'measurement': 'temperature', 'tags': {'sensor': 'a'}, 'fields': {'value': 2.0}, 'time': 20 * 10**9},
+        ])
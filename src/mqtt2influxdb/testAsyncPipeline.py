@@ -0,0 +1,263 @@
+import unittest
+import asyncio
+import contextlib
+import os
+import ssl
+import tempfile
+import unittest.mock
+
+import paho.mqtt.client as mqttClient
+
+from mqtt2influxdb import async_pipeline
+from mqtt2influxdb.rule_handler import RuleHandler
+from mqtt2influxdb.stubInfluxdb import StubInfluxdbServer
+
+class AsyncInfluxdbWriterTests(unittest.IsolatedAsyncioTestCase):
+
+    def createWriter(self, server, **kwargs):
+        writer = async_pipeline.AsyncInfluxdbWriter({'influxdb': {
+            'address': '127.0.0.1',
+            'port': server.server_address[1],
+            'database': 'test',
+            **kwargs,
+        }})
+        writer.connect()
+        return writer
+
+    @contextlib.contextmanager
+    def recordConnections(self):
+        connections = []
+        openConnection = asyncio.open_connection
+        async def recordConnection(*args, **kwargs):
+            connections.append(await openConnection(*args, **kwargs))
+            return connections[-1]
+
+        with unittest.mock.patch('asyncio.open_connection', recordConnection):
+            yield connections
+
+    async def testWrite(self):
+        server = StubInfluxdbServer()
+        self.addCleanup(server.stop)
+
+        writer = self.createWriter(server, flush_interval=0.01)
+        writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': 1.5}}])
+        await asyncio.sleep(0.3)
+        self.assertEqual(server.lines, ['m,t=a value=1.5'])
+        self.assertEqual(server.paths, ['/write?db=test'])
+
+        # The second batch reuses the keep-alive connection
+        writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': 2.5}}])
+        await writer.disconnect()
+        self.assertEqual(server.lines, ['m,t=a value=1.5', 'm,t=a value=2.5'])
+        self.assertEqual(writer.stats.summary()['failed_flushes'], 0)
+
+    async def testInFlightWindow(self):
+        server = StubInfluxdbServer(delay=0.05)
+        self.addCleanup(server.stop)
+
+        writer = self.createWriter(server, batch_size=1, max_in_flight=3)
+        for index in range(12):
+            writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': index}}])
+            await writer.drain()
+        await writer.disconnect()
+
+        self.assertEqual(len(server.lines), 12)
+        self.assertLessEqual(server.maxActive, 3)
+        self.assertGreater(server.maxActive, 1)
+
+    async def testV2(self):
+        server = StubInfluxdbServer()
+        self.addCleanup(server.stop)
+
+        writer = self.createWriter(server, version=2, bucket='sensors', precision='s')
+        writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': 1.5}, 'time': 1700000000123456789}])
+        await writer.disconnect()
+        self.assertEqual(server.lines, ['m,t=a value=1.5 1700000000'])
+        self.assertEqual(server.paths, ['/api/v2/write?bucket=sensors&precision=s'])
+
+    async def testTimeoutClosesConnection(self):
+        server = StubInfluxdbServer(delay=0.5)
+        self.addCleanup(server.stop)
+
+        writer = self.createWriter(server, timeout=0.1, retries=0)
+        with self.recordConnections() as connections:
+            writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': 1.5}}])
+            await writer.disconnect()
+
+        self.assertEqual(writer.stats.summary()['failed_flushes'], 1)
+        self.assertEqual(len(connections), 1)
+        self.assertTrue(connections[0][1].is_closing())
+
+    async def testPoolSize(self):
+        server = StubInfluxdbServer()
+        self.addCleanup(server.stop)
+
+        writer = self.createWriter(server, pool_size=0)
+        with self.recordConnections() as connections:
+            for index in range(3):
+                writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': index}}])
+                writer.flush()
+                await asyncio.wait(writer._tasks)
+            await writer.disconnect()
+
+        # Without idle connections every request opens its own
+        self.assertEqual(len(server.lines), 3)
+        self.assertEqual(len(connections), 3)
+        self.assertTrue(all(streamWriter.is_closing() for _, streamWriter in connections))
+
+    def testSsl(self):
+        writer = async_pipeline.AsyncInfluxdbWriter({'influxdb': {'version': 2, 'bucket': 'b', 'ssl': True, 'token': 'secret'}})
+        self.assertIsInstance(writer._sslContext, ssl.SSLContext)
+        self.assertEqual(writer._sslContext.verify_mode, ssl.CERT_REQUIRED)
+
+    async def testSslHandshake(self):
+        server = StubInfluxdbServer()
+        self.addCleanup(server.stop)
+
+        # The plain HTTP stub fails the TLS handshake, so nothing is sent in the clear
+        writer = self.createWriter(server, version=2, bucket='b', ssl=True, token='secret', retries=0)
+        writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': 1.5}}])
+        await writer.disconnect()
+        self.assertEqual(server.lines, [])
+        self.assertEqual(writer.stats.summary()['failed_flushes'], 1)
+
+    async def testRetry(self):
+        server = StubInfluxdbServer(responses=[(429, {'Retry-After': '0.2'}), (503, {})])
+        self.addCleanup(server.stop)
+
+        writer = self.createWriter(server, retry_backoff=0.01)
+        writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': 1.5}}])
+        await writer.disconnect()
+
+        self.assertEqual(server.lines, ['m,t=a value=1.5'])
+        self.assertEqual(writer.retried, 2)
+        self.assertGreaterEqual(server.times[1] - server.times[0], 0.2)
+        self.assertEqual(writer.stats.summary()['failed_flushes'], 0)
+
+    async def testDiscardNotRetried(self):
+        server = StubInfluxdbServer(status=400)
+        self.addCleanup(server.stop)
+
+        writer = self.createWriter(server, retry_backoff=0.01)
+        writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': 1.5}}])
+        await writer.disconnect()
+
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(writer.retried, 0)
+
+    async def testWriteAheadLog(self):
+        server = StubInfluxdbServer(status=503)
+        self.addCleanup(server.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        writer = self.createWriter(server, batch_size=1, buffer={'path': directory.name})
+        writer._wal.retryInterval = 0.05
+        for index in range(5):
+            writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': index}}])
+            await asyncio.wait(writer._tasks)
+        self.assertFalse(writer._wal.empty)
+
+        # The logged batches are replayed in order before the new ones
+        server.status = 204
+        writer.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': 5}}])
+        for _ in range(100):
+            if len(server.lines) == 6:
+                break
+            await asyncio.sleep(0.05)
+        await writer.disconnect()
+
+        self.assertEqual(server.lines, [f'm,t=a value={index}i' for index in range(6)])
+        self.assertEqual(writer.retried, 0)
+
+class FakeMqtt:
+    def __init__(self):
+        self.topics = []
+
+    def subscribe(self, topics):
+        self.topics += topics
+
+    def unsubscribe(self, topics):
+        self.topics = [topic for topic in self.topics if topic not in topics]
+
+class AsyncMqttTests(unittest.IsolatedAsyncioTestCase):
+
+    def createMqtt(self, overflow):
+        m = async_pipeline.AsyncMqtt({'mqtt': {'queue_size': 2, 'overflow': overflow}})
+        # Set up like by connect(), without a broker
+        m._loop = asyncio.get_running_loop()
+        m._queue = asyncio.Queue()
+        return m
+
+    def receive(self, m, count):
+        for index in range(count):
+            msg = mqttClient.MQTTMessage(topic=f'sensor/{index}'.encode('utf-8'))
+            msg.payload = b'1'
+            m._mqtt_on_message(None, None, msg)
+
+    def queuedTopics(self, m):
+        topics = []
+        while not m.getQueue().empty():
+            topics.append(m.getQueue().get_nowait().topic)
+        return topics
+
+    async def testDropNewest(self):
+        m = self.createMqtt('drop_newest')
+        self.receive(m, 3)
+        self.assertEqual(self.queuedTopics(m), ['sensor/0', 'sensor/1'])
+        self.assertEqual(m.dropped, 1)
+
+    async def testDropOldest(self):
+        m = self.createMqtt('drop_oldest')
+        self.receive(m, 3)
+        self.assertEqual(self.queuedTopics(m), ['sensor/1', 'sensor/2'])
+        self.assertEqual(m.dropped, 1)
+
+    async def testBlock(self):
+        m = self.createMqtt('block')
+        self.receive(m, 2)
+        # The socket is not read until the consumer made space
+        self.assertTrue(m._paused)
+
+        await m.getQueue().get()
+        m.resumeReading()
+        self.assertFalse(m._paused)
+        self.assertEqual(m.dropped, 0)
+
+    def testSpillNotSupported(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spillFile = os.path.join(directory, 'spill')
+            with self.assertRaises(ValueError):
+                async_pipeline.AsyncMqtt({'mqtt': {'queue_size': 2, 'overflow': 'spill', 'spill_file': spillFile}})
+            self.assertFalse(os.path.exists(spillFile))
+
+class ReloadTests(unittest.IsolatedAsyncioTestCase):
+
+    def writeConfig(self, filename, topic, mtime):
+        with open(filename, 'w') as file:
+            file.write(f"rules:\n  - topic: '{topic}'\n    measurement: m\n")
+        os.utime(filename, ns=(mtime, mtime))
+
+    async def testWatch(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        filename = os.path.join(directory.name, 'config.yaml')
+        cacheDirectory = os.path.join(directory.name, 'cache')
+
+        self.writeConfig(filename, 'a/+room', 10**18)
+        config = {'rules': [{'topic': 'a/+room', 'measurement': 'm'}]}
+        rh = RuleHandler(config, FakeMqtt(), None, workers=False)
+        reloader = asyncio.get_running_loop().create_task(
+            async_pipeline._reloadLoop(filename, config, rh, asyncio.Event(), True, cacheDirectory))
+        self.addCleanup(reloader.cancel)
+        # The loop takes the modification time of the first version
+        await asyncio.sleep(0.1)
+
+        self.writeConfig(filename, 'b/+room', 10**18 + 10**9)
+        for _ in range(50):
+            if list(rh._ruleSet.normalizedTopics) == ['b/+']:
+                break
+            await asyncio.sleep(0.1)
+
+        self.assertEqual(list(rh._ruleSet.normalizedTopics), ['b/+'])
+        self.assertEqual(len(os.listdir(cacheDirectory)), 1)
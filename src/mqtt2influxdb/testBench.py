@@ -0,0 +1,52 @@
+import unittest
+import os
+import random
+import tempfile
+
+from mqtt2influxdb import bench
+
+class BenchTests(unittest.TestCase):
+
+    CONFIG = {
+        'mqtt': {'prefix': 'home'},
+        'rules': [
+            {
+                'topic': '+room/+sensor/+quantity',
+                'payload': {'type': 'float', 'name': 'value', 'field': True},
+                'tokens': {'room': {'tag': True}, 'sensor': {'tag': True}, 'quantity': {'measurement': True}},
+            },
+            {
+                'topic': 'zigbee2mqtt/+device',
+                'measurement': 'zigbee',
+                'payload': {'parser': "fields = {'linkquality': payload['linkquality']}\ntags = {'device': tokens['device']}"},
+            },
+        ],
+    }
+
+    def testGeneratedTraffic(self):
+        messages = bench.generateMixed(1000, random.Random(0))
+        report = bench.run(self.CONFIG, messages, encode=True)
+
+        self.assertEqual(report['messages'], 1000)
+        self.assertEqual(report['errors'], 0)
+        self.assertGreater(report['points'], 900)
+        self.assertGreater(report['bytes'], 0)
+        self.assertLessEqual(report['latency_p50'], report['latency_p99'])
+
+    def testCapture(self):
+        messages = bench.generateZigbee(100, random.Random(0))
+        messages.append(bench.createMessage('home/kitchen/sensor1/temperature', b'21.5'))
+        messages.append(bench.createMessage('home/kitchen/sensor1/raw', b'\xff\x00'))
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'capture.jsonl')
+            bench.writeCapture(filename, messages)
+            replayed = bench.readCapture(filename)
+
+        self.assertEqual([(msg.topic, msg.payload, msg.retain) for msg in replayed],
+                         [(msg.topic, msg.payload, msg.retain) for msg in messages])
+
+        # The prefix of the configuration is removed from the topics
+        report = bench.run(self.CONFIG, replayed)
+        states = [msg for msg in messages if not msg.retain and '/' not in msg.topic[len('zigbee2mqtt/'):]]
+        self.assertEqual(report['points'], len(states) + 1)
@@ -0,0 +1,70 @@
+import unittest
+
+from mqtt2influxdb import bulk
+from mqtt2influxdb import payload
+from mqtt2influxdb import rule
+
+RULE = {
+    'topic': 'gateway/+gateway',
+    'measurement': 'sensor',
+    'tokens': {'gateway': {'tag': True}},
+    'bulk': {
+        'json': 'readings',
+        'tags': {'sensor': 'id'},
+        'fields': {'temperature': {'key': 't', 'type': 'float'}, 'battery': 'b'},
+        'time': 'ts',
+        'unit': 'ms',
+    },
+}
+
+def apply(raw, ruleConfig=RULE):
+    return rule.Rule(ruleConfig, 0).apply('gateway/gw1', payload.Payload(raw.encode('utf-8')), 5)
+
+class BulkPayloadTests(unittest.TestCase):
+
+    def testRows(self):
+        raw = '{"readings": [{"id": "s1", "t": 21, "ts": 1700000000000}, {"id": "s2", "t": 19.5, "b": 90}, {"id": "s3"}, 7]}'
+        self.assertEqual(apply(raw), [
+            {'measurement': 'sensor', 'tags': {'gateway': 'gw1', 'sensor': 's1'},
+             'fields': {'temperature': 21.0}, 'time': 1700000000000000000},
+            {'measurement': 'sensor', 'tags': {'gateway': 'gw1', 'sensor': 's2'},
+             'fields': {'temperature': 19.5, 'battery': 90}, 'time': 5},
+        ])
+
+    def testColumns(self):
+        self.assertEqual(apply('{"readings": {"id": ["s1", null], "t": [21, 19.5], "b": [80, null], "ts": [1700000000000, 1.5]}}'), [
+            {'measurement': 'sensor', 'tags': {'gateway': 'gw1', 'sensor': 's1'},
+             'fields': {'temperature': 21.0, 'battery': 80}, 'time': 1700000000000000000},
+            {'measurement': 'sensor', 'tags': {'gateway': 'gw1'}, 'fields': {'temperature': 19.5}, 'time': 1500000},
+        ])
+
+    def testMeasurementPerReading(self):
+        ruleConfig = {'topic': 'gateway/+gateway', 'bulk': {'measurement': 'kind', 'fields': {'value': 'v'}}}
+        self.assertEqual(apply('[{"kind": "temperature", "v": 21.5}, {"v": 1}]', ruleConfig), [
+            {'measurement': 'temperature', 'tags': {}, 'fields': {'value': 21.5}, 'time': 5},
+            {'tags': {}, 'fields': {'value': 1}, 'time': 5},
+        ])
+
+    def testCasts(self):
+        fields = {'on': {'key': 'on', 'type': 'bool'}, 'count': {'key': 'n', 'type': 'int'}}
+        ruleConfig = {'topic': 'gateway/+gateway', 'measurement': 'm', 'bulk': {'fields': fields}}
+        points = apply('[{"on": "false", "n": 3.0}, {"on": "ON", "n": "4"}, {"on": 0}, {"on": true}]', ruleConfig)
+        self.assertEqual([point['fields'] for point in points], [
+            {'on': False, 'count': 3},
+            {'on': True, 'count': 4},
+            {'on': False},
+            {'on': True},
+        ])
+
+        # Fractional numbers aren't truncated, invalid booleans aren't True
+        for raw in ['[{"n": 2.5}]', '[{"on": "maybe"}]']:
+            with self.assertRaises(ValueError):
+                apply(raw, ruleConfig)
+
+    def testInvalid(self):
+        with self.assertRaises(TypeError):
+            apply('{"readings": 5}')
+
+        for bulkConfig in [{}, {'fields': {}}, {'fields': {'a': {'key': 'a', 'type': 'complex'}}}, {'fields': {'a': 'a'}, 'unit': 'h'}]:
+            with self.assertRaises(ValueError):
+                bulk.createBulk({'bulk': bulkConfig}, 0, rule.TIME_UNITS)
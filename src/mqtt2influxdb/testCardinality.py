@@ -0,0 +1,38 @@
+import unittest
+
+from mqtt2influxdb import cardinality
+
+def createPoint(sensor, room='kitchen'):
+    return {'measurement': 'temperature', 'tags': {'sensor': sensor, 'room': room}, 'fields': {'value': 1.0}}
+
+class SeriesGuardTests(unittest.TestCase):
+
+    def testDrop(self):
+        guard = cardinality.SeriesGuard(2)
+        points = guard.add([createPoint('a'), createPoint('b'), createPoint('c'), createPoint('a')])
+        self.assertEqual([point['tags']['sensor'] for point in points], ['a', 'b', 'a'])
+        self.assertEqual(guard.info(), {'series': 2, 'max_series': 2, 'limited': 1})
+
+    def testOther(self):
+        guard = cardinality.SeriesGuard(1, 'other', tags=['sensor'])
+        points = guard.add([createPoint('a'), createPoint('b'), createPoint('c', 'attic')])
+        self.assertEqual([point['tags'] for point in points], [
+            {'sensor': 'a', 'room': 'kitchen'},
+            {'sensor': 'other', 'room': 'kitchen'},
+            {'sensor': 'other', 'room': 'attic'},
+        ])
+        self.assertEqual((len(guard), guard.limited), (3, 2))
+
+    def testAlert(self):
+        guard = cardinality.SeriesGuard(1, 'alert')
+        with self.assertLogs(level='WARNING'):
+            points = guard.add([createPoint('a'), createPoint('b')])
+        self.assertEqual(len(points), 2)
+        self.assertEqual((len(guard), guard.limited), (1, 1))
+
+    def testInvalidConfig(self):
+        self.assertIsNone(cardinality.createGuard({'topic': 'a'}, 0))
+        with self.assertRaises(ValueError):
+            cardinality.createGuard({'topic': 'a', 'cardinality': {'action': 'drop'}}, 0)
+        with self.assertRaises(ValueError):
+            cardinality.createGuard({'topic': 'a', 'cardinality': {'max_series': 10, 'action': 'ignore'}}, 0)
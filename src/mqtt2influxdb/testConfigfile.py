@@ -0,0 +1,51 @@
+import unittest
+import pathlib
+import tempfile
+
+from mqtt2influxdb import configfile
+
+class ConfigfileTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = pathlib.Path(directory.name)
+        self.configFile = self.directory / 'config.yaml'
+        self.cacheDirectory = self.directory / 'cache'
+
+    def testLoad(self):
+        self.configFile.write_text("rules:\n  - topic: 'a/+b'\n")
+        self.assertEqual(configfile.load(self.configFile), {'rules': [{'topic': 'a/+b'}]})
+        self.assertFalse(self.cacheDirectory.exists())
+
+    def testCache(self):
+        self.configFile.write_text("rules:\n  - topic: 'a/+b'\n")
+        self.assertEqual(configfile.load(self.configFile, self.cacheDirectory), {'rules': [{'topic': 'a/+b'}]})
+        cacheFiles = list(self.cacheDirectory.glob('config-*.pickle'))
+        self.assertEqual(len(cacheFiles), 1)
+        self.assertEqual(configfile.load(self.configFile, self.cacheDirectory), {'rules': [{'topic': 'a/+b'}]})
+
+        # A changed file gets a new cache, the old one is removed
+        self.configFile.write_text("rules:\n  - topic: 'c/+d'\n")
+        self.assertEqual(configfile.load(self.configFile, self.cacheDirectory), {'rules': [{'topic': 'c/+d'}]})
+        self.assertNotEqual(list(self.cacheDirectory.glob('config-*.pickle')), cacheFiles)
+        self.assertEqual(len(list(self.cacheDirectory.glob('config-*.pickle'))), 1)
+
+    def testBrokenCache(self):
+        self.configFile.write_text("rules: []\n")
+        configfile.load(self.configFile, self.cacheDirectory)
+        for cacheFile in self.cacheDirectory.glob('config-*.pickle'):
+            cacheFile.write_bytes(b'broken')
+
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(configfile.load(self.configFile, self.cacheDirectory), {'rules': []})
+        self.assertEqual(configfile.load(self.configFile, self.cacheDirectory), {'rules': []})
+
+    def testRestartWarnings(self):
+        oldConfig = {'outputs': [{'database': 'a'}], 'retain_cache_size': 10, 'rules': []}
+        newConfig = {'outputs': [{'database': 'b'}], 'retain_cache_size': 20, 'rules': [{'topic': 'a/+b'}]}
+        with self.assertLogs(level='WARNING') as logs:
+            configfile.warnRestartSections(oldConfig, newConfig)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("'outputs'", logs.output[0])
+        self.assertIn("'retain_cache_size'", logs.output[1])
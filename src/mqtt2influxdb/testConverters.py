@@ -0,0 +1,49 @@
+import unittest
+
+from mqtt2influxdb import converters
+
+class ConvertersTests(unittest.TestCase):
+
+    INFER_DATA = {
+        '21.5': 21.5,
+        '5': 5.0,
+        '-3': -3.0,
+        '.5': 0.5,
+        '1e3': 1000.0,
+        '12abc': '12abc',
+        '1_000': '1_000',
+        'nan': 'nan',
+        'inf': 'inf',
+        'true': True,
+        'FALSE': False,
+        'ON': 'ON',
+        '': '',
+    }
+
+    def testInferType(self):
+        for value, result in self.INFER_DATA.items():
+            self.assertEqual(converters.inferType(value), result)
+            self.assertIs(type(converters.inferType(value)), type(result))
+
+    def testTypes(self):
+        self.assertEqual(converters.getConverter('int')('42'), 42)
+        self.assertEqual(converters.getConverter('float')('42'), 42.0)
+        self.assertEqual(converters.getConverter('bool')('false'), False)
+        self.assertEqual(converters.getConverter('bool')('On'), True)
+        self.assertEqual(converters.getConverter('string')('42'), '42')
+
+        with self.assertRaises(ValueError):
+            converters.getConverter('bool')('maybe')
+
+        with self.assertRaises(ValueError):
+            converters.getConverter('complex')
+
+    def testLearnedConverter(self):
+        converter = converters.getConverter(None, learn=3)
+        self.assertEqual([converter(value) for value in ['1', '2', 'x']], [1.0, 2.0, 'x'])
+        self.assertIs(converter.type_, float)
+
+        self.assertEqual(converter('3'), 3.0)
+        self.assertIs(converter('y'), converters.SKIP)
+        self.assertIs(converter('nan'), converters.SKIP)
+        self.assertEqual(converter.skipped, 2)
@@ -0,0 +1,331 @@
+import unittest
+import gzip
+import threading
+import time
+
+from influxdb.line_protocol import make_lines
+
+from mqtt2influxdb import influxdb_
+from mqtt2influxdb.stubInfluxdb import StubInfluxdbServer
+
+class FakePost:
+    """
+        Replaces the _post() of a backend and records the written batches.
+    """
+
+    def __init__(self, delay=0.0):
+        self.batches = []
+        self.delay = delay
+
+    def __call__(self, body, headers):
+        time.sleep(self.delay)
+        if headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.batches.append(body.decode('utf-8').splitlines())
+        return 204, b'', None
+
+class InfluxdbBatchTests(unittest.TestCase):
+
+    POINT = {'measurement': 'temperature', 'tags': {'room': 'kitchen'}, 'fields': {'value': 21.5}}
+
+    def createInfluxdb(self, **kwargs):
+        config = {'influxdb': {'database': 'test', **kwargs}}
+        db = influxdb_.Influxdb(config)
+        db.connect()
+        db._backend._post = FakePost()
+        return db
+
+    def testFlushOnPointCount(self):
+        db = self.createInfluxdb(batch_size=3, flush_interval=60)
+        db.write([self.POINT, self.POINT])
+        time.sleep(0.1)
+        self.assertEqual(db._backend._post.batches, [])
+
+        db.write([self.POINT])
+        time.sleep(0.1)
+        self.assertEqual(db._backend._post.batches, [['temperature,room=kitchen value=21.5'] * 3])
+        db.disconnect()
+
+    def testFlushOnBytes(self):
+        db = self.createInfluxdb(batch_bytes=10, flush_interval=60)
+        db.write([self.POINT])
+        time.sleep(0.1)
+        self.assertEqual(len(db._backend._post.batches), 1)
+        db.disconnect()
+
+    def testFlushOnDeadline(self):
+        db = self.createInfluxdb(flush_interval=0.05)
+        db.write([self.POINT])
+        time.sleep(0.3)
+        self.assertEqual(len(db._backend._post.batches), 1)
+        db.disconnect()
+
+    def testPrecision(self):
+        db = self.createInfluxdb(precision='s', flush_interval=60)
+        client = db._backend._post
+        db.write([{**self.POINT, 'time': 1700000000123456789}])
+        db.disconnect()
+        self.assertEqual(client.batches, [['temperature,room=kitchen value=21.5 1700000000']])
+        self.assertEqual(db._backend._path, '/write?db=test&precision=s')
+
+    def testFlushOnDisconnect(self):
+        db = self.createInfluxdb(flush_interval=60)
+        client = db._backend._post
+        db.write([self.POINT, self.POINT])
+        db.disconnect()
+        self.assertEqual(len(client.batches), 1)
+
+        summary = db.stats.summary()
+        self.assertEqual(summary['flushes'], 1)
+        self.assertEqual(summary['points'], 2)
+        self.assertEqual(summary['batch_size_histogram']['<=10'], 1)
+
+    def testSlowWritesBoundBatches(self):
+        db = self.createInfluxdb(batch_size=100, max_concurrency=1, max_pending_points=300, flush_interval=0.01)
+        client = db._backend._post = FakePost(delay=0.2)
+
+        pending = []
+        def writeAll():
+            for index in range(100):
+                db.write([{**self.POINT, 'fields': {'value': index}}] * 10)
+                pending.append(len(db._batch))
+        writer = threading.Thread(target=writeAll)
+        writer.start()
+        time.sleep(0.5)
+        # The writer waits for the slow writes
+        self.assertTrue(writer.is_alive())
+        writer.join()
+        db.disconnect()
+
+        self.assertLessEqual(max(pending), 310)
+        self.assertLessEqual(max(len(batch) for batch in client.batches), 100)
+        self.assertEqual(sum(len(batch) for batch in client.batches), 1000)
+
+    def testFlushSplitsBatch(self):
+        db = self.createInfluxdb(batch_size=3, batch_bytes=80, max_concurrency=1, flush_interval=60)
+        client = db._backend._post
+        # Filled directly, so the flush loop doesn't take the lines first
+        with db._batchCondition:
+            db._batch += ['temperature,room=kitchen value=21.5'] * 5 + ['x' * 100, 'm v=1']
+            db._batchBytes += 36 * 5 + 101 + 6
+        db.flush()
+        db.disconnect()
+
+        # 80 bytes hold two 36 byte lines, a larger line is a batch of its own
+        self.assertEqual([len(batch) for batch in client.batches], [2, 2, 1, 1, 1])
+        self.assertEqual(db._batchBytes, 0)
+
+    def testGzip(self):
+        db = self.createInfluxdb(gzip=True, flush_interval=60)
+        client = db._backend._post
+        db.write([self.POINT])
+        db.disconnect()
+        self.assertEqual(client.batches, [['temperature,room=kitchen value=21.5']])
+
+class OutputTests(unittest.TestCase):
+
+    POINT = {'measurement': 'temperature', 'tags': {'room': 'kitchen'}, 'fields': {'value': 21.5}}
+
+    def createServer(self, **kwargs):
+        server = StubInfluxdbServer(**kwargs)
+        self.addCleanup(server.stop)
+        return server
+
+    def outputConfig(self, server, **kwargs):
+        return {'version': 2, 'port': server.server_address[1], 'org': 'home', 'bucket': 'sensors', 'token': 'secret', **kwargs}
+
+    def testV2KeepAlive(self):
+        server = self.createServer()
+        db = influxdb_.createOutput({'influxdb': self.outputConfig(server, precision='ms', gzip=True)})
+        db.connect()
+        for _ in range(3):
+            db.write([self.POINT])
+            db.flush()
+        db.disconnect()
+
+        self.assertEqual(server.lines, ['temperature,room=kitchen value=21.5'] * 3)
+        paths, authorizations, clients = zip(*server.requests)
+        self.assertEqual(set(paths), {'/api/v2/write?bucket=sensors&org=home&precision=ms'})
+        self.assertEqual(set(authorizations), {'Token secret'})
+        # All requests used the same connection
+        self.assertEqual(len(set(clients)), 1)
+
+    def testV2Errors(self):
+        server = self.createServer(status=400)
+        backend = influxdb_.InfluxdbV2Backend(self.outputConfig(server))
+        with self.assertRaises(influxdb_.wal.DiscardBatch):
+            backend.write(b'm v=1\n', False)
+
+        server.status = 503
+        with self.assertRaises(influxdb_.WriteError):
+            backend.write(b'm v=1\n', False)
+        backend.close()
+
+    def testSlowOutputDoesNotBlock(self):
+        fast = self.createServer()
+        slow = self.createServer(delay=1.0)
+        db = influxdb_.createOutput({'outputs': [
+            self.outputConfig(slow, name='longterm', flush_interval=0.01),
+            self.outputConfig(fast, name='recent', flush_interval=0.01),
+        ]})
+        self.assertEqual([output.name for output in db.outputs], ['longterm', 'recent'])
+        db.connect()
+
+        db.write([self.POINT])
+        time.sleep(0.3)
+        db.write([self.POINT])
+        time.sleep(0.3)
+        self.assertEqual(len(fast.lines), 2)
+        self.assertEqual(len(slow.lines), 0)
+
+        db.disconnect()
+        self.assertEqual(len(slow.lines), 2)
+
+    def testStalledOutputDropsPoints(self):
+        fast = self.createServer()
+        stalled = self.createServer(delay=1.0)
+        db = influxdb_.createOutput({'outputs': [
+            self.outputConfig(stalled, name='stalled', batch_size=1, max_pending_points=1, max_concurrency=1, flush_interval=0.01),
+            self.outputConfig(fast, name='fast', flush_interval=0.01),
+        ]})
+        db.connect()
+
+        start = time.monotonic()
+        for _ in range(5):
+            db.write([self.POINT])
+            time.sleep(0.05)
+        self.assertLess(time.monotonic() - start, 0.8)
+
+        stalledOutput, fastOutput = db.outputs
+        self.assertGreater(stalledOutput.dropped, 0)
+        db.disconnect()
+        self.assertEqual(len(fast.lines), 5)
+        self.assertEqual(fastOutput.dropped, 0)
+        self.assertEqual(len(stalled.lines) + stalledOutput.dropped, 5)
+
+    def testRetryAfter(self):
+        server = self.createServer(responses=[(429, {'Retry-After': '0.3'}), (503, {})])
+        db = influxdb_.createOutput({'influxdb': self.outputConfig(server, retry_backoff=0.01)})
+        db.connect()
+        db.write([self.POINT])
+        db.flush()
+
+        self.assertEqual(server.lines, ['temperature,room=kitchen value=21.5'])
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(db._scheduler.retried, 2)
+        self.assertGreaterEqual(server.times[1] - server.times[0], 0.3)
+        db.disconnect()
+        self.assertEqual(db.stats.summary()['failed_flushes'], 0)
+
+    def testV1RetryAfter(self):
+        server = self.createServer(responses=[(429, {'Retry-After': '0.3'})])
+        db = influxdb_.createOutput({'influxdb': {
+            'address': '127.0.0.1', 'port': server.server_address[1], 'database': 'test',
+            'username': 'user', 'password': 'secret', 'retry_backoff': 0.01,
+        }})
+        db.connect()
+        db.write([self.POINT])
+        db.flush()
+        db.disconnect()
+
+        self.assertEqual(server.lines, ['temperature,room=kitchen value=21.5'])
+        self.assertEqual(server.paths, ['/write?db=test'] * 2)
+        self.assertEqual({authorization for _, authorization, _ in server.requests}, {'Basic dXNlcjpzZWNyZXQ='})
+        self.assertGreaterEqual(server.times[1] - server.times[0], 0.3)
+        # Both requests used the same connection
+        self.assertEqual(len({client for _, _, client in server.requests}), 1)
+
+    def testRetriesExhausted(self):
+        server = self.createServer(status=503)
+        db = influxdb_.createOutput({'influxdb': self.outputConfig(server, retries=2, retry_backoff=0.01)})
+        db.connect()
+        db.write([self.POINT])
+        db.disconnect()
+
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(server.lines, [])
+        self.assertEqual(db.stats.summary()['failed_flushes'], 1)
+
+    def testDiscardNotRetried(self):
+        server = self.createServer(status=400)
+        db = influxdb_.createOutput({'influxdb': self.outputConfig(server, retry_backoff=0.01)})
+        db.connect()
+        db.write([self.POINT])
+        db.disconnect()
+
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(db._scheduler.retried, 0)
+
+    def writeBatches(self, db, count):
+        for index in range(count):
+            db.write([{**self.POINT, 'fields': {'value': index}}])
+            db._submitBatch()
+        db.flush()
+
+    def testConcurrentWrites(self):
+        server = self.createServer(delay=0.05)
+        db = influxdb_.createOutput({'influxdb': self.outputConfig(server, max_concurrency=4, flush_interval=60)})
+        db.connect()
+        self.writeBatches(db, 20)
+        db.disconnect()
+
+        self.assertEqual(sorted(server.lines), sorted(f'temperature,room=kitchen value={index}i' for index in range(20)))
+        self.assertGreater(server.maxActive, 1)
+        self.assertLessEqual(server.maxActive, 4)
+        # All writes were fast, the limit grew to the maximum
+        self.assertEqual(db._scheduler.limit, 4)
+        # Connections are pooled
+        self.assertLessEqual(len(set(client for _, _, client in server.requests)), 4)
+
+    def testSlowWritesReduceConcurrency(self):
+        server = self.createServer(delay=0.1)
+        db = influxdb_.createOutput({'influxdb': self.outputConfig(server, max_concurrency=4, latency_target=0.05, flush_interval=60)})
+        db.connect()
+        self.writeBatches(db, 5)
+        db.disconnect()
+
+        self.assertEqual(len(server.lines), 5)
+        self.assertEqual(server.maxActive, 1)
+        self.assertEqual(db._scheduler.limit, 1)
+
+    def testDuplicateOutputNames(self):
+        with self.assertRaises(ValueError):
+            influxdb_.createOutput({'outputs': [{'name': 'a', 'database': 'a'}, {'name': 'a', 'database': 'b'}]})
+
+class LineProtocolEncoderTests(unittest.TestCase):
+
+    TEST_DATA = [
+        (
+            {'measurement': 'temperature', 'tags': {'room': 'kitchen'}, 'fields': {'value': 21.5}},
+            'temperature,room=kitchen value=21.5',
+        ),
+        (
+            {'measurement': 'te mp,x', 'tags': {'z': 'a b', 'a': 'c=d', 'e': ''},
+             'fields': {'v': 1.5, 'i': 3, 's': 'he"l\\lo', 'b': True, 'n': None}},
+            'te\\ mp\\,x,a=c\\=d,z=a\\ b b=True,i=3i,s="he\\"l\\\\lo",v=1.5',
+        ),
+        (
+            {'measurement': 'm', 'tags': {}, 'fields': {'v': 1}, 'time': 1700000000000000000},
+            'm v=1i 1700000000000000000',
+        ),
+    ]
+
+    def testEncode(self):
+        encoder = influxdb_.LineProtocolEncoder()
+        for point, line in self.TEST_DATA:
+            # The second run uses the cached series and field keys
+            self.assertEqual(encoder.encode(point), line)
+            self.assertEqual(encoder.encode(point), line)
+            self.assertEqual(encoder.encode(point), make_lines({'points': [point]}).rstrip('\n'))
+
+    def testPrecision(self):
+        point = {'measurement': 'm', 'tags': {}, 'fields': {'v': 1}, 'time': 1700000000123456789}
+        for precision, time_ in [('s', '1700000000'), ('ms', '1700000000123'), ('us', '1700000000123456'), ('ns', '1700000000123456789')]:
+            self.assertEqual(influxdb_.LineProtocolEncoder(precision=precision).encode(point), 'm v=1i ' + time_)
+
+        with self.assertRaises(ValueError):
+            influxdb_.LineProtocolEncoder(precision='m')
+
+    def testMissingMeasurement(self):
+        with self.assertRaises(ValueError):
+            influxdb_.LineProtocolEncoder().encode({'tags': {'a': 'b'}, 'fields': {'v': 1}})
@@ -0,0 +1,53 @@
+import unittest
+import urllib.request
+
+from mqtt2influxdb import metrics
+
+class MetricsTests(unittest.TestCase):
+
+    def testCounter(self):
+        counter = metrics.Counter("test_total", "Test counter", ('rule',))
+        counter.inc(labels=('1',))
+        counter.inc(2, labels=('1',))
+        counter.inc(labels=('a"b',))
+        self.assertEqual(counter.expose(), [
+            '# HELP test_total Test counter',
+            '# TYPE test_total counter',
+            'test_total{rule="1"} 3',
+            'test_total{rule="a\\"b"} 1',
+        ])
+
+    def testGaugeFunction(self):
+        gauge = metrics.Gauge("test_depth", "Test gauge")
+        gauge.setFunction(lambda: 42)
+        self.assertEqual(gauge.expose()[-1], 'test_depth 42')
+
+    def testCounterFunction(self):
+        counter = metrics.Counter("test_retries_total", "Test counter", ('output',))
+        counter.setFunction(lambda: 7, labels=('influxdb',))
+        self.assertEqual(counter.expose()[-1], 'test_retries_total{output="influxdb"} 7')
+
+    def testHistogram(self):
+        histogram = metrics.Histogram("test_seconds", "Test histogram", buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(histogram.expose()[2:], [
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.55',
+            'test_seconds_count 3',
+        ])
+
+    def testEndpoint(self):
+        metrics.start({'metrics': {'address': '127.0.0.1', 'port': 0}})
+        self.addCleanup(metrics.stop)
+        self.assertTrue(metrics.enabled)
+
+        metrics.mqttMessages.inc()
+        port = metrics._server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            body = response.read().decode('utf-8')
+        self.assertIn('# TYPE mqtt2influxdb_mqtt_messages_total counter', body)
+        self.assertIn('mqtt2influxdb_rule_evaluation_seconds', body)
@@ -0,0 +1,204 @@
+import unittest
+import tempfile
+import pathlib
+import queue
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+import paho.mqtt.client as mqttClient
+
+from mqtt2influxdb import mqtt
+
+def createMessage(value):
+    return mqtt.Message('sensor/value', str(value).encode('utf-8'))
+
+class IngestQueueTests(unittest.TestCase):
+
+    def drain(self, queue_):
+        values = []
+        while not queue_.empty():
+            values.append(int(queue_.get().payload))
+            queue_.task_done()
+        return values
+
+    def testDropNewest(self):
+        queue_ = mqtt.IngestQueue(maxDepth=3, overflow='drop_newest')
+        for value in range(5):
+            queue_.put(createMessage(value))
+        self.assertEqual(queue_.depth, 3)
+        self.assertEqual(queue_.dropped, 2)
+        self.assertEqual(self.drain(queue_), [0, 1, 2])
+
+    def testDropOldest(self):
+        queue_ = mqtt.IngestQueue(maxDepth=3, overflow='drop_oldest')
+        for value in range(5):
+            queue_.put(createMessage(value))
+        self.assertEqual(queue_.dropped, 2)
+        self.assertEqual(self.drain(queue_), [2, 3, 4])
+        queue_.join()
+
+    def testBlock(self):
+        queue_ = mqtt.IngestQueue(maxDepth=1, overflow='block')
+        queue_.put(createMessage(0))
+
+        thread = threading.Thread(target=queue_.put, args=(createMessage(1),))
+        thread.start()
+        time.sleep(0.1)
+        self.assertTrue(thread.is_alive())
+
+        self.assertEqual(int(queue_.get().payload), 0)
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(int(queue_.get().payload), 1)
+
+    def testBlockWithTimeout(self):
+        queue_ = mqtt.IngestQueue(maxDepth=1, overflow='block')
+        queue_.put(createMessage(0))
+        with self.assertRaises(queue.Full):
+            queue_.put_nowait(createMessage(1))
+        with self.assertRaises(queue.Full):
+            queue_.put(createMessage(1), timeout=0.05)
+        self.assertEqual(self.drain(queue_), [0])
+
+    def testSpill(self):
+        with tempfile.TemporaryDirectory() as directory:
+            queue_ = mqtt.IngestQueue(maxDepth=2, overflow='spill', spillFile=pathlib.Path(directory) / 'spill')
+            for value in range(5):
+                queue_.put(createMessage(value))
+            self.assertEqual(queue_.depth, 5)
+            self.assertEqual(queue_.spilled, 3)
+
+            self.assertEqual(int(queue_.get().payload), 0)
+            queue_.put(createMessage(5))
+            self.assertEqual(self.drain(queue_), [1, 2, 3, 4, 5])
+            self.assertEqual(queue_.dropped, 0)
+
+    def testSpillSurvivesRestart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            spillFile = pathlib.Path(directory) / 'spill'
+            queue_ = mqtt.IngestQueue(maxDepth=2, overflow='spill', spillFile=spillFile)
+            for value in range(6):
+                queue_.put(createMessage(value))
+            self.assertEqual([int(queue_.get().payload) for _ in range(3)], [0, 1, 2])
+            queue_.close()
+
+            # The messages which were still spilled are queued again
+            queue_ = mqtt.IngestQueue(maxDepth=2, overflow='spill', spillFile=spillFile)
+            self.assertEqual(queue_.depth, 1)
+            queue_.put(createMessage(6))
+            self.assertEqual(self.drain(queue_), [5, 6])
+            queue_.join()
+            queue_.close()
+
+            self.assertEqual(mqtt.IngestQueue(maxDepth=2, overflow='spill', spillFile=spillFile).depth, 0)
+
+    def testSentinelIsNotDropped(self):
+        queue_ = mqtt.IngestQueue(maxDepth=1, overflow='drop_newest')
+        queue_.put(createMessage(0))
+        queue_.put(None)
+        self.assertEqual(queue_.depth, 2)
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+
+    def subscribe(self, topic):
+        self.calls.append(('subscribe', topic))
+
+    def unsubscribe(self, topic):
+        self.calls.append(('unsubscribe', topic))
+
+class MqttTests(unittest.TestCase):
+
+    def testResubscribeOnConnect(self):
+        m = mqtt.Mqtt({'mqtt': {'prefix': 'home'}})
+        client = FakeClient()
+        m._clients = [client]
+
+        m.subscribe('+room/temperature')
+        m.subscribe('zigbee/+')
+        m.unsubscribe('zigbee/+')
+        client.calls = []
+
+        m._mqtt_on_connect(client, None, {}, 0)
+        self.assertEqual(client.calls, [('subscribe', [('home/+room/temperature', 0)])])
+
+    def testBatchedSubscribe(self):
+        m = mqtt.Mqtt({'mqtt': {'prefix': 'home'}})
+        client = FakeClient()
+        m._clients = [client]
+        m.subscribeBatch = 2
+
+        m.subscribe(['a/+', 'b/+', 'c/+'])
+        m.unsubscribe(['a/+', 'b/+'])
+        self.assertEqual(client.calls, [
+            ('subscribe', [('home/a/+', 0), ('home/b/+', 0)]),
+            ('subscribe', [('home/c/+', 0)]),
+            ('unsubscribe', ['home/a/+', 'home/b/+']),
+        ])
+
+    def testSharedSubscription(self):
+        m = mqtt.Mqtt({'mqtt': {'prefix': 'home', 'share_group': 'mqtt2influxdb', 'clients': 2}})
+        clients = [FakeClient(), FakeClient()]
+        m._clients = clients
+
+        m.subscribe('+room/temperature')
+        for client in clients:
+            self.assertEqual(client.calls, [('subscribe', [('$share/mqtt2influxdb/home/+room/temperature', 0)])])
+
+        # Messages of shared subscriptions have the original topic
+        msg = mqttClient.MQTTMessage(topic=b'home/kitchen/temperature')
+        msg.payload = b'21.5'
+        m._mqtt_on_message(clients[1], None, msg)
+        self.assertEqual(m.getQueue().get().topic, 'kitchen/temperature')
+
+    def testInvalidSharing(self):
+        for mqttConfig in [{'clients': 2}, {'share_group': 'a/b'}, {'protocol': 3}]:
+            with self.assertRaises(ValueError):
+                mqtt.Mqtt({'mqtt': mqttConfig})
+
+@unittest.skipIf(shutil.which('mosquitto') is None, "mosquitto is not installed")
+class MosquittoTests(unittest.TestCase):
+
+    def setUp(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        configFile = pathlib.Path(directory.name) / 'mosquitto.conf'
+        configFile.write_text(f"listener {self.port} 127.0.0.1\nallow_anonymous true\n")
+
+        broker = subprocess.Popen(['mosquitto', '-c', str(configFile)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(broker.wait)
+        self.addCleanup(broker.terminate)
+        time.sleep(0.5)
+
+    def testSharedSubscriptionsDeliverOnce(self):
+        instances = []
+        for protocol in [4, 5]:
+            m = mqtt.Mqtt({'mqtt': {'port': self.port, 'prefix': 'home', 'protocol': protocol, 'share_group': 'test', 'clients': 2}})
+            m.connect()
+            self.addCleanup(m.disconnect)
+            m.subscribe('+room/temperature')
+            instances.append(m)
+        time.sleep(0.5)
+
+        publisher = mqttClient.Client()
+        publisher.connect('127.0.0.1', self.port)
+        publisher.loop_start()
+        for index in range(100):
+            publisher.publish('home/kitchen/temperature', str(index), qos=1).wait_for_publish()
+        publisher.loop_stop()
+        publisher.disconnect()
+        time.sleep(0.5)
+
+        received = []
+        for m in instances:
+            while not m.getQueue().empty():
+                received.append(int(m.getQueue().get().payload))
+        self.assertEqual(sorted(received), list(range(100)))
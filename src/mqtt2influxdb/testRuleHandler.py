@@ -0,0 +1,370 @@
+import unittest
+import queue
+import threading
+
+from mqtt2influxdb import metrics, mqtt
+from mqtt2influxdb.rule_handler import RuleHandler
+
+class FakeMqtt:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.topics = []
+        self.unsubscribed = []
+
+    def getQueue(self):
+        return self.queue
+
+    def subscribe(self, topics):
+        self.topics += topics
+
+    def unsubscribe(self, topics):
+        self.unsubscribed += topics
+
+class FakeInfluxdb:
+    def __init__(self):
+        self.points = []
+        self.times = []
+
+    def write(self, message):
+        # Times are compared separately
+        for point in message:
+            self.times.append(point.pop('time', None))
+        self.points += message
+
+def parseDevice(payload, tokens):
+    return {'measurement': 'device', 'tags': {'device': tokens['device']}, 'fields': {'battery': payload['battery']}}
+
+class RuleHandlerTests(unittest.TestCase):
+
+    RULES = [
+        {
+            'topic': '+room/+sensor/+quantity',
+            'payload': {'type': 'float', 'name': 'value', 'field': True},
+            'tokens': {
+                'room': {'rule': '^(livingroom|kitchen)$', 'tag': True},
+                'sensor': {'tag': True},
+                'quantity': {'measurement': True},
+            },
+        },
+        {
+            'topic': 'zigbee/+device',
+            'payload': {
+                'parser': "measurement = 'zigbee'\ntags = {'device': tokens['device']}\nfields = {'linkquality': payload['linkquality']}",
+            },
+        },
+        {
+            'topic': 'device/+device',
+            'retain': True,
+            'payload': {'parser_function': 'mqtt2influxdb.testRuleHandler.parseDevice'},
+        },
+    ]
+
+    def createRuleHandler(self, rules=None, workers=None):
+        self.mqtt = FakeMqtt()
+        self.influxdb = FakeInfluxdb()
+        self.ruleHandler = RuleHandler({'rules': rules if rules is not None else self.RULES, 'workers': workers}, self.mqtt, self.influxdb)
+        self.addCleanup(self.ruleHandler.finish)
+        return self.ruleHandler
+
+    def publish(self, topic, payload, retain=False, received=None):
+        msg = mqtt.Message(topic, payload.encode('utf-8'), retain=retain, received=received)
+        self.mqtt.queue.put(msg)
+        self.mqtt.queue.join()
+
+    def testSubscribe(self):
+        self.createRuleHandler()
+        self.assertEqual(self.mqtt.topics, ['+/+/+', 'zigbee/+', 'device/+'])
+
+    def testTokens(self):
+        self.createRuleHandler()
+        self.publish('kitchen/sensor1/temperature', '21.5')
+        self.publish('garage/sensor1/temperature', '21.5')
+        self.assertEqual(self.influxdb.points, [
+            {'measurement': 'temperature', 'tags': {'room': 'kitchen', 'sensor': 'sensor1'}, 'fields': {'value': 21.5}},
+        ])
+
+    def testRetain(self):
+        self.createRuleHandler()
+        self.publish('kitchen/sensor1/temperature', '21.5', retain=True)
+        self.publish('device/plug', '{"battery": 97}', retain=True)
+        self.assertEqual(self.influxdb.points, [
+            {'measurement': 'device', 'tags': {'device': 'plug'}, 'fields': {'battery': 97}},
+        ])
+
+    def testRetainedReplay(self):
+        self.createRuleHandler()
+        # The broker sends the retained messages again after a reconnect
+        for _ in range(2):
+            self.publish('device/plug', '{"battery": 97}', retain=True)
+            self.publish('device/lamp', '{"battery": 50}', retain=True)
+            self.publish('kitchen/sensor1/temperature', '21.5', retain=True)
+        self.publish('device/plug', '{"battery": 96}', retain=True)
+        self.publish('device/plug', '{"battery": 96}')
+
+        self.assertEqual([point['fields']['battery'] for point in self.influxdb.points], [97, 50, 96, 96])
+        self.assertEqual(len(self.ruleHandler._retainCache), 3)
+
+    def testRetainedReplayWithLiveTraffic(self):
+        self.createRuleHandler()
+        self.publish('device/plug', '{"battery": 97}', retain=True)
+        # Live messages are delivered without the retain flag and do not replace the retained one
+        self.publish('device/plug', '{"battery": 96}')
+        self.publish('device/plug', '{"battery": 95}')
+        # After a reconnect the broker sends the stale retained value again
+        self.publish('device/plug', '{"battery": 97}', retain=True)
+
+        self.assertEqual([point['fields']['battery'] for point in self.influxdb.points], [97, 96, 95])
+        self.assertEqual(len(self.ruleHandler._retainCache), 1)
+
+    def testParser(self):
+        self.createRuleHandler()
+        self.publish('zigbee/plug', '{"linkquality": 42}')
+        self.assertEqual(self.influxdb.points, [
+            {'measurement': 'zigbee', 'tags': {'device': 'plug'}, 'fields': {'linkquality': 42}},
+        ])
+
+    def testInvalidParser(self):
+        with self.assertRaises(ValueError):
+            self.createRuleHandler([{'topic': 'a/+b', 'payload': {'parser': 'fields = {'}}])
+
+        with self.assertRaises(ValueError):
+            self.createRuleHandler([{'topic': 'a/+b', 'payload': {'parser_function': 'mqtt2influxdb.testRuleHandler.missing'}}])
+
+    def testStaticFieldsAndTags(self):
+        self.createRuleHandler([{
+            'topic': 'meter/+name',
+            'measurement': 'energy',
+            'fields': {'unit': 'kWh'},
+            'tags': {'source': 'meter'},
+            'payload': {'type': 'float', 'field': True, 'name': 'value'},
+            'tokens': {'name': {'tag_name': 'meter', 'tag': True}},
+        }])
+        self.publish('meter/main', '1234.5')
+        self.assertEqual(self.influxdb.points, [
+            {'measurement': 'energy', 'tags': {'source': 'meter', 'meter': 'main'}, 'fields': {'value': 1234.5, 'unit': 'kWh'}},
+        ])
+
+    def testThreadsKeepOrderPerTopic(self):
+        self.createRuleHandler(workers={'threads': 4})
+        for value in range(100):
+            for room in ['livingroom', 'kitchen']:
+                self.mqtt.queue.put(mqtt.Message(f'{room}/sensor1/temperature', str(value).encode('utf-8')))
+        self.ruleHandler.finish()
+
+        for room in ['livingroom', 'kitchen']:
+            values = [point['fields']['value'] for point in self.influxdb.points if point['tags']['room'] == room]
+            self.assertEqual(values, [float(value) for value in range(100)])
+
+    def testProcesses(self):
+        self.createRuleHandler(workers={'threads': 2, 'processes': 1})
+        self.publish('zigbee/plug', '{"linkquality": 42}')
+        self.publish('kitchen/sensor1/temperature', '21.5')
+        self.assertEqual(self.influxdb.points, [
+            {'measurement': 'zigbee', 'tags': {'device': 'plug'}, 'fields': {'linkquality': 42}},
+            {'measurement': 'temperature', 'tags': {'room': 'kitchen', 'sensor': 'sensor1'}, 'fields': {'value': 21.5}},
+        ])
+
+    def testProcessesKeepOrderPerTopic(self):
+        self.createRuleHandler(workers={'threads': 1, 'processes': 2})
+        for value in range(50):
+            for device in ['plug', 'lamp']:
+                self.mqtt.queue.put(mqtt.Message(f'zigbee/{device}', f'{{"linkquality": {value}}}'.encode('utf-8')))
+                self.mqtt.queue.put(mqtt.Message('kitchen/sensor1/temperature', str(value).encode('utf-8')))
+        self.ruleHandler.finish()
+
+        for device in ['plug', 'lamp']:
+            values = [point['fields']['linkquality'] for point in self.influxdb.points if point['tags'].get('device') == device]
+            self.assertEqual(values, list(range(50)))
+        values = [point['fields']['value'] for point in self.influxdb.points if point['measurement'] == 'temperature']
+        self.assertEqual(values, [float(value) for value in range(50) for _ in range(2)])
+
+    def testJsonPath(self):
+        self.createRuleHandler([{
+            'topic': 'zigbee/+device',
+            'measurement': 'temperature',
+            'payload': {'type': 'json', 'json': 'sensor,temperature', 'field': True, 'name': 'value'},
+            'tokens': {'device': {'tag': True}},
+        }, {
+            'topic': 'zigbee/+device',
+            'measurement': 'humidity',
+            'payload': {'type': 'json', 'json': 'sensor,humidity', 'field': True, 'name': 'value'},
+            'tokens': {'device': {'tag': True}},
+        }])
+        self.publish('zigbee/plug', '{"sensor": {"temperature": 21.5, "humidity": 40}}')
+        self.assertEqual(self.influxdb.points, [
+            {'measurement': 'temperature', 'tags': {'device': 'plug'}, 'fields': {'value': '21.5'}},
+            {'measurement': 'humidity', 'tags': {'device': 'plug'}, 'fields': {'value': '40'}},
+        ])
+
+    def testTopicCache(self):
+        ruleHandler = self.createRuleHandler([{
+            'topic': 'sensor/#path',
+            'measurement': 'value',
+            'payload': {'parser': "tags = {'path': '/'.join(tokens['path'])}\ntokens['path'].append('x')\nfields = {'value': payload}"},
+        }])
+        for _ in range(3):
+            self.publish('sensor/a/b', '1')
+        self.publish('sensor/c', '2')
+
+        self.assertEqual([point['tags'] for point in self.influxdb.points], [{'path': 'a/b'}] * 3 + [{'path': 'c'}])
+        info = ruleHandler.topicCacheInfo()
+        self.assertEqual((info['hits'], info['misses'], info['size']), (2, 2, 2))
+
+    def testReload(self):
+        ruleHandler = self.createRuleHandler()
+        self.publish('kitchen/sensor1/temperature', '21.5')
+
+        ruleHandler.reload({'rules': [self.RULES[0], {
+            'topic': 'power/+device',
+            'measurement': 'power',
+            'payload': {'type': 'float', 'name': 'value', 'field': True},
+            'tokens': {'device': {'tag': True}},
+        }]})
+        self.assertEqual(self.mqtt.topics, ['+/+/+', 'zigbee/+', 'device/+', 'power/+'])
+        self.assertEqual(self.mqtt.unsubscribed, ['zigbee/+', 'device/+'])
+
+        self.publish('kitchen/sensor1/temperature', '22.5')
+        self.publish('power/plug', '100')
+        self.assertEqual(self.influxdb.points, [
+            {'measurement': 'temperature', 'tags': {'room': 'kitchen', 'sensor': 'sensor1'}, 'fields': {'value': 21.5}},
+            {'measurement': 'temperature', 'tags': {'room': 'kitchen', 'sensor': 'sensor1'}, 'fields': {'value': 22.5}},
+            {'measurement': 'power', 'tags': {'device': 'plug'}, 'fields': {'value': 100.0}},
+        ])
+        # The lookups before the reload are still counted
+        self.assertEqual(metrics.topicCacheMisses.expose()[-1], 'mqtt2influxdb_topic_cache_misses_total 3')
+
+    def testReloadWaitsForHandledMessages(self):
+        ruleHandler = self.createRuleHandler()
+        written = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        write = self.influxdb.write
+
+        def blockingWrite(message):
+            written.set()
+            release.wait()
+            write(message)
+        self.influxdb.write = blockingWrite
+
+        self.mqtt.queue.put(mqtt.Message('kitchen/sensor1/temperature', b'21.5'))
+        self.assertTrue(written.wait(5))
+
+        # The worker still handles the message with the old rules
+        reload = threading.Thread(target=ruleHandler.reload, args=({'rules': self.RULES[:1]}, ))
+        reload.start()
+        reload.join(0.1)
+        self.assertTrue(reload.is_alive())
+
+        release.set()
+        reload.join(5)
+        self.assertFalse(reload.is_alive())
+        self.mqtt.queue.join()
+        self.assertEqual(len(self.influxdb.points), 1)
+
+    def testReloadRemovesRuleMetrics(self):
+        rules = [{'topic': f'removed{index}/+device', 'measurement': 'value', 'cardinality': {'max_series': 10}} for index in range(2)]
+        ruleHandler = self.createRuleHandler(rules)
+        metrics.ruleMatches.inc(labels=('1', 'removed1/+device'))
+        self.assertIn('removed1', ''.join(metrics.ruleSeries.expose()))
+
+        ruleHandler.reload({'rules': rules[:1]})
+        self.assertIn('mqtt2influxdb_rule_series{rule="0",topic="removed0/+device"} 0', metrics.ruleSeries.expose())
+        self.assertNotIn('removed1', ''.join(metrics.ruleSeries.expose() + metrics.ruleMatches.expose()))
+
+    def testInvalidReloadKeepsRules(self):
+        ruleHandler = self.createRuleHandler()
+        with self.assertRaises(ValueError):
+            ruleHandler.reload({'rules': [{'topic': 'a/+b', 'payload': {'parser': 'fields = ('}}]})
+
+        self.publish('kitchen/sensor1/temperature', '21.5')
+        self.assertEqual(len(self.influxdb.points), 1)
+        self.assertEqual(self.mqtt.unsubscribed, [])
+
+    def testReloadWithProcesses(self):
+        ruleHandler = self.createRuleHandler(workers={'processes': 1})
+        self.publish('zigbee/plug', '{"linkquality": 80}')
+
+        rules = list(self.RULES)
+        rules[1] = {
+            'topic': 'zigbee/+device',
+            'payload': {'parser': "measurement = 'zigbee'\ntags = {'device': tokens['device']}\nfields = {'lqi': payload['linkquality']}"},
+        }
+        ruleHandler.reload({'rules': rules})
+        self.publish('zigbee/plug', '{"linkquality": 90}')
+
+        self.assertEqual([point['fields'] for point in self.influxdb.points], [{'linkquality': 80}, {'lqi': 90}])
+
+    def testLearnedTypeWithProcesses(self):
+        ruleHandler = self.createRuleHandler([{
+            'topic': 'learn/+device',
+            'payload': {'parser': "measurement = 'learn'\ntags = {'device': tokens['device']}", 'field': True, 'name': 'value', 'learn': 2},
+        }], workers={'threads': 1, 'processes': 2})
+        for value in ['1', '2', 'on', '3']:
+            self.publish('learn/plug', value)
+
+        # The type is learned once from the values of both processes
+        converter = ruleHandler._ruleSet.compiledRules[0]._learnedConverter
+        self.assertIs(converter.type_, float)
+        self.assertEqual(converter.skipped, 1)
+        self.assertEqual([point['fields'] for point in self.influxdb.points], [{'value': 1.0}, {'value': 2.0}, {'value': 3.0}])
+
+    def testAggregate(self):
+        ruleHandler = self.createRuleHandler([{
+            'topic': 'power/+device',
+            'measurement': 'power',
+            'payload': {'type': 'float', 'name': 'value', 'field': True},
+            'tokens': {'device': {'tag': True}},
+            'aggregate': {'window': 3600, 'functions': ['mean', 'max']},
+        }])
+        for value in ['100', '200', '600']:
+            self.publish('power/plug', value)
+        self.assertEqual(self.influxdb.points, [])
+
+        ruleHandler.finish()
+        self.assertEqual(len(self.influxdb.points), 1)
+        self.assertEqual(self.influxdb.points[0]['fields'], {'value_mean': 300.0, 'value_max': 600.0})
+
+    def testCardinality(self):
+        ruleHandler = self.createRuleHandler([{
+            'topic': 'power/+device',
+            'measurement': 'power',
+            'payload': {'type': 'float', 'name': 'value', 'field': True},
+            'tokens': {'device': {'tag': True}},
+            'cardinality': {'max_series': 2, 'action': 'other'},
+        }])
+        for device in ['a', 'b', 'c', 'd', 'a']:
+            self.publish(f'power/{device}', '1')
+
+        self.assertEqual([point['tags']['device'] for point in self.influxdb.points], ['a', 'b', 'other', 'other', 'a'])
+        self.assertEqual(ruleHandler.cardinalityInfo(), {'power/+device': {'series': 3, 'max_series': 2, 'limited': 2}})
+
+    def testTimestamps(self):
+        self.createRuleHandler([{
+            'topic': 'sensor/+device',
+            'measurement': 'temperature',
+            'payload': {'type': 'json', 'json': 'temperature', 'field': True, 'name': 'value'},
+            'tokens': {'device': {'tag': True}},
+        }, {
+            'topic': 'sensor/+device',
+            'measurement': 'battery',
+            'timestamp': {'json': 'time', 'unit': 'ms'},
+            'payload': {'type': 'json', 'json': 'battery', 'field': True, 'name': 'value'},
+            'tokens': {'device': {'tag': True}},
+        }, {
+            'topic': 'sensor/+device',
+            'measurement': 'linkquality',
+            'timestamp': False,
+            'payload': {'type': 'json', 'json': 'linkquality', 'field': True, 'name': 'value'},
+            'tokens': {'device': {'tag': True}},
+        }])
+        received = 1700000000123456789
+        self.publish('sensor/a', '{"temperature": 21.5, "battery": 90, "linkquality": 80, "time": 1600000000500}', received=received)
+        self.publish('sensor/b', '{"temperature": 21.5, "battery": 90, "linkquality": 80, "time": "2020-09-13T12:26:40.5Z"}',
+                     received=received)
+        self.publish('sensor/c', '{"temperature": 21.5, "battery": 90, "linkquality": 80}', received=received)
+
+        self.assertEqual(self.influxdb.times, [
+            received, 1600000000500000000, None,
+            received, 1600000000500000000, None,
+            received, received, None,
+        ])
@@ -127,3 +127,27 @@ class TopicTests(unittest.TestCase):
                     for tokenName, tokenData in parseEntry['rules'].items():
                         topicObject.addTokenRule(tokenName, tokenData)
                 self.assertEqual(topicObject.parse(parseEntry['topic']), parseEntry['result'])
+
+class TopicTrieTests(unittest.TestCase):
+
+    FILTERS = ['#', '+', 'a/#', 'a/+', 'a/b', 'a/+/c', '+/+/c', 'a/b/#', '$SYS/#', '/+', 'a//b']
+
+    TEST_DATA = {
+        'a': ['#', '+', 'a/#'],
+        'a/b': ['#', 'a/#', 'a/+', 'a/b', 'a/b/#'],
+        'a/b/c': ['#', 'a/#', 'a/+/c', '+/+/c', 'a/b/#'],
+        'x/y/c': ['#', '+/+/c'],
+        'a//b': ['#', 'a/#', 'a//b'],
+        '/x': ['#', '/+'],
+        '$SYS/broker': ['$SYS/#'],
+    }
+
+    def testMatch(self):
+        trie = topic.TopicTrie()
+        for filter_ in self.FILTERS:
+            trie.add(filter_, filter_)
+
+        self.assertEqual(len(trie), len(self.FILTERS))
+
+        for key, value in self.TEST_DATA.items():
+            self.assertEqual(trie.match(key), value)
@@ -0,0 +1,119 @@
+import pathlib
+import unittest
+import tempfile
+import time
+
+from mqtt2influxdb import influxdb_
+from mqtt2influxdb import wal
+from mqtt2influxdb.stubInfluxdb import StubInfluxdbServer
+
+class WriteAheadLogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def waitFor(self, condition, timeout=5):
+        end = time.monotonic() + timeout
+        while not condition() and time.monotonic() < end:
+            time.sleep(0.01)
+        return condition()
+
+    def testSegmentsAndReplay(self):
+        written = []
+        log = wal.WriteAheadLog(self.directory.name, written.append, segmentSize=100)
+        for index in range(20):
+            log.append([f'm value={index}'])
+        self.assertGreater(len(log), 1)
+
+        log.start()
+        self.assertTrue(self.waitFor(lambda: log.empty))
+        log.stop()
+        self.assertEqual([line for lines in written for line in lines], [f'm value={index}' for index in range(20)])
+
+    def testRecovery(self):
+        log = wal.WriteAheadLog(self.directory.name, None)
+        log.append(['m value=1', 'm value=2'])
+        log.stop()
+
+        written = []
+        log = wal.WriteAheadLog(self.directory.name, written.append)
+        log.start()
+        self.assertTrue(self.waitFor(lambda: log.empty))
+        log.stop()
+        self.assertEqual(written, [['m value=1\nm value=2']])
+
+    def testTimedFsync(self):
+        def fail(lines):
+            raise ConnectionError("down")
+
+        # The replay thread keeps retrying the first segment while a second one is appended
+        log = wal.WriteAheadLog(self.directory.name, fail, fsyncInterval=0.05, retryInterval=10)
+        log.append(['m value=0'])
+        log.start()
+        self.assertTrue(self.waitFor(lambda: log._activeFile is None))
+        log.append(['m value=1'])
+        log.append(['m value=2'])
+        segment = log._activeSegment
+        self.assertTrue(self.waitFor(lambda: segment.stat().st_size == 2 * (8 + 9)))
+        log.stop()
+
+    def testAcknowledgedOffset(self):
+        written = []
+
+        def writeOnce(lines):
+            if len(written) > 0:
+                raise ConnectionError("down")
+            written.extend(lines)
+
+        log = wal.WriteAheadLog(self.directory.name, writeOnce, replayBatchBytes=1, retryInterval=10)
+        for index in range(3):
+            log.append([f'm value={index}'])
+        log.start()
+        self.assertTrue(self.waitFor(lambda: len(written) == 1))
+        log.stop()
+
+        # Only the records which were not written yet are replayed after a restart
+        replayed = []
+        log = wal.WriteAheadLog(self.directory.name, replayed.extend)
+        log.start()
+        self.assertTrue(self.waitFor(lambda: log.empty))
+        log.stop()
+        self.assertEqual(written, ['m value=0'])
+        self.assertEqual(replayed, ['m value=1', 'm value=2'])
+        self.assertEqual(list(pathlib.Path(self.directory.name).iterdir()), [])
+
+    def testMaxSize(self):
+        log = wal.WriteAheadLog(self.directory.name, None, segmentSize=50, maxSize=200)
+        for index in range(100):
+            log.append([f'm value={index}'])
+        self.assertLessEqual(log.size, 250)
+        self.assertGreater(log.droppedSegments, 0)
+        log.stop()
+
+    def testOutage(self):
+        server = StubInfluxdbServer()
+        self.addCleanup(server.stop)
+
+        db = influxdb_.Influxdb({'influxdb': {
+            'address': '127.0.0.1',
+            'port': server.server_address[1],
+            'database': 'test',
+            'flush_interval': 0.01,
+            'buffer': {'path': self.directory.name},
+        }})
+        db.connect()
+        db._wal.retryInterval = 0.05
+
+        server.status = 503
+        for index in range(10):
+            db.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': index}}])
+            db.flush()
+        self.assertFalse(db._wal.empty)
+
+        server.status = 204
+        db.write([{'measurement': 'm', 'tags': {'t': 'a'}, 'fields': {'value': 10}}])
+        self.assertTrue(self.waitFor(lambda: len(server.lines) == 11))
+        db.disconnect()
+
+        self.assertEqual(server.lines, [f'm,t=a value={index}i' for index in range(11)])
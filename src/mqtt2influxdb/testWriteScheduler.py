@@ -0,0 +1,120 @@
+import unittest
+import threading
+import time
+
+from mqtt2influxdb import wal
+from mqtt2influxdb import write_scheduler
+
+class RetryAfterError(Exception):
+    def __init__(self, retryAfter):
+        super().__init__("busy")
+        self.retryAfter = retryAfter
+
+class WriteSchedulerTests(unittest.TestCase):
+
+    def createScheduler(self, **kwargs):
+        scheduler = write_scheduler.WriteScheduler(**{'backoff': 0.01, **kwargs})
+        scheduler.start()
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    def submit(self, scheduler, write):
+        results = []
+        scheduler.submit(write, lambda error, latency: results.append(error))
+        scheduler.join()
+        return results
+
+    def failing(self, errors):
+        calls = []
+        def write():
+            calls.append(time.monotonic())
+            if len(errors) > 0:
+                raise errors.pop(0)
+        return write, calls
+
+    def testRetry(self):
+        scheduler = self.createScheduler(retries=3)
+        write, calls = self.failing([OSError("refused"), OSError("refused")])
+        self.assertEqual(self.submit(scheduler, write), [None])
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(scheduler.retried, 2)
+
+    def testRetriesExhausted(self):
+        scheduler = self.createScheduler(retries=1)
+        error = OSError("refused")
+        write, calls = self.failing([error, error, error])
+        self.assertEqual(self.submit(scheduler, write), [error])
+        self.assertEqual(len(calls), 2)
+
+    def testDiscardBatch(self):
+        scheduler = self.createScheduler(retries=3)
+        error = wal.DiscardBatch("bad points")
+        write, calls = self.failing([error])
+        self.assertEqual(self.submit(scheduler, write), [error])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(scheduler.limit, 1)
+
+    def testRetryAfterPausesWrites(self):
+        scheduler = self.createScheduler(retries=1)
+        write, calls = self.failing([RetryAfterError(0.2)])
+        scheduler.submit(write, lambda error, latency: None)
+        time.sleep(0.05)
+
+        # Other batches wait as well
+        started = []
+        self.submit(scheduler, lambda: started.append(time.monotonic()))
+        self.assertGreaterEqual(started[0] - calls[0], 0.2)
+        self.assertGreaterEqual(calls[1] - calls[0], 0.2)
+
+    def testRetryAfterCapped(self):
+        scheduler = self.createScheduler(retries=1, maxBackoff=0.1)
+        write, calls = self.failing([RetryAfterError(3600)])
+        self.submit(scheduler, write)
+        self.assertLess(calls[1] - calls[0], 1)
+
+    def testAdditiveIncrease(self):
+        scheduler = self.createScheduler(maxConcurrency=8)
+        self.submit(scheduler, lambda: None)
+        self.submit(scheduler, lambda: None)
+        # Slow start adds one per write
+        self.assertEqual(scheduler.limit, 3)
+
+        # After a decrease, one per round of writes
+        scheduler._adjust(False)
+        self.assertEqual(scheduler.limit, 1.5)
+        self.submit(scheduler, lambda: None)
+        self.assertAlmostEqual(scheduler.limit, 1.5 + 1 / 1.5)
+
+        for _ in range(100):
+            self.submit(scheduler, lambda: None)
+        self.assertEqual(scheduler.limit, 8)
+
+    def testMultiplicativeDecrease(self):
+        scheduler = self.createScheduler(maxConcurrency=8, latencyTarget=0.1)
+        scheduler.limit = 8
+        scheduler._adjust(False)
+        self.assertEqual(scheduler.limit, 4)
+        # At most one decrease per latency target
+        scheduler._adjust(False)
+        self.assertEqual(scheduler.limit, 4)
+        time.sleep(0.1)
+        scheduler._adjust(False)
+        self.assertEqual(scheduler.limit, 2)
+
+    def testConcurrencyLimit(self):
+        scheduler = self.createScheduler(maxConcurrency=3)
+        scheduler.limit = 3
+        lock = threading.Lock()
+        active = [0, 0]
+        def write():
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+
+        for _ in range(9):
+            scheduler.submit(write, lambda error, latency: None)
+        scheduler.join()
+        self.assertEqual(active[1], 3)
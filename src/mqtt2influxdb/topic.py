@@ -1,4 +1,12 @@
+import functools
 import re
+import sys
+import types
+
+# Rules of large configurations share topics and token rules, each pattern is
+# compiled once. re's own cache is too small for thousands of patterns. The
+# cache is bounded, so patterns of replaced configurations do not pile up.
+_compilePattern = functools.lru_cache(maxsize=16384)(re.compile)
 
 class Topic:
     """
@@ -32,9 +40,9 @@ class Topic:
     def __init__(self, topic):
         self._topic = topic
         self._tokenRules = {}
+        self._regex = None
         self._createTokens()
         self._calculateNormalized()
-        self._makeRegex()
 
     @property
     def topic(self):
@@ -48,6 +56,10 @@ class Topic:
     def tokenRules(self):
         return self._tokenRules
 
+    @property
+    def tokenNames(self):
+        return [token['name'] for token in self._tokens if token.get('name', '') != '']
+
     def _calculateNormalized(self):
         self._normalized = '/'.join(list(map(
             lambda token : 
@@ -58,6 +70,11 @@ class Topic:
         , self._tokens)))
 
     def parse(self, topic):
+        # The regex is compiled when the first message arrives, which keeps
+        # the startup of large configurations short
+        if self._regex is None:
+            self._makeRegex()
+
         matches = self._regex.match(topic)
 
         # Return empty set if regex did not match anything
@@ -104,7 +121,7 @@ class Topic:
         self._tokenRules = {}
 
     def addTokenRule(self, token, data):
-        self._tokenRules.update({token: re.compile(data)})
+        self._tokenRules.update({token: _compilePattern(data)})
 
     def _createTokens(self):
         self._tokens = list(map(self._processToken, self._topic.split('/')))
@@ -152,4 +169,79 @@ class Topic:
 
         pattern += '$'
 
-        self._regex = re.compile(pattern)
\ No newline at end of file
+        self._regex = _compilePattern(pattern)
+
+def freezeTokens(tokens):
+    """
+        Returns a read only copy of the tokens returned by Topic.parse(), which
+        can be shared between messages. Single tokens are interned, multi
+        tokens become tuples.
+    """
+    return types.MappingProxyType({name: tuple(value) if isinstance(value, list) else sys.intern(value) for name, value in tokens.items()})
+
+def thawTokens(tokens):
+    return {name: list(value) if isinstance(value, tuple) else value for name, value in tokens.items()}
+
+class TopicTrie:
+    """
+        Subscription trie keyed by topic level. Filters may contain the MQTT
+        wildcards '+' and '#'. match() only walks the branches that can match
+        the given topic, so the cost depends on the topic depth instead of the
+        number of filters.
+    """
+
+    def __init__(self):
+        self._root = _TopicTrieNode()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, filter_, value):
+        node = self._root
+        for level in filter_.split('/'):
+            node = node.children.setdefault(level, _TopicTrieNode())
+
+        # Remember the insertion order, so matches are returned in a stable order
+        node.values.append((self._count, value))
+        self._count += 1
+
+    def match(self, topic):
+        levels = topic.split('/')
+        matches = []
+        # Topics starting with '$' are not matched by wildcards on the first level
+        self._match(self._root, levels, 0, matches, len(topic) > 0 and topic[0] == '$')
+
+        if len(matches) > 1:
+            matches.sort(key=lambda x: x[0])
+
+        return [value for _, value in matches]
+
+    def _match(self, node, levels, index, matches, systemTopic):
+        wildcards = not (systemTopic and index == 0)
+
+        if wildcards:
+            multi = node.children.get('#')
+            if multi is not None:
+                matches += multi.values
+
+        if index == len(levels):
+            matches += node.values
+            return
+
+        child = node.children.get(levels[index])
+        if child is not None:
+            self._match(child, levels, index + 1, matches, systemTopic)
+
+        if wildcards:
+            child = node.children.get('+')
+            if child is not None:
+                self._match(child, levels, index + 1, matches, systemTopic)
+
+
+class _TopicTrieNode:
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
@@ -0,0 +1,283 @@
+import logging
+import os
+import pathlib
+import struct
+import threading
+import time
+import zlib
+
+class DiscardBatch(Exception):
+    """
+        Raised by the writer of a WriteAheadLog for batches which will never be
+        accepted (e.g. malformed points), so they are dropped instead of retried.
+    """
+
+class WriteAheadLog:
+    """
+        Append-only log of line protocol batches which could not be written.
+
+        Batches are appended to segment files in a directory. A segment is
+        closed when it reaches segmentSize bytes. When the log exceeds maxSize
+        bytes, the oldest segments are deleted. Appends are flushed and
+        fsynced at most every fsyncInterval seconds, by the next append or
+        else by the replay thread.
+
+        A replay thread writes the logged batches in order with the given
+        writer function, combining records up to replayBatchBytes per write.
+        Failed writes are retried with an exponential backoff. The offset up
+        to which a segment was written is stored next to it, so a restart
+        continues there instead of writing the records again.
+    """
+
+    # Each record is prefixed with its length and CRC32
+    _HEADER = struct.Struct('<II')
+    _SUFFIX = '.wal'
+    # Offset of the first record of a segment which was not written yet
+    _ACK = struct.Struct('<Q')
+    _ACK_SUFFIX = '.ack'
+
+    def __init__(self, path, writer, segmentSize=16 * 1024 * 1024, maxSize=1024 * 1024 * 1024, fsyncInterval=1.0,
+                 replayBatchBytes=4 * 1024 * 1024, retryInterval=1.0, maxRetryInterval=60.0):
+        self.path = pathlib.Path(path)
+        self.segmentSize = segmentSize
+        self.maxSize = maxSize
+        self.fsyncInterval = fsyncInterval
+        self.replayBatchBytes = replayBatchBytes
+        self.retryInterval = retryInterval
+        self.maxRetryInterval = maxRetryInterval
+
+        self.appendedBatches = 0
+        self.replayedBatches = 0
+        self.droppedSegments = 0
+
+        self._writer = writer
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        self._stopEvent = threading.Event()
+        self._thread = None
+
+        self._activeFile = None
+        self._activeSegment = None
+        self._lastFsync = 0.0
+        self._unsynced = False
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        # Segments left over from a previous run are replayed first
+        self._segments = sorted(self.path.glob('*' + self._SUFFIX))
+        self._nextSequence = int(self._segments[-1].stem) + 1 if len(self._segments) > 0 else 0
+        if len(self._segments) > 0:
+            logging.info(f"Found {len(self._segments)} segments to replay in {self.path}")
+            self._pending.set()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._segments)
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    @property
+    def size(self):
+        with self._lock:
+            return sum(self._segmentSize(segment) for segment in self._segments)
+
+    def start(self):
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._replayLoop, name="walReplay")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopEvent.set()
+        self._pending.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        with self._lock:
+            self._closeActiveSegment()
+
+    def append(self, lines):
+        data = '\n'.join(lines).encode('utf-8')
+
+        with self._lock:
+            if self._activeFile is None:
+                self._openSegment()
+
+            self._activeFile.write(self._HEADER.pack(len(data), zlib.crc32(data)))
+            self._activeFile.write(data)
+            self.appendedBatches += 1
+
+            self._unsynced = True
+            self._syncIfDue()
+
+            if self._activeFile.tell() >= self.segmentSize:
+                self._closeActiveSegment()
+
+            self._enforceMaxSize()
+
+        self._pending.set()
+
+    def _openSegment(self):
+        segment = self.path / f"{self._nextSequence:016d}{self._SUFFIX}"
+        self._nextSequence += 1
+        self._activeFile = open(segment, 'ab')
+        self._activeSegment = segment
+        self._segments.append(segment)
+
+    def _closeActiveSegment(self):
+        if self._activeFile is not None:
+            self._fsync()
+            self._activeFile.close()
+            self._activeFile = None
+            self._activeSegment = None
+
+    def _fsync(self):
+        self._activeFile.flush()
+        os.fsync(self._activeFile.fileno())
+        self._lastFsync = time.monotonic()
+        self._unsynced = False
+
+    def _syncIfDue(self):
+        # The lock must be held
+        if (self._activeFile is not None) and self._unsynced and (time.monotonic() - self._lastFsync >= self.fsyncInterval):
+            self._fsync()
+
+    def _syncLater(self, timeout):
+        """
+            Waits up to timeout seconds for stop() and meanwhile syncs the
+            appends. Returns True if the log is stopped.
+        """
+        end = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._syncIfDue()
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return self._stopEvent.is_set()
+            if self._stopEvent.wait(min(remaining, self.fsyncInterval)):
+                return True
+
+    def _ackFile(self, segment):
+        return segment.with_suffix(self._ACK_SUFFIX)
+
+    def _readAck(self, segment):
+        try:
+            with open(self._ackFile(segment), 'rb') as f:
+                return self._ACK.unpack(f.read())[0]
+        except (FileNotFoundError, struct.error):
+            return 0
+
+    def _writeAck(self, segment, offset):
+        with open(self._ackFile(segment), 'wb') as f:
+            f.write(self._ACK.pack(offset))
+
+    def _segmentSize(self, segment):
+        try:
+            return segment.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def _enforceMaxSize(self):
+        size = sum(self._segmentSize(segment) for segment in self._segments)
+
+        # The active segment is never dropped
+        while (size > self.maxSize) and (len(self._segments) > 1):
+            segment = self._segments.pop(0)
+            size -= self._segmentSize(segment)
+            segment.unlink(missing_ok=True)
+            self._ackFile(segment).unlink(missing_ok=True)
+            self.droppedSegments += 1
+            logging.warning(f"Write-ahead log exceeds {self.maxSize} bytes, dropped segment {segment.name}")
+
+    def _nextSegmentToReplay(self):
+        with self._lock:
+            if len(self._segments) == 0:
+                return None
+
+            # Close the active segment, so it is not appended while replaying
+            if self._segments[0] == self._activeSegment:
+                self._closeActiveSegment()
+
+            return self._segments[0]
+
+    def _readRecords(self, segment, offset=0):
+        """
+            Returns the records from offset on with the offset of their end.
+        """
+        records = []
+        try:
+            with open(segment, 'rb') as f:
+                f.seek(offset)
+                while True:
+                    header = f.read(self._HEADER.size)
+                    if len(header) < self._HEADER.size:
+                        break
+                    length, crc = self._HEADER.unpack(header)
+                    data = f.read(length)
+                    if (len(data) < length) or (zlib.crc32(data) != crc):
+                        logging.warning(f"Truncated or corrupt record in {segment.name}, skipping rest of segment")
+                        break
+                    records.append((data, f.tell()))
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _replaySegment(self, segment):
+        records = self._readRecords(segment, self._readAck(segment))
+        retryInterval = self.retryInterval
+        index = 0
+
+        while index < len(records):
+            # Combine records into bulk writes
+            end = index
+            size = 0
+            while (end < len(records)) and ((end == index) or (size + len(records[end][0]) <= self.replayBatchBytes)):
+                size += len(records[end][0]) + 1
+                end += 1
+
+            try:
+                self._writer([record.decode('utf-8') for record, _ in records[index:end]])
+            except DiscardBatch as e:
+                logging.error(f"Dropping {end - index} batches from write-ahead log: {e}")
+            except Exception as e:
+                logging.warning(f"Replay of write-ahead log failed, retrying in {retryInterval:.1f} s: {e}")
+                if self._syncLater(retryInterval):
+                    return False
+                retryInterval = min(retryInterval * 2, self.maxRetryInterval)
+                continue
+
+            self._writeAck(segment, records[end - 1][1])
+            with self._lock:
+                self._syncIfDue()
+            self.replayedBatches += end - index
+            retryInterval = self.retryInterval
+            index = end
+
+        with self._lock:
+            if (len(self._segments) > 0) and (self._segments[0] == segment):
+                self._segments.pop(0)
+            segment.unlink(missing_ok=True)
+            self._ackFile(segment).unlink(missing_ok=True)
+
+        logging.info(f"Replayed {len(records)} batches of segment {segment.name}")
+        return True
+
+    def _replayLoop(self):
+        logging.debug("Starting write-ahead log replay loop ...")
+        while not self._stopEvent.is_set():
+            # Appends since the last fsync are synced while there is nothing to replay
+            if not self._pending.wait(self.fsyncInterval):
+                with self._lock:
+                    self._syncIfDue()
+                continue
+            self._pending.clear()
+
+            while not self._stopEvent.is_set():
+                segment = self._nextSegmentToReplay()
+                if segment is None:
+                    break
+                if not self._replaySegment(segment):
+                    break
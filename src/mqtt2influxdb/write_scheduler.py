@@ -0,0 +1,163 @@
+import collections
+import logging
+import random
+import threading
+import time
+
+from . import wal
+
+class WriteScheduler:
+    """
+        Runs batch writes on a pool of threads with an adaptive number of
+        writes in flight, at most maxConcurrency.
+
+        The limit starts at one and grows by one per successful write until
+        the first slow or failed write, then by one per round of writes
+        (additive increase). A write slower than latencyTarget or a failed
+        write halves it, at most once per latencyTarget (multiplicative
+        decrease), so the writes back off while InfluxDB is busy, e.g. with
+        compactions.
+
+        Failed writes are retried up to retries times after an exponential
+        backoff with full jitter. An error with a retryAfter attribute
+        (e.g. from a 429 or 503 response) pauses all writes for that long.
+        DiscardBatch errors are not retried.
+    """
+
+    def __init__(self, maxConcurrency=4, retries=3, backoff=0.5, maxBackoff=30.0, latencyTarget=2.0, name="influxdb"):
+        if maxConcurrency < 1:
+            raise ValueError(f"Invalid write concurrency {maxConcurrency}")
+
+        self.maxConcurrency = maxConcurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.latencyTarget = latencyTarget
+        self.name = name
+
+        self.limit = 1.0
+        self.retried = 0
+
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._inFlight = 0
+        self._pending = 0
+        self._slowStart = True
+        self._lastDecrease = 0.0
+        self._pausedUntil = 0.0
+        self._stopping = False
+        self._threads = []
+
+    def start(self):
+        with self._condition:
+            self._stopping = False
+        for index in range(self.maxConcurrency):
+            thread = threading.Thread(target=self._run, name=f"{self.name}Write{index}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+            Waits for the submitted writes and stops the threads.
+        """
+        self.join()
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, write, done):
+        """
+            Schedules write(), done(error, latency) is called when it succeeded
+            (error is None) or finally failed. Blocks while maxConcurrency
+            writes are waiting, so batches queue up in the caller instead.
+        """
+        with self._condition:
+            while (len(self._queue) >= self.maxConcurrency) and not self._stopping:
+                self._condition.wait()
+            self._queue.append((write, done))
+            self._pending += 1
+            self._condition.notify_all()
+
+    def join(self):
+        with self._condition:
+            while self._pending > 0:
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopping and len(self._queue) == 0:
+                        return
+                    pause = self._pausedUntil - time.monotonic()
+                    if (len(self._queue) > 0) and (self._inFlight < int(self.limit)) and (pause <= 0):
+                        break
+                    self._condition.wait(pause if pause > 0 else None)
+
+                write, done = self._queue.popleft()
+                self._inFlight += 1
+                self._condition.notify_all()
+
+            error = None
+            start = time.monotonic()
+            try:
+                # The write keeps its slot while it waits for a retry, so a failing server gets fewer requests
+                self._write(write)
+            except Exception as e:
+                error = e
+            latency = time.monotonic() - start
+
+            try:
+                done(error, latency)
+            except Exception:
+                logging.exception(f"Error in write callback of '{self.name}'")
+
+            with self._condition:
+                self._inFlight -= 1
+                self._pending -= 1
+                self._condition.notify_all()
+
+    def _write(self, write):
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                write()
+            except wal.DiscardBatch:
+                raise
+            except Exception as e:
+                retryAfter = getattr(e, 'retryAfter', None)
+                self._adjust(False, retryAfter)
+                if attempt >= self.retries:
+                    raise
+
+                delay = random.uniform(0, min(self.maxBackoff, self.backoff * 2**attempt))
+                if retryAfter is not None:
+                    delay = max(delay, min(retryAfter, self.maxBackoff))
+                attempt += 1
+                with self._condition:
+                    self.retried += 1
+                logging.warning(f"Write to '{self.name}' failed, retry {attempt}/{self.retries} in {delay:.2f} s: {e}")
+                time.sleep(delay)
+            else:
+                self._adjust(time.monotonic() - start <= self.latencyTarget)
+                return
+
+    def _adjust(self, success, retryAfter=None):
+        now = time.monotonic()
+        with self._condition:
+            if success:
+                self.limit = min(self.maxConcurrency, self.limit + (1 if self._slowStart else 1 / self.limit))
+            else:
+                self._slowStart = False
+                if now - self._lastDecrease >= self.latencyTarget:
+                    self._lastDecrease = now
+                    self.limit = max(1.0, self.limit / 2)
+
+            if retryAfter is not None:
+                self._pausedUntil = max(self._pausedUntil, now + min(retryAfter, self.maxBackoff))
+            self._condition.notify_all()